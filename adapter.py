@@ -21,6 +21,16 @@ class PaymentAdapter:
             'callback_host': os.environ.get('CALLBACK_HOST', '0.0.0.0'),
             'callback_port': int(os.environ.get('CALLBACK_PORT', 8000)),
             'public_url': os.environ.get('PUBLIC_URL', None),
+            # Public URL of the callback service (callbacks.py), if the host runs one
+            'callback_url': os.environ.get('CALLBACK_URL', None),
+            # Pooled API session (see http_client.py)
+            'http_pool_connections': int(os.environ.get('LIPIA_HTTP_POOL_CONNECTIONS', 1)),
+            'http_pool_maxsize': int(os.environ.get('LIPIA_HTTP_POOL_MAXSIZE', 10)),
+            'http_max_retries': int(os.environ.get('LIPIA_HTTP_MAX_RETRIES', 2)),
+            'http_backoff': float(os.environ.get('LIPIA_HTTP_BACKOFF', 0.2)),
+            'http_backoff_max': float(os.environ.get('LIPIA_HTTP_BACKOFF_MAX', 2.0)),
+            'http_retry_budget_ratio': float(os.environ.get('LIPIA_HTTP_RETRY_BUDGET_RATIO', 0.1)),
+            'http_retry_budget_min_per_second': float(os.environ.get('LIPIA_HTTP_RETRY_BUDGET_MIN_PER_SECOND', 1.0)),
         }
         
         # Set default server type based on environment
@@ -0,0 +1,119 @@
+"""
+Hot/cold tiering for transactions and payments.
+
+The hot collections (transactions, payments) hold what status checks and
+recent history read. Pending rows nobody completes expire through a partial
+TTL index on timestamp (see indexes.py). Rows in a final status older than
+ARCHIVE_AFTER_DAYS move in batches to transactions_archive and
+payments_archive, so the hot collections and their indexes stay small.
+
+A batch is copied to the archive (replace by _id, so a rerun is harmless)
+before it is deleted from the hot collection. Readers query the hot tier
+first, then the archive: a row moved in between is seen in both and
+deduplicated, never in neither. Rows that cannot be moved stay hot and are
+skipped for the rest of the pass instead of blocking the rows behind them.
+
+Timestamps are naive UTC, the clock MongoDB's TTL monitor ages them by.
+"""
+import os
+import heapq
+from datetime import datetime, timedelta
+
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+PENDING_TTL = int(os.environ.get('PENDING_TRANSACTION_TTL', 86400))
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 1000))
+
+FINAL_STATUSES = ("completed", "cancelled", "failed")
+TIERS = {"transactions": "transactions_archive", "payments": "payments_archive"}
+
+
+def stamp_missing_timestamps(db, now=None):
+    """Give rows without a timestamp one, so TTL and archiving can age them out"""
+    now = now or datetime.utcnow()
+    stamped = {}
+    for name in TIERS:
+        result = db[name].update_many({"timestamp": {"$exists": False}}, {"$set": {"timestamp": now}})
+        stamped[name] = result.modified_count
+    return stamped
+
+
+def archive_batch(db, name, cutoff, batch_size=ARCHIVE_BATCH_SIZE, skipped=None):
+    """
+    Move up to batch_size final rows older than cutoff to the archive,
+    returns rows moved. _ids in skipped are passed over, and rows this batch
+    fails to move are added to it.
+    """
+    hot, cold = db[name], db[TIERS[name]]
+    query = {"status": {"$in": list(FINAL_STATUSES)}, "timestamp": {"$lt": cutoff}}
+    if skipped:
+        query["_id"] = {"$nin": list(skipped)}
+    docs = list(hot.find(query).sort("timestamp", 1).limit(batch_size))
+    if not docs:
+        return 0
+
+    copied = [d["_id"] for d in docs]
+    try:
+        cold.bulk_write([ReplaceOne({"_id": d["_id"]}, d, upsert=True) for d in docs], ordered=False)
+    except BulkWriteError as e:
+        # Rows the archive refused (e.g. a checkout id archived under another
+        # _id) stay hot rather than being lost
+        failed = {error["index"] for error in e.details.get("writeErrors", [])}
+        copied = [d["_id"] for i, d in enumerate(docs) if i not in failed]
+        if skipped is not None:
+            skipped.update(d["_id"] for i, d in enumerate(docs) if i in failed)
+    if not copied:
+        return 0
+    # Final statuses do not change, the status guard is belt and braces
+    deleted = hot.delete_many({"_id": {"$in": copied}, "status": {"$in": list(FINAL_STATUSES)}}).deleted_count
+    if deleted < len(copied) and skipped is not None:
+        # Archived but still hot; readers deduplicate, a later pass retries
+        skipped.update(d["_id"] for d in hot.find({"_id": {"$in": copied}}, {"_id": 1}))
+    return deleted
+
+
+def archive(db, older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE, max_batches=None, progress=None,
+            skipped=None):
+    """
+    Archive final rows older than older_than_days in batches, returns rows
+    moved per collection. Rows that could not be moved are collected in
+    skipped (collection -> set of _ids) when it is given.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    moved = dict.fromkeys(TIERS, 0)
+    if skipped is None:
+        skipped = {}
+    for name in TIERS:
+        skipped.setdefault(name, set())
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            before = len(skipped[name])
+            count = archive_batch(db, name, cutoff, batch_size, skipped[name])
+            if not count and len(skipped[name]) == before:
+                break
+            moved[name] += count
+            batches += 1
+            if progress:
+                progress(name, moved[name])
+    return moved
+
+
+def find_one(db, name, query, projection=None):
+    """Find a row in the hot tier, then in the archive"""
+    doc = db[name].find_one(query, projection)
+    if doc is None:
+        doc = db[TIERS[name]].find_one(query, projection)
+    return doc
+
+
+def merge_newest_first(hot, cold, key):
+    """Merge two newest-first cursors over both tiers, dropping rows seen in both"""
+    # key includes _id, so the two copies of a row come out next to each other
+    previous = None
+    for doc in heapq.merge(hot, cold, key=key, reverse=True):
+        if previous is not None and doc["_id"] == previous:
+            continue
+        previous = doc["_id"]
+        yield doc
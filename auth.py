@@ -1,7 +1,7 @@
 from flask import Blueprint, request, jsonify, session, redirect, url_for, flash, current_app
 from functools import wraps
 import re
-from models import get_user, create_user, update_user, user_exists
+from models import get_user, get_account, create_user, update_user, user_exists
 
 # Initialize auth blueprint
 auth_bp = Blueprint('auth', __name__)
@@ -85,7 +85,7 @@ def api_login():
         
         # Get user
         try:
-            user = get_user(username)
+            user = get_user(username, 'auth')
             if not user:
                 return jsonify({"error": "User not found"}), 404
             
@@ -134,7 +134,7 @@ def api_get_user():
         username = session.get('user_id')
         
         try:
-            user = get_user(username)
+            user = get_user(username, 'profile')
             
             if not user:
                 return jsonify({"error": "User not found"}), 404
@@ -160,6 +160,26 @@ def api_get_user():
         current_app.logger.error(f"Unexpected error in api_get_user: {e}")
         return jsonify({"error": "Failed to get user information"}), 500
 
+@auth_bp.route('/api/account', methods=['GET'])
+@api_login_required
+def api_get_account():
+    """API endpoint for the account view: balance, plan, recent payments and this month's usage"""
+    username = session.get('user_id')
+    try:
+        account = get_account(username)
+    except Exception as e:
+        current_app.logger.error(f"Error retrieving account for {username}: {e}")
+        return jsonify({"error": "Failed to retrieve account"}), 500
+    
+    if not account:
+        return jsonify({"error": "User not found"}), 404
+    
+    for payment in account["recent_payments"]:
+        timestamp = payment.get("timestamp")
+        if hasattr(timestamp, "isoformat"):
+            payment["timestamp"] = timestamp.isoformat()
+    return jsonify({"status": "success", "account": account}), 200
+
 @auth_bp.route('/api/user/update', methods=['POST'])
 @api_login_required
 def api_update_user():
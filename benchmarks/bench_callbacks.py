@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Sustained payment callbacks per second through the callback service (callbacks.py).
+
+Seeds pending checkouts in the BENCH_MONGO_URI database and runs the
+callback server and consumer in this process on a throwaway queue file
+(--queue-dir, so it can be put on the disk under test). --clients
+senders post callbacks over keep-alive connections, one per checkout,
+with --repeats of them redelivered as the provider does. Three phases:
+
+    ingest     consumer stopped: how fast callbacks for fresh checkouts are durably queued
+    drain      consumer started on that backlog: settlements per second
+    sustained  both at once, for --callbacks fresh checkouts more
+
+Every phase prints its rate, the queue's group commits, and the worst
+queue depth, oldest queued callback and receipt-to-settlement lag seen
+by a once-a-second sampler of the server's stats().
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/bench python benchmarks/bench_callbacks.py --callbacks 5000
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import tempfile
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+import callbacks
+
+
+def seed(username, count):
+    run = uuid.uuid4().hex[:8]
+    checkout_ids = [f"STK-cb-{run}-{i}" for i in range(count)]
+    for checkout_id in checkout_ids:
+        models.save_transaction(checkout_id, {
+            'checkout_id': checkout_id,
+            'username': username,
+            'amount': 20,
+            'phone': '0712345678',
+            'subscription_type': 'basic',
+            'status': 'pending'
+        })
+        models.record_payment(username, 20, 'basic', 'pending', 'N/A', checkout_id)
+    return checkout_ids
+
+
+def send(port, checkout_ids, clients):
+    """Post one callback per checkout id from clients keep-alive connections, returns seconds taken"""
+    local = threading.local()
+
+    def post(checkout_id):
+        for _ in range(3):
+            if getattr(local, 'conn', None) is None:
+                local.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            try:
+                local.conn.request('POST', f'/payment/callback?checkout_id={checkout_id}',
+                                   body=json.dumps({"reference": f"CB-{checkout_id[-8:]}"}),
+                                   headers={'Content-Type': 'application/json'})
+                response = local.conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise RuntimeError(f"callback answered {response.status}")
+                return
+            except (OSError, http.client.HTTPException):
+                local.conn.close()
+                local.conn = None
+        raise RuntimeError(f"could not post callback for {checkout_id}")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(post, checkout_ids))
+    return time.perf_counter() - started
+
+
+class Sampler:
+    """Worst queue depth, oldest age and lag seen once a second"""
+    def __init__(self, server):
+        self.server = server
+        self.worst = {"depth": 0, "oldest_age": 0.0, "last_lag": 0.0}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(1.0):
+            self.sample()
+
+    def sample(self):
+        stats = self.server.stats()
+        observed = dict(stats["queue"], last_lag=stats["consumer"]["last_lag"])
+        for key in self.worst:
+            self.worst[key] = max(self.worst[key], observed[key])
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        return self.worst
+
+
+def wait_drained(queue, timeout):
+    started = time.perf_counter()
+    while queue.stats()["depth"] and time.perf_counter() - started < timeout:
+        time.sleep(0.05)
+    return time.perf_counter() - started
+
+
+def with_repeats(checkout_ids, share):
+    position = {checkout_id: i for i, checkout_id in enumerate(checkout_ids)}
+    repeated = checkout_ids + random.sample(checkout_ids, int(len(checkout_ids) * share))
+    # Redeliveries arrive a little later than the first callback
+    return sorted(repeated, key=lambda c: position[c] + random.uniform(0, 50))
+
+
+def snapshot(server):
+    return server.queue.stats(), server.consumer.stats()
+
+
+def report(label, count, seconds, before, server, worst):
+    (queue, consumer), (queue_before, consumer_before) = snapshot(server), before
+    applied, duplicates, ignored = (consumer[k] - consumer_before[k] for k in ('applied', 'duplicates', 'ignored'))
+    print(f"{label:>9}: {count / seconds:8.0f} callbacks/s  "
+          f"({queue['appended'] - queue_before['appended']} queued in {queue['commits'] - queue_before['commits']} commits)  "
+          f"applied={applied} duplicates={duplicates} ignored={ignored}  "
+          f"worst depth={worst['depth']} oldest={worst['oldest_age']:.2f}s lag={worst['last_lag']:.2f}s "
+          f"max lag={consumer['max_lag']:.2f}s")
+
+
+def main(args):
+    os.environ['MONGO_URI'] = os.environ['BENCH_MONGO_URI']
+    os.environ.setdefault('ARCHIVE_INTERVAL', '0')
+    app = callbacks.create_app()
+    from payment import process_payment_callback
+
+    username = f"cbbench_{uuid.uuid4().hex[:8]}"
+    models.create_user(username, '1234', '0712345678')
+
+    with tempfile.TemporaryDirectory(dir=args.queue_dir) as directory:
+        queue = callbacks.CallbackQueue(os.path.join(directory, 'callbacks.db'), synchronous=args.synchronous)
+        consumer = callbacks.CallbackConsumer(queue, process_payment_callback, context=app.app_context,
+                                              batch_size=args.batch_size, concurrency=args.threads)
+        server = callbacks.CallbackServer(('127.0.0.1', 0), queue, consumer)
+        port = server.server_address[1]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        # ingest: nothing is applied yet
+        checkout_ids = seed(username, args.callbacks)
+        posted = with_repeats(checkout_ids, args.repeats)
+        before, sampler = snapshot(server), Sampler(server)
+        seconds = send(port, posted, args.clients)
+        report('ingest', len(posted), seconds, before, server, sampler.stop())
+
+        # drain: the consumer works through the backlog
+        before, sampler = snapshot(server), Sampler(server)
+        consumer.start()
+        seconds = wait_drained(queue, args.timeout)
+        report('drain', len(posted), seconds, before, server, sampler.stop())
+
+        # sustained: callbacks arrive while they are applied
+        checkout_ids = seed(username, args.callbacks)
+        posted = with_repeats(checkout_ids, args.repeats)
+        before, sampler = snapshot(server), Sampler(server)
+        started = time.perf_counter()
+        send(port, posted, args.clients)
+        wait_drained(queue, args.timeout)
+        report('sustained', len(posted), time.perf_counter() - started, before, server, sampler.stop())
+        print(f"           {server.stats()}")
+
+        server.shutdown()
+        consumer.stop(timeout=10)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--callbacks', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--repeats', type=float, default=0.1, help='share of callbacks delivered twice')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=8, help='consumer apply threads')
+    parser.add_argument('--synchronous', default='FULL', choices=('FULL', 'NORMAL'))
+    parser.add_argument('--queue-dir', default=None, help='directory for the queue file')
+    parser.add_argument('--timeout', type=float, default=600.0, help='longest wait for the queue to drain')
+    main(parser.parse_args())
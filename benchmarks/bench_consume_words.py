@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Concurrency benchmark for /api/user/consume-words.
+
+Hammers the endpoint from many threads against a single user and reports
+debits per second and any over-spend (successful debits beyond the starting
+balance, or a final balance that does not match the debits served).
+
+Uses MongoDB when BENCH_MONGO_URI is set, otherwise the in-memory fallback.
+
+    python benchmarks/bench_consume_words.py --threads 32 --requests 200
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+import models
+from auth import auth_bp
+
+
+def build_app():
+    """Create a Flask app with only the auth blueprint registered"""
+    app = Flask(__name__)
+    app.secret_key = 'bench'
+    app.register_blueprint(auth_bp)
+
+    mongo_uri = os.environ.get('BENCH_MONGO_URI')
+    if mongo_uri:
+        app.config['MONGO_URI'] = mongo_uri
+        os.environ['MONGO_FALLBACK_TO_MEMORY'] = 'false'
+        models.init_mongo(app)
+    return app
+
+
+def run(threads, requests_per_thread, words_per_debit, balance):
+    app = build_app()
+    username = f"bench-{int(time.time())}"
+    models.create_user(username, '1234', '0712345678')
+    models.update_word_count(username, balance)
+
+    successes = [0] * threads
+    failures = [0] * threads
+    start_barrier = threading.Barrier(threads + 1)
+
+    def worker(idx):
+        client = app.test_client()
+        client.post('/api/login', json={'username': username, 'pin': '1234'})
+        start_barrier.wait()
+        for _ in range(requests_per_thread):
+            resp = client.post('/api/user/consume-words', json={'words': words_per_debit})
+            if resp.status_code == 200:
+                successes[idx] += 1
+            else:
+                failures[idx] += 1
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    served = sum(successes)
+    total = served + sum(failures)
+    final_balance = models.get_user(username).get('words_remaining', 0)
+    overspend = max(0, served * words_per_debit - balance)
+    drift = balance - served * words_per_debit - final_balance
+
+    print(f"backend:          {'mongodb' if models.mongo_connected else 'in-memory'}")
+    print(f"threads:          {threads}")
+    print(f"requests:         {total} in {elapsed:.2f}s ({total / elapsed:.0f} req/s)")
+    print(f"debits served:    {served} ({served / elapsed:.0f} debits/s)")
+    print(f"debits rejected:  {sum(failures)}")
+    print(f"starting balance: {balance}")
+    print(f"final balance:    {final_balance}")
+    print(f"over-spend:       {overspend} words")
+    print(f"balance drift:    {drift} words")
+    return overspend == 0 and drift == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=200, help='requests per thread')
+    parser.add_argument('--words', type=int, default=7, help='words per debit')
+    parser.add_argument('--balance', type=int, default=10000, help='starting balance')
+    args = parser.parse_args()
+    ok = run(args.threads, args.requests, args.words, args.balance)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the in-memory fallback transaction store.
+
+Fills the store with 1k..1M transactions and measures point lookups
+(get_transaction / get_payment / /payment/check), status updates and
+per-user history reads. Latency should stay flat as the store grows.
+
+    python benchmarks/bench_fallback_store.py --sizes 1000 10000 100000 1000000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from store import TransactionStore
+
+USERS = 5000
+
+
+def fill(store, size):
+    for i in range(size):
+        store.upsert(f"ws_CO_{i}", {
+            'user_id': f"user{i % USERS}",
+            'phone_number': '0712345678',
+            'amount': 20,
+            'date': '2024-01-01 00:00:00',
+            'status': 'completed' if i % 10 else 'pending',
+            'reference': f"REF{i}",
+            'subscription_type': 'basic'
+        })
+
+
+def timed(fn, keys):
+    started = time.perf_counter()
+    for key in keys:
+        fn(key)
+    return (time.perf_counter() - started) / len(keys) * 1e9
+
+
+def run(sizes, samples):
+    print(f"{'size':>9} {'get ns':>9} {'miss ns':>9} {'update ns':>10} {'history ns':>11} {'per-user':>9}")
+    for size in sizes:
+        store = TransactionStore()
+        fill(store, size)
+        rng = random.Random(size)
+        hit_keys = [f"ws_CO_{rng.randrange(size)}" for _ in range(samples)]
+        miss_keys = [f"missing_{i}" for i in range(samples)]
+        user_keys = [f"user{rng.randrange(USERS)}" for _ in range(samples // 10 or 1)]
+
+        get_ns = timed(store.get, hit_keys)
+        miss_ns = timed(store.get, miss_keys)
+        update_ns = timed(lambda k: store.update(k, {'status': 'completed'}), hit_keys)
+        history_ns = timed(store.for_user, user_keys)
+        per_user = size // USERS or 1
+        print(f"{size:>9} {get_ns:>9.0f} {miss_ns:>9.0f} {update_ns:>10.0f} {history_ns:>11.0f} {per_user:>9}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--samples', type=int, default=100000)
+    args = parser.parse_args()
+    run(args.sizes, args.samples)
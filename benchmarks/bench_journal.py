@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the fallback write journal.
+
+Measures journaled (fsynced, group-committed) writes per second through the
+fallback store from N threads, then the time to replay a journal of
+--replay-entries entries into a fresh store.
+
+    python benchmarks/bench_journal.py --threads 1 8 32 --replay-entries 1000000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from journal import Journal
+from store import UserStore, TransactionStore
+
+
+def user_record(i):
+    return {
+        "password": "1234",
+        "plan": "Basic",
+        "joined_date": "2024-01-01",
+        "words_used": 0,
+        "words_remaining": i,
+        "phone_number": "0712345678",
+        "payment_status": "Paid",
+        "api_keys": {"gpt_zero": "", "originality": ""}
+    }
+
+
+def bench_writes(directory, threads, writes_per_thread):
+    journal = Journal(directory)
+    users = UserStore()
+    users.changes.journal = journal
+
+    def worker(idx):
+        for i in range(writes_per_thread):
+            users.put(f"user{idx}-{i}", user_record(i))
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+    journal.close()
+
+    writes = threads * writes_per_thread
+    per_commit = writes / max(1, journal.metrics["commits"])
+    print(f"threads={threads:<3} writes={writes:<7} {writes / elapsed:>9.0f} writes/s "
+          f"{elapsed / writes * 1e6:>8.1f} us/write  {per_commit:>6.1f} writes/fsync")
+
+
+def bench_replay(directory, entries):
+    # Write the journal without fsync, only replay speed is measured here
+    journal = Journal(directory, fsync=False, commit_interval=0)
+    for i in range(entries):
+        if i % 2:
+            journal.append('user', f"user{i % 100000}", user_record(i))
+        else:
+            journal.append('transaction', f"ws_CO_{i}", {
+                'user_id': f"user{i % 100000}", 'phone_number': '0712345678', 'amount': 20,
+                'date': '2024-01-01 00:00:00', 'status': 'pending', 'reference': 'N/A',
+                'subscription_type': 'basic'
+            })
+    journal.seal()
+    journal.close()
+    segments = sorted(os.path.join(directory, n) for n in os.listdir(directory))
+
+    replayer = Journal(directory)
+    users, transactions = UserStore(), TransactionStore()
+    started = time.perf_counter()
+    for kind, key, record in replayer.replay(segments):
+        if kind == 'user':
+            users.restore(key, record)
+        else:
+            transactions.restore(key, record)
+    elapsed = time.perf_counter() - started
+    size_mb = sum(os.path.getsize(p) for p in segments) / 1e6
+    print(f"replayed {entries} entries ({size_mb:.0f} MB, {len(segments)} segments) in {elapsed:.2f}s "
+          f"({entries / elapsed:.0f} entries/s), {len(users)} users, {len(transactions)} transactions")
+    replayer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--writes', type=int, default=2000, help='writes per thread')
+    parser.add_argument('--replay-entries', type=int, default=1000000)
+    parser.add_argument('--dir', default=None, help='journal directory (default: a temp dir)')
+    args = parser.parse_args()
+
+    base = args.dir or tempfile.mkdtemp(prefix='journal-bench-')
+    try:
+        for threads in args.threads:
+            directory = os.path.join(base, f"writes-{threads}")
+            bench_writes(directory, threads, args.writes)
+        bench_replay(os.path.join(base, 'replay'), args.replay_entries)
+    finally:
+        if not args.dir:
+            shutil.rmtree(base, ignore_errors=True)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Balance-read latency as the word ledger grows.
+
+Grows word_ledger through --stages (default up to 10M entries) spread over
+--users users. Each user keeps a tail of --tail unfolded entries; everything
+older is folded, as compaction leaves it. After each stage it times
+ledger.balance (tail query + snapshot read) for random users and prints
+the ledger size, the size of the partial tail index and latency
+percentiles. Read latency should follow the tail, not the ledger.
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/bench python benchmarks/bench_ledger_balance.py
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import MongoClient
+
+import ledger
+import indexes
+
+
+def grow(db, start, stop, users, batch=10000):
+    """Insert folded entries start..stop, round-robin over users"""
+    base = datetime(2024, 1, 1)
+    for offset in range(start, stop, batch):
+        db.word_ledger.insert_many([
+            {
+                "_id": f"bench-{i}",
+                "username": f"ledgerbench{i % users}",
+                "delta": 1,
+                "reason": "bench",
+                "at": base + timedelta(seconds=i),
+                "folded": True
+            }
+            for i in range(offset, min(stop, offset + batch))
+        ], ordered=False)
+
+
+def seed_tails(db, users, tail):
+    db.word_ledger.delete_many({"folded": False, "username": {"$regex": "^ledgerbench"}})
+    now = datetime.now()
+    db.word_ledger.insert_many([
+        {
+            "_id": f"tail-{u}-{t}",
+            "username": f"ledgerbench{u}",
+            "delta": 1,
+            "reason": "bench",
+            "at": now,
+            "folded": False
+        }
+        for u in range(users) for t in range(tail)
+    ])
+
+
+def main(stages, users, tail, reads):
+    db = MongoClient(os.environ['BENCH_MONGO_URI']).get_database()
+    db.word_ledger.drop()
+    db.users.delete_many({"username": {"$regex": "^ledgerbench"}})
+    db.users.insert_many([{"username": f"ledgerbench{u}", "words_remaining": 0} for u in range(users)])
+    indexes.apply(db, collections=("users", "word_ledger"))
+    seed_tails(db, users, tail)
+
+    rng = random.Random(3)
+    size = 0
+    for stage in stages:
+        t0 = time.perf_counter()
+        grow(db, size, stage, users)
+        grown = time.perf_counter() - t0
+        size = stage
+
+        latencies = []
+        for _ in range(reads):
+            username = f"ledgerbench{rng.randrange(users)}"
+            t0 = time.perf_counter()
+            ledger.balance(db, username)
+            latencies.append(time.perf_counter() - t0)
+        latencies.sort()
+
+        index_sizes = db.command('collStats', 'word_ledger')['indexSizes']
+        print(f"{size:>10} entries (+{grown:.0f}s): tail index {index_sizes.get('ledger_tail', 0) / 1024:.0f}KB  "
+              f"history index {index_sizes.get('ledger_history', 0) / 1048576:.0f}MB  "
+              f"balance p50={statistics.median(latencies) * 1000:.3f}ms "
+              f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.3f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--stages', type=lambda v: [int(x) for x in v.split(',')],
+                        default=[10000, 100000, 1000000, 10000000])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--tail', type=int, default=5, help='unfolded entries per user')
+    parser.add_argument('--reads', type=int, default=5000)
+    args = parser.parse_args()
+    main(args.stages, args.users, args.tail, args.reads)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+STK push latency through a bare requests.post per call vs the pooled LipiaClient.
+
+Starts a local HTTPS stand-in for the Lipia API with a throwaway
+self-signed certificate (needs the openssl command). Every new connection
+waits --connect-delay seconds before its TLS handshake, standing in for
+the DNS, TCP and TLS round trips to the real host, and every request
+takes --latency seconds. --threads senders, like the STK dispatcher's,
+post --requests pushes in each mode; it prints p50/p99 latency, the
+connections the server accepted and the client's metrics().
+
+Finally the client is pointed at a closed port for an --outage-requests
+push outage: connections are refused, so pushes are retried, and the
+attempts per push show the retry budget holding retries to a fraction
+of traffic.
+
+    python benchmarks/bench_lipia_session.py --connect-delay 0.06 --latency 0.05
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from adapter import PaymentAdapter
+from http_client import LipiaClient
+
+
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes
+    disable_nagle_algorithm = True
+    connect_delay = 0.0
+    latency = 0.0
+    lock = threading.Lock()
+    connections = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        time.sleep(self.connect_delay)
+        self.request.do_handshake()
+        with self.lock:
+            type(self).connections += 1
+        super().setup()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        body = json.dumps({"message": "STK push sent", "data": {"CheckoutRequestID": "ws_CO_standin"}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TLSServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, context):
+        super().__init__(address, handler)
+        self.context = context
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+        # Handshake in the handler thread, after the simulated connect delay
+        return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), address
+
+
+def start_stand_in(directory):
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+                    '-keyout', key, '-out', cert], check=True, capture_output=True)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server = TLSServer(('localhost', 0), StandIn, context)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # Both modes verify the stand-in's certificate through requests' CA bundle setting
+    os.environ['REQUESTS_CA_BUNDLE'] = cert
+    return f"https://localhost:{server.server_port}"
+
+
+def closed_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def timed(send, requests_count, threads):
+    def one(_):
+        t0 = time.perf_counter()
+        try:
+            send()
+        except requests.exceptions.RequestException:
+            pass
+        return time.perf_counter() - t0
+    with ThreadPoolExecutor(threads) as pool:
+        return sorted(pool.map(one, range(requests_count)))
+
+
+def report(label, latencies, extra=''):
+    p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)]
+    print(f"{label:>8}: p50={statistics.median(latencies) * 1000:7.1f}ms  p99={p99 * 1000:7.1f}ms  {extra}")
+
+
+def main(args):
+    StandIn.connect_delay = args.connect_delay
+    StandIn.latency = args.latency
+    payload = {'phone': '0712345678', 'amount': '20', 'callback_url': 'https://example.com/payment/callback'}
+    with tempfile.TemporaryDirectory() as directory:
+        adapter = PaymentAdapter()
+        adapter.config['api_base_url'] = start_stand_in(directory)
+        headers = {'Authorization': f'Bearer {adapter.get_api_key()}', 'Content-Type': 'application/json'}
+
+        StandIn.connections = 0
+        latencies = timed(lambda: requests.post(adapter.get_api_url('request/stk'), headers=headers,
+                                                json=payload, timeout=15), args.requests, args.threads)
+        report('bare', latencies, f"connections={StandIn.connections}")
+
+        client = LipiaClient(adapter)
+        StandIn.connections = 0
+        latencies = timed(lambda: client.post('request/stk', json=payload, timeout=15), args.requests, args.threads)
+        report('pooled', latencies, f"connections={StandIn.connections}")
+        print(f"          {client.metrics()}")
+
+        adapter.config['api_base_url'] = f"http://localhost:{closed_port()}"
+        before = client.metrics()
+        latencies = timed(lambda: client.post('request/stk', json=payload, timeout=5), args.outage_requests, args.threads)
+        after = client.metrics()
+        sent = after['requests'] - before['requests']
+        attempts = after['attempts'] - before['attempts']
+        report('outage', latencies, f"{attempts / sent:.2f} attempts per push, "
+                                    f"{after['retries_denied'] - before['retries_denied']} retries denied by the budget")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--connect-delay', type=float, default=0.06, help='seconds added to each new connection')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stand-in takes per request')
+    parser.add_argument('--outage-requests', type=int, default=400)
+    main(parser.parse_args())
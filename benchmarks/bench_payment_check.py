@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+/payment/check latency on a large transaction history, before and after tiering.
+
+Seeds --rows historical completed transactions and payments (default 50M,
+spread over two years and --users users) plus --recent pending checkouts,
+then times GET /payment/check/<id> for random recent checkouts and for
+unknown ids (a 404 reads both tiers). It then archives everything older
+than --older-than-days with archive.archive and times the same requests
+again. After each phase it prints the hot collections' document count and
+index sizes: the point of tiering is that the hot indexes fit in the
+WiredTiger cache, so compare them with the cache size printed at the start.
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/bench python benchmarks/bench_payment_check.py --rows 50000000
+
+Seeding 50M rows takes a while; --skip-seed reuses a seeded database.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+import models
+import archive
+import indexes
+
+
+def build_app():
+    app = Flask(__name__)
+    app.secret_key = 'bench'
+    app.config['MONGO_URI'] = os.environ['BENCH_MONGO_URI']
+    os.environ['MONGO_FALLBACK_TO_MEMORY'] = 'false'
+    os.environ['ARCHIVE_INTERVAL'] = '0'
+    models.ARCHIVE_INTERVAL = 0
+    models.init_mongo(app)
+    with app.app_context():
+        from payment import payment_bp, ACTIVE_TRANSACTIONS
+    app.register_blueprint(payment_bp)
+    return app, ACTIVE_TRANSACTIONS
+
+
+def seed(db, rows, users, batch=20000):
+    db.transactions.drop()
+    db.payments.drop()
+    db.transactions_archive.drop()
+    db.payments_archive.drop()
+    indexes.apply(db)
+    start = datetime.now() - timedelta(days=730)
+    step = timedelta(days=700) / rows
+    started = time.time()
+    for offset in range(0, rows, batch):
+        transactions, payments = [], []
+        for i in range(offset, min(rows, offset + batch)):
+            checkout_id = f"ws_CO_{i:010d}"
+            common = {
+                "username": f"checkbench{i % users}",
+                "amount": 20,
+                "subscription_type": "basic",
+                "timestamp": start + step * i,
+                "status": "completed" if i % 20 else "cancelled",
+                "reference": f"REF{i}"
+            }
+            transactions.append(dict(common, _id=checkout_id, checkout_id=checkout_id, phone="0712345678"))
+            payments.append(dict(common, checkout_id=checkout_id))
+        db.transactions.insert_many(transactions, ordered=False)
+        db.payments.insert_many(payments, ordered=False)
+        if offset and offset % 1000000 == 0:
+            print(f"  seeded {offset} rows ({time.time() - started:.0f}s)", flush=True)
+
+
+def seed_recent(db, recent):
+    checkout_ids = []
+    now = datetime.now()
+    for i in range(recent):
+        checkout_id = f"ws_CO_recent_{i}"
+        db.transactions.replace_one({"_id": checkout_id}, {
+            "checkout_id": checkout_id,
+            "username": f"checkbench{i}",
+            "amount": 20,
+            "phone": "0712345678",
+            "subscription_type": "basic",
+            "timestamp": now,
+            "status": "pending"
+        }, upsert=True)
+        checkout_ids.append(checkout_id)
+    return checkout_ids
+
+
+def hot_stats(db):
+    for name in archive.TIERS:
+        stats = db.command('collStats', name)
+        sizes = ', '.join(f"{k} {v / 1048576:.0f}MB" for k, v in stats['indexSizes'].items())
+        print(f"  {name}: {stats['count']} docs, indexes {stats['totalIndexSize'] / 1048576:.0f}MB ({sizes})")
+
+
+def measure(label, client, active, checkout_ids, requests):
+    from payment import status_cache
+    rng = random.Random(11)
+    latencies = []
+    for _ in range(requests):
+        checkout_id = rng.choice(checkout_ids)
+        # Skip the route's in-process status memo and cache so every request reads MongoDB
+        active.pop(checkout_id, None)
+        status_cache.invalidate(checkout_id)
+        t0 = time.perf_counter()
+        client.get(f"/payment/check/{checkout_id}")
+        latencies.append(time.perf_counter() - t0)
+    latencies.sort()
+    print(f"  {label:>8}: p50={statistics.median(latencies) * 1000:.3f}ms  "
+          f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.3f}ms")
+
+
+def phase(label, db, client, active, recent_ids, requests):
+    print(label)
+    hot_stats(db)
+    measure("recent", client, active, recent_ids, requests)
+    measure("unknown", client, active, [f"ws_CO_missing_{i}" for i in range(1000)], requests)
+
+
+def main(args):
+    app, active = build_app()
+    db = models.get_db()
+    cache = db.command('serverStatus')['wiredTiger']['cache']['maximum bytes configured']
+    print(f"WiredTiger cache: {cache / 1048576:.0f}MB")
+
+    if not args.skip_seed:
+        seed(db, args.rows, args.users)
+    recent_ids = seed_recent(db, args.recent)
+    client = app.test_client()
+
+    phase("untiered", db, client, active, recent_ids, args.requests)
+    started = time.time()
+    moved = archive.archive(db, older_than_days=args.older_than_days, batch_size=args.batch_size)
+    print(f"archived {moved} in {time.time() - started:.0f}s")
+    phase("tiered", db, client, active, recent_ids, args.requests)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000000)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--recent', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--older-than-days', type=float, default=90)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--skip-seed', action='store_true')
+    main(parser.parse_args())
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Throughput of initiate + callback payment cycles through record_payment.
+
+Each cycle records a pending payment (STK push initiated) and completes it
+(callback). Every --reject-every'th cycle is cancelled before its callback
+arrives, and that completion must be rejected. At the end the benchmark checks
+that each checkout id has exactly one payment in the expected status.
+
+Uses MongoDB when BENCH_MONGO_URI is set, otherwise the fallback store.
+
+    python benchmarks/bench_payment_cycles.py --cycles 10000 --threads 8
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+import models
+
+
+def build_app():
+    app = Flask(__name__)
+    mongo_uri = os.environ.get('BENCH_MONGO_URI')
+    if mongo_uri:
+        app.config['MONGO_URI'] = mongo_uri
+        os.environ['MONGO_FALLBACK_TO_MEMORY'] = 'false'
+        models.init_mongo(app)
+    return app
+
+
+def run(cycles, threads, reject_every):
+    build_app()
+    username = f"paybench-{int(time.time())}"
+    models.create_user(username, '1234', '0712345678')
+    checkout_ids = [f"paybench-{uuid.uuid4()}" for _ in range(cycles)]
+    rejected = [0] * threads
+    unexpected = [0] * threads
+
+    def worker(idx):
+        for i in range(idx, cycles, threads):
+            checkout_id = checkout_ids[i]
+            models.record_payment(username, 20, 'basic', 'pending', 'N/A', checkout_id)
+            cancel = reject_every and i % reject_every == 0
+            if cancel:
+                models.update_payment_status(checkout_id, 'cancelled')
+            completed = models.record_payment(username, 20, 'basic', 'completed', f"REF{i}", checkout_id)
+            if not completed:
+                rejected[idx] += 1
+            if completed == bool(cancel):
+                unexpected[idx] += 1
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    # One record per checkout id, in the status its cycle should end in
+    mismatched = 0
+    for i, checkout_id in enumerate(checkout_ids):
+        payment = models.get_payment(checkout_id)
+        expected = 'cancelled' if reject_every and i % reject_every == 0 else 'completed'
+        if payment is None or payment.get('status') != expected:
+            mismatched += 1
+    duplicates = 0
+    if models.mongo_connected:
+        duplicates = models.get_db().payments.count_documents({"username": username}) - cycles
+
+    print(f"backend:             {'mongodb' if models.mongo_connected else 'fallback store'}")
+    print(f"cycles:              {cycles} on {threads} threads in {elapsed:.2f}s")
+    print(f"throughput:          {cycles / elapsed:.0f} cycles/s")
+    print(f"rejected callbacks:  {sum(rejected)}")
+    print(f"unexpected outcomes: {sum(unexpected)}")
+    print(f"wrong final status:  {mismatched}")
+    print(f"duplicate payments:  {duplicates}")
+    return not (sum(unexpected) or mismatched or duplicates)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cycles', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--reject-every', type=int, default=10, help='cancel every Nth payment before its callback')
+    args = parser.parse_args()
+    sys.exit(0 if run(args.cycles, args.threads, args.reject_every) else 1)
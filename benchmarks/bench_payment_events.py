@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Server CPU and MongoDB QPS of --clients waiting payment pages, polling vs /payment/events.
+
+Runs the payment blueprint under gunicorn with threaded workers (-w
+--workers, --threads each, PAYMENT_EVENTS_MAX_STREAMS=--max-streams or
+the cap derived from the threads) on the BENCH_MONGO_URI database and
+seeds one pending checkout per client. The waiting pages are simulated
+by one asyncio loop:
+
+    poll    GET /payment/check/<id> every 2 seconds, the old page
+    events  hold GET /payment/events/<id> open and reconnect 2 seconds
+            after each stream ends (PAYMENT_EVENTS_TIMEOUT); on 503 (the
+            worker's streams are all taken) poll with the page's backoff
+
+Each phase runs for --duration seconds on fresh checkouts, none of which
+settle, so it is the steady cost of waiting. It prints the CPU seconds
+per second used by the gunicorn master and workers (from /proc, so
+Linux only), MongoDB operations per second from serverStatus opcounters,
+and what the clients did. Needs gunicorn and a few thousand file
+descriptors; the soft limit is raised to the hard limit.
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/bench python benchmarks/bench_payment_events.py --clients 2000
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import socket
+import asyncio
+import argparse
+import resource
+import subprocess
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from flask import Flask
+
+import models
+
+# The app gunicorn loads in each worker
+APP = 'bench_payment_events:create_app()'
+
+
+def create_app():
+    app = Flask(__name__)
+    app.secret_key = 'bench'
+    app.config['MONGO_URI'] = os.environ['BENCH_MONGO_URI']
+    models.init_mongo(app)
+    with app.app_context():
+        from payment import payment_bp
+    app.register_blueprint(payment_bp)
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, port):
+    if args.max_streams is not None:
+        os.environ['PAYMENT_EVENTS_MAX_STREAMS'] = str(args.max_streams)
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH')])),
+               PAYMENT_EVENTS_ENABLED='true', GUNICORN_THREADS=str(args.threads),
+               MONGO_FALLBACK_TO_MEMORY='false', ARCHIVE_INTERVAL='0', USER_SNAPSHOT_INTERVAL='0')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '-k', 'gthread', '--threads', str(args.threads),
+         '--keep-alive', '5', '-b', f'127.0.0.1:{port}', '--log-level', 'warning', APP],
+        env=env
+    )
+    for _ in range(300):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("gunicorn did not start")
+
+
+def cpu_seconds(master_pid):
+    """utime + stime of the gunicorn master and its workers"""
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # fields[1] is ppid, fields[11:13] utime and stime
+        if int(pid) == master_pid or int(fields[1]) == master_pid:
+            total += int(fields[11]) + int(fields[12])
+    return total / ticks
+
+
+def mongo_ops(db):
+    counters = db.command('serverStatus')['opcounters']
+    return sum(counters[k] for k in ('query', 'getmore', 'command', 'insert', 'update', 'delete'))
+
+
+async def read_head(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return int(status_line.split()[1]), headers
+
+
+class Client:
+    def __init__(self, port, checkout_id, stop_at, counts):
+        self.port = port
+        self.checkout_id = checkout_id
+        self.stop_at = stop_at
+        self.counts = counts
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.close()
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def get(self, path):
+        reused = self.writer is not None
+        if not reused:
+            await self.connect()
+        try:
+            self.writer.write(f"GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+            await self.writer.drain()
+            return await read_head(self.reader)
+        except (OSError, asyncio.IncompleteReadError):
+            if not reused:
+                raise
+        # The server closed the idle keep-alive connection; browsers retry on a new one
+        await self.connect()
+        return await self.get(path)
+
+    async def poll(self, interval, backoff=False):
+        loop = asyncio.get_running_loop()
+        delay = interval
+        while loop.time() < self.stop_at:
+            try:
+                status, headers = await self.get(f"/payment/check/{self.checkout_id}")
+                await self.reader.readexactly(int(headers.get('content-length', 0)))
+                self.counts['polls'] += 1
+                if headers.get('connection', '').lower() == 'close':
+                    self.close()
+            except (OSError, asyncio.IncompleteReadError):
+                self.counts['errors'] += 1
+                self.close()
+            await asyncio.sleep(min(delay * random.uniform(0.8, 1.2), max(0.0, self.stop_at - loop.time())))
+            if backoff:
+                delay = min(delay * 1.5, 15.0)
+
+    async def follow_events(self):
+        loop = asyncio.get_running_loop()
+        while loop.time() < self.stop_at:
+            try:
+                status, headers = await asyncio.wait_for(self.get(f"/payment/events/{self.checkout_id}"),
+                                                         self.stop_at - loop.time())
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                self.counts['errors'] += 1
+                self.close()
+                return
+            if status != 200:
+                await self.reader.readexactly(int(headers.get('content-length', 0)))
+                self.counts['fell_back'] += 1
+                return await self.poll(2.0, backoff=True)
+            self.counts['streams'] += 1
+            try:
+                # Chunked: read chunks until the stream or the phase ends
+                while loop.time() < self.stop_at:
+                    size = await asyncio.wait_for(self.reader.readline(), self.stop_at - loop.time())
+                    if not size or int(size.strip() or b'0', 16) == 0:
+                        break
+                    chunk = await self.reader.readexactly(int(size.strip(), 16) + 2)
+                    if b'event:' in chunk:
+                        self.counts['events'] += 1
+                    elif chunk.startswith(b':'):
+                        self.counts['heartbeats'] += 1
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+                pass
+            self.close()
+            # As EventSource does after the retry delay
+            await asyncio.sleep(min(2.0, max(0.0, self.stop_at - loop.time())))
+
+
+async def run_clients(port, checkout_ids, mode, duration, ramp):
+    loop = asyncio.get_running_loop()
+    stop_at = loop.time() + duration
+    counts = {"polls": 0, "streams": 0, "fell_back": 0, "events": 0, "heartbeats": 0, "errors": 0}
+
+    async def one(i, checkout_id):
+        # Pages open over the ramp, not all in the same millisecond
+        await asyncio.sleep(ramp * i / len(checkout_ids))
+        client = Client(port, checkout_id, stop_at, counts)
+        if mode == 'poll':
+            await client.poll(2.0)
+        else:
+            await client.follow_events()
+        client.close()
+
+    await asyncio.gather(*(one(i, c) for i, c in enumerate(checkout_ids)))
+    return counts
+
+
+def seed(clients):
+    run = uuid.uuid4().hex[:8]
+    checkout_ids = [f"ws_CO_events_{run}_{i}" for i in range(clients)]
+    models.get_db().transactions.insert_many([{
+        '_id': checkout_id,
+        'checkout_id': checkout_id,
+        'username': 'eventsbench',
+        'amount': 20,
+        'phone': '0712345678',
+        'subscription_type': 'basic',
+        'timestamp': datetime.now(),
+        'status': 'pending'
+    } for checkout_id in checkout_ids])
+    return checkout_ids
+
+
+def main(args):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    os.environ.setdefault('MONGO_DBNAME', 'lipia')
+    client = models.create_mongo_client(models.resolve_mongo_uri(os.environ['BENCH_MONGO_URI']))
+    models._set_client(client)
+    db = models.get_db()
+
+    port = free_port()
+    server = start_server(args, port)
+    try:
+        for mode in ('poll', 'events'):
+            checkout_ids = seed(args.clients)
+            cpu_before, ops_before, started = cpu_seconds(server.pid), mongo_ops(db), time.monotonic()
+            counts = asyncio.run(run_clients(port, checkout_ids, mode, args.duration, args.ramp))
+            elapsed = time.monotonic() - started
+            cpu = (cpu_seconds(server.pid) - cpu_before) / elapsed
+            qps = (mongo_ops(db) - ops_before) / elapsed
+            print(f"{mode:>6}: server cpu {cpu:5.2f} s/s  mongo {qps:7.1f} ops/s  {counts}")
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=9)
+    parser.add_argument('--threads', type=int, default=256)
+    parser.add_argument('--max-streams', type=int, default=None, help='PAYMENT_EVENTS_MAX_STREAMS (default: the cap for --threads)')
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--ramp', type=float, default=5.0, help='seconds over which the clients arrive')
+    main(parser.parse_args())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Bytes-on-wire and latency of get_user with and without projection presets.
+
+Seeds a synthetic users collection whose documents carry the extra weight
+real ones accumulate (api_keys, history fields), then reads random users
+through models.get_user with the full document and with each preset.
+Reply sizes are captured with a pymongo command listener.
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/bench python benchmarks/bench_projections.py
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bson
+from pymongo import MongoClient, monitoring
+
+import models
+
+
+class ReplySizeListener(monitoring.CommandListener):
+    def __init__(self):
+        self.reply_bytes = 0
+        self.replies = 0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if event.command_name == 'find':
+            self.reply_bytes += len(bson.encode(event.reply))
+            self.replies += 1
+
+    def failed(self, event):
+        pass
+
+
+def seed(db, users):
+    db.users.delete_many({"username": {"$regex": "^projbench"}})
+    docs = []
+    for i in range(users):
+        docs.append({
+            "username": f"projbench{i}",
+            "pin": "1234",
+            "words_remaining": i,
+            "phone_number": "0712345678",
+            "plan": "Basic",
+            "payment_status": "Paid",
+            "created_at": models.datetime.now(),
+            "api_keys": {"gpt_zero": "k" * 64, "originality": "k" * 64},
+            "preferences": {"theme": "dark", "language": "en", "notes": "x" * 512},
+            "history": [{"words": 100, "at": models.datetime.now()} for _ in range(20)]
+        })
+    db.users.insert_many(docs)
+    db.users.create_index("username", unique=True)
+
+
+def main(users, reads):
+    listener = ReplySizeListener()
+    uri = os.environ['BENCH_MONGO_URI']
+    client = MongoClient(uri, event_listeners=[listener], **models.MONGO_POOL_OPTIONS)
+    seed(client.get_database(), users)
+    models._set_client(client)
+    models.mongo_connected = True
+    models.USER_CACHE_ENABLED = False
+
+    rng = random.Random(7)
+    for projection in (None,) + tuple(models.USER_PROJECTIONS):
+        listener.reply_bytes = listener.replies = 0
+        latencies = []
+        for _ in range(reads):
+            username = f"projbench{rng.randrange(users)}"
+            t0 = time.perf_counter()
+            models.get_user(username, projection)
+            latencies.append(time.perf_counter() - t0)
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(f"{projection or 'full':>8}: {listener.reply_bytes / max(1, listener.replies):>7.0f} bytes/reply  "
+              f"p50={statistics.median(latencies) * 1000:.3f}ms  p99={p99 * 1000:.3f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--reads', type=int, default=5000)
+    args = parser.parse_args()
+    main(args.users, args.reads)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Callbacks per second: the old per-step callback sequence vs settle_payment.
+
+Seeds --payments pending payments (transaction + payment record) and
+settles each one, first with the sequence /payment/callback used to run
+(get_transaction, update_transaction_status, record_payment, update_user,
+update_word_count), then with models.settle_payment. Prints throughput,
+latency percentiles and the MongoDB commands issued per callback.
+
+Run against a local replica set to exercise the transactional path, e.g.
+mongod --replSet rs0 then rs.initiate():
+
+    BENCH_MONGO_URI="mongodb://localhost:27017/bench?replicaSet=rs0" python benchmarks/bench_settlement.py
+
+Without BENCH_MONGO_URI it measures the fallback store.
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import statistics
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from pymongo import MongoClient, monitoring
+
+import models
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = 0
+
+    def started(self, event):
+        self.commands += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def build_app():
+    app = Flask(__name__)
+    mongo_uri = os.environ.get('BENCH_MONGO_URI')
+    if mongo_uri:
+        app.config['MONGO_URI'] = mongo_uri
+        os.environ['MONGO_FALLBACK_TO_MEMORY'] = 'false'
+        models.init_mongo(app)
+    return app
+
+
+def seed(username, payments):
+    checkout_ids = []
+    for _ in range(payments):
+        checkout_id = f"settlebench-{uuid.uuid4()}"
+        models.save_transaction(checkout_id, {
+            'checkout_id': checkout_id,
+            'username': username,
+            'amount': 20,
+            'phone': '0712345678',
+            'subscription_type': 'basic',
+            'timestamp': datetime.now(),
+            'status': 'pending'
+        })
+        models.record_payment(username, 20, 'basic', 'pending', 'N/A', checkout_id)
+        checkout_ids.append(checkout_id)
+    return checkout_ids
+
+
+def legacy_settle(checkout_id, reference):
+    """The callback sequence before settle_payment"""
+    transaction = models.get_transaction(checkout_id)
+    models.update_transaction_status(checkout_id, 'completed', reference)
+    username = transaction['username']
+    models.record_payment(username, transaction['amount'], transaction['subscription_type'], 'completed', reference, checkout_id)
+    models.update_user(username, {'payment_status': 'Paid'})
+    return models.update_word_count(username, models.subscription_words(transaction['subscription_type']))
+
+
+def settle(checkout_id, reference):
+    return models.settle_payment(checkout_id, reference)
+
+
+def measure(label, fn, checkout_ids, counter):
+    latencies = []
+    commands_before = counter.commands if counter else 0
+    started = time.perf_counter()
+    for i, checkout_id in enumerate(checkout_ids):
+        t0 = time.perf_counter()
+        fn(checkout_id, f"REF{i}")
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    commands = (counter.commands - commands_before) / len(checkout_ids) if counter else float('nan')
+    print(f"{label:>14}: {len(checkout_ids) / elapsed:>7.0f} callbacks/s  "
+          f"p50={statistics.median(latencies) * 1000:.2f}ms  p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f}ms  "
+          f"commands/callback={commands:.1f}")
+
+
+def main(payments):
+    counter = None
+    build_app()
+    if models.mongo_connected:
+        # Swap in a client that counts the commands each callback issues
+        counter = CommandCounter()
+        models._set_client(MongoClient(models.resolve_mongo_uri(os.environ['BENCH_MONGO_URI']),
+                                       event_listeners=[counter], **models.MONGO_POOL_OPTIONS))
+        print(f"transactions: {'yes' if models.get_db().supports_transactions and models.SETTLE_WITH_TRANSACTION else 'no'}")
+
+    username = f"settlebench-{int(time.time())}"
+    models.create_user(username, '1234', '0712345678')
+
+    measure("legacy", legacy_settle, seed(username, payments), counter)
+    measure("settle_payment", settle, seed(username, payments), counter)
+
+    expected = 2 * payments * models.subscription_words('basic')
+    balance = models.get_user(username, 'balance')['words_remaining']
+    print(f"final balance {balance}, expected {expected}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--payments', type=int, default=2000)
+    args = parser.parse_args()
+    main(args.payments)
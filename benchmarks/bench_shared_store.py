@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the shared SQLite fallback store.
+
+Starts N worker processes against one fallback database, the way gunicorn's
+workers share it during an outage, and runs a read-heavy mix (user lookups,
+transaction lookups) plus writes (word debits, transaction upserts) for a
+fixed duration. Also checks that no debit was lost or double-applied across
+processes.
+
+    python benchmarks/bench_shared_store.py --workers 1 4 9 --seconds 5
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from store import SQLiteFallbackDB, SQLiteUserStore, SQLiteTransactionStore
+
+USERS = 1000
+TRANSACTIONS = 10000
+BALANCE = 1000000
+
+
+def seed(path):
+    db = SQLiteFallbackDB(path)
+    users, transactions = SQLiteUserStore(db), SQLiteTransactionStore(db)
+    for i in range(USERS):
+        users.put(f"user{i}", {"password": "1234", "plan": "Basic", "words_remaining": BALANCE,
+                               "phone_number": "0712345678", "payment_status": "Paid"})
+    for i in range(TRANSACTIONS):
+        transactions.upsert(f"ws_CO_{i}", {"user_id": f"user{i % USERS}", "amount": 20,
+                                           "status": "pending", "subscription_type": "basic"})
+
+
+def worker(path, seconds, write_ratio, results):
+    db = SQLiteFallbackDB(path)
+    users, transactions = SQLiteUserStore(db), SQLiteTransactionStore(db)
+    rng = random.Random(os.getpid())
+    reads = writes = debited = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        if rng.random() < write_ratio:
+            if rng.random() < 0.5:
+                ok, _ = users.consume_words(f"user{rng.randrange(USERS)}", 1)
+                debited += ok
+            else:
+                transactions.update(f"ws_CO_{rng.randrange(TRANSACTIONS)}", {"status": "completed"})
+            writes += 1
+        else:
+            if rng.random() < 0.5:
+                users.get(f"user{rng.randrange(USERS)}")
+            else:
+                transactions.get(f"ws_CO_{rng.randrange(TRANSACTIONS)}")
+            reads += 1
+    results.put((reads, writes, debited))
+
+
+def run(workers, seconds, write_ratio):
+    base = tempfile.mkdtemp(prefix='shared-store-bench-')
+    path = os.path.join(base, 'fallback_store.db')
+    try:
+        seed(path)
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=worker, args=(path, seconds, write_ratio, results))
+                 for _ in range(workers)]
+        for p in procs:
+            p.start()
+        totals = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+
+        reads = sum(t[0] for t in totals)
+        writes = sum(t[1] for t in totals)
+        debited = sum(t[2] for t in totals)
+        users = SQLiteUserStore(SQLiteFallbackDB(path))
+        remaining = sum(users.get(f"user{i}")["words_remaining"] for i in range(USERS))
+        lost = USERS * BALANCE - debited - remaining
+        print(f"workers={workers:<3} reads/s={reads / seconds:>9.0f} writes/s={writes / seconds:>8.0f} "
+              f"total ops/s={(reads + writes) / seconds:>9.0f} debit drift={lost}")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 9])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    args = parser.parse_args()
+    for n in args.workers:
+        run(n, args.seconds, args.write_ratio)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+MongoDB QPS of --pollers concurrent /payment/check pollers, with and without single-flight.
+
+Seeds --checkouts pending checkouts and starts --pollers threads, spread
+evenly over them (500 pollers on 50 checkouts is 10 tabs per checkout).
+Each poller requests /payment/check/<id> every --interval seconds, the
+way payment_waiting.html does. The tabs of one checkout start within
+--spread seconds of each other, like tabs opened or reloaded together.
+It runs for --duration seconds with models.SINGLE_FLIGHT_ENABLED off,
+then on, and prints requests/s, MongoDB commands/s and the collapsed
+lookup counters.
+
+Collapsing needs lookups to overlap, so the saving grows with read
+latency: compare a local mongod with one a network hop away.
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/bench python benchmarks/bench_single_flight.py --pollers 500
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from pymongo import monitoring
+
+import models
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def started(self, event):
+        with self.lock:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def build_app():
+    app = Flask(__name__)
+    app.secret_key = 'bench'
+    app.config['MONGO_URI'] = os.environ['BENCH_MONGO_URI']
+    os.environ['MONGO_FALLBACK_TO_MEMORY'] = 'false'
+    # Every poll looks the checkout up, as the single-flight is what is measured
+    os.environ['STATUS_CACHE_TTL'] = '0'
+    models.ARCHIVE_INTERVAL = 0
+    models.USER_SNAPSHOT_INTERVAL = 0
+    models.init_mongo(app)
+    with app.app_context():
+        from payment import payment_bp, ACTIVE_TRANSACTIONS
+    app.register_blueprint(payment_bp)
+    return app, ACTIVE_TRANSACTIONS
+
+
+def poller(app, checkout_id, delay, interval, deadline, latencies):
+    client = app.test_client()
+    time.sleep(delay)
+    while time.monotonic() < deadline:
+        t0 = time.perf_counter()
+        client.get(f"/payment/check/{checkout_id}")
+        latencies.append(time.perf_counter() - t0)
+        time.sleep(max(0.0, interval - (time.perf_counter() - t0)))
+
+
+def run(app, checkout_ids, pollers, interval, spread, duration, counter):
+    rng = random.Random(5)
+    phases = {checkout_id: rng.uniform(0, interval) for checkout_id in checkout_ids}
+    latencies = []
+    deadline = time.monotonic() + duration
+    threads = []
+    for i in range(pollers):
+        checkout_id = checkout_ids[i % len(checkout_ids)]
+        delay = phases[checkout_id] + rng.uniform(0, spread)
+        threads.append(threading.Thread(target=poller, args=(app, checkout_id, delay, interval, deadline, latencies)))
+    before = counter.count
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    return len(latencies) / elapsed, (counter.count - before) / elapsed, latencies
+
+
+def main(args):
+    # Registered before init_mongo creates the client, so every command is counted
+    counter = CommandCounter()
+    monitoring.register(counter)
+    app, active = build_app()
+
+    checkout_ids = [f"ws_CO_flightbench_{i}" for i in range(args.checkouts)]
+    for checkout_id in checkout_ids:
+        if not models.get_transaction(checkout_id):
+            models.save_transaction(checkout_id, {
+                'checkout_id': checkout_id,
+                'username': 'flightbench',
+                'amount': 20,
+                'phone': '0712345678',
+                'subscription_type': 'basic',
+                'status': 'pending'
+            })
+
+    for enabled in (False, True):
+        models.SINGLE_FLIGHT_ENABLED = enabled
+        models.lookups.calls = models.lookups.collapsed = 0
+        for checkout_id in checkout_ids:
+            active.pop(checkout_id, None)
+        rps, qps, latencies = run(app, checkout_ids, args.pollers, args.interval, args.spread, args.duration, counter)
+        latencies.sort()
+        stats = models.get_single_flight_stats()
+        print(f"single-flight {'on ' if enabled else 'off'}: {rps:>6.0f} req/s  {qps:>6.0f} mongo cmds/s  "
+              f"p50={statistics.median(latencies) * 1000:.2f}ms  p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f}ms  "
+              f"calls={stats['calls']} collapsed={stats['collapsed']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pollers', type=int, default=500)
+    parser.add_argument('--checkouts', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=2.0)
+    parser.add_argument('--spread', type=float, default=0.05)
+    parser.add_argument('--duration', type=float, default=20.0)
+    main(parser.parse_args())
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Callback-to-page latency and /payment/check cache hit rate across gunicorn workers, with and without the status bus.
+
+Runs the payment blueprint under gunicorn (-w --workers, threaded) on the
+BENCH_MONGO_URI database, with the STK push going to a local fake Lipia
+API that accepts it at once and never calls back. --checkouts paid
+checkouts are created through /payment/initiate, and their waiting pages
+are simulated, half of them each way:
+
+    events  a /payment/events stream, reopened 2 seconds after it ends
+            (PAYMENT_EVENTS_TIMEOUT) until it sees the settlement
+    poll    GET /payment/check every --interval seconds
+
+Every request is on a new connection, so it lands on whichever worker
+accepts it, as it does behind a load balancer. For the first half of
+--duration nothing settles, and MongoDB queries per poll (from
+serverStatus opcounters; stream opens count too) give the share of
+polls answered from the worker's status cache. In the second half every
+checkout is settled at a random moment by a POST to /payment/callback,
+and the time from that POST to the stream's event and to the first poll
+that sees it is recorded.
+
+The run is repeated with STATUS_BUS_ENABLED on and off. Without the bus
+a stream on another worker learns of the settlement at its next
+heartbeat (PAYMENT_EVENTS_HEARTBEAT, 10s by default) or when it reconnects.
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/bench python benchmarks/bench_status_bus.py --workers 9
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import statistics
+import subprocess
+from urllib.parse import urlsplit
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCHMARKS)
+
+import models
+from bench_payment_events import APP, free_port, read_head
+from bench_stk_dispatch import start_fake_lipia
+
+
+def start_server(args, port, bus, lipia_url, bus_dir):
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT, BENCHMARKS, os.environ.get('PYTHONPATH')])),
+               STATUS_BUS_ENABLED='true' if bus else 'false', STATUS_BUS_DIR=bus_dir,
+               LIPIA_API_URL=lipia_url, PAYMENT_EVENTS_ENABLED='true', GUNICORN_THREADS=str(args.threads),
+               PAYMENT_EVENTS_MAX_STREAMS=str(args.checkouts),
+               MONGO_FALLBACK_TO_MEMORY='false', ARCHIVE_INTERVAL='0', USER_SNAPSHOT_INTERVAL='0')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '-k', 'gthread', '--threads', str(args.threads),
+         '-b', f'127.0.0.1:{port}', '--log-level', 'warning', APP],
+        env=env
+    )
+    for _ in range(300):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("gunicorn did not start")
+
+
+def query_ops(db):
+    return db.command('serverStatus')['opcounters']['query']
+
+
+async def request(port, method, path, body=b''):
+    """One request on a new connection, returns (status, headers, body)"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(f"{method} {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        status, headers = await read_head(reader)
+        return status, headers, await reader.read()
+    finally:
+        writer.close()
+
+
+async def initiate(port, username, count):
+    checkout_ids = []
+    for _ in range(count):
+        status, headers, _ = await request(port, 'POST', '/payment/initiate',
+                                           f'{{"username": "{username}", "subscription_type": "basic"}}'.encode())
+        # Redirected to /payment/waiting/<checkout_id>
+        path = urlsplit(headers.get('location', '')).path
+        if status != 302 or not path.startswith('/payment/waiting/'):
+            raise RuntimeError(f"initiate answered {status} {path}")
+        checkout_ids.append(path.rsplit('/', 1)[1])
+    return checkout_ids
+
+
+async def follow(port, checkout_id, settled_at, seen, stop_at):
+    loop = asyncio.get_running_loop()
+    while loop.time() < stop_at:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            writer.write(f"GET /payment/events/{checkout_id} HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+            await writer.drain()
+            status, _ = await read_head(reader)
+            if status != 200:
+                return
+            while loop.time() < stop_at:
+                line = await asyncio.wait_for(reader.readline(), stop_at - loop.time())
+                # A zero-length chunk ends the stream
+                if not line or line == b'0\r\n':
+                    break
+                if b'"completed"' in line and checkout_id in settled_at:
+                    seen[checkout_id] = time.monotonic() - settled_at[checkout_id]
+                    return
+        except (OSError, asyncio.TimeoutError):
+            return
+        finally:
+            writer.close()
+        # As EventSource does after the retry delay
+        await asyncio.sleep(min(2.0, max(0.0, stop_at - loop.time())))
+
+
+async def poll(port, checkout_id, interval, settled_at, seen, counts, stop_at):
+    loop = asyncio.get_running_loop()
+    await asyncio.sleep(random.uniform(0, interval))
+    while loop.time() < stop_at:
+        try:
+            _, _, body = await request(port, 'GET', f'/payment/check/{checkout_id}')
+            counts['polls'] += 1
+            if b'"completed"' in body and checkout_id in settled_at:
+                seen[checkout_id] = time.monotonic() - settled_at[checkout_id]
+                return
+        except OSError:
+            counts['errors'] += 1
+        await asyncio.sleep(interval)
+
+
+async def settle(port, checkout_id, delay, settled_at):
+    await asyncio.sleep(delay)
+    settled_at[checkout_id] = time.monotonic()
+    await request(port, 'POST', f'/payment/callback?checkout_id={checkout_id}',
+                  f'{{"reference": "BUS-{checkout_id[4:12]}"}}'.encode())
+
+
+async def run_phase(port, db, checkout_ids, args):
+    loop = asyncio.get_running_loop()
+    stop_at = loop.time() + args.duration
+    half = args.duration / 2
+    settled_at, streamed, polled = {}, {}, {}
+    counts = {'polls': 0, 'errors': 0}
+    tasks = [asyncio.ensure_future(follow(port, c, settled_at, streamed, stop_at)) for c in checkout_ids[::2]]
+    tasks += [asyncio.ensure_future(poll(port, c, args.interval, settled_at, polled, counts, stop_at))
+              for c in checkout_ids[1::2]]
+
+    # Waiting: nothing settles
+    queries, polls = query_ops(db), counts['polls']
+    await asyncio.sleep(half)
+    waiting = (query_ops(db) - queries) / max(1, counts['polls'] - polls)
+
+    # Settling, each at a random moment of the first half of what is left
+    tasks += [asyncio.ensure_future(settle(port, c, random.uniform(0, half / 2), settled_at)) for c in checkout_ids]
+    await asyncio.gather(*tasks)
+    return waiting, streamed, polled, counts
+
+
+def latency(label, seen, total):
+    if not seen:
+        return f"{label} none seen"
+    values = sorted(seen.values())
+    return (f"{label} p50={statistics.median(values) * 1000:7.1f}ms p99={values[max(0, int(len(values) * 0.99) - 1)] * 1000:7.1f}ms"
+            f" ({len(values)}/{total} seen)")
+
+
+def main(args):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    os.environ.setdefault('MONGO_DBNAME', 'lipia')
+    client = models.create_mongo_client(models.resolve_mongo_uri(os.environ['BENCH_MONGO_URI']))
+    models._set_client(client)
+    db = models.get_db()
+    username = f"busbench_{uuid.uuid4().hex[:8]}"
+    models.create_user(username, '1234', '0712345678')
+    lipia_url = start_fake_lipia(0.0)
+
+    for bus in (True, False):
+        port = free_port()
+        with tempfile.TemporaryDirectory() as bus_dir:
+            server = start_server(args, port, bus, lipia_url, bus_dir)
+            try:
+                checkout_ids = asyncio.run(initiate(port, username, args.checkouts))
+                waiting, streamed, polled, counts = asyncio.run(run_phase(port, db, checkout_ids, args))
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+        print(f"bus {'on ' if bus else 'off'}: {counts['polls']} polls, {waiting:.2f} queries per poll while waiting "
+              f"(hit rate {max(0.0, 1 - waiting):.0%}), {counts['errors']} errors")
+        print(f"        {latency('events', streamed, len(checkout_ids[::2]))}")
+        print(f"        {latency('polls ', polled, len(checkout_ids[1::2]))}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=9)
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--checkouts', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between polls')
+    parser.add_argument('--duration', type=float, default=40.0)
+    main(parser.parse_args())
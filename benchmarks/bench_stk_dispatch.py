@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Checkouts per second of one sync worker against a slow payment API, inline vs dispatched STK pushes.
+
+Starts a local fake Lipia API whose /request/stk answers after --latency
+seconds (default 5) and points the payment adapter at it. One client
+thread then posts paid-plan checkouts to /payment/initiate back to back
+for --duration seconds, which is what a gunicorn sync worker sees: it
+serves one request at a time. The run is repeated with the STK push sent
+inline (STK_DISPATCH_ENABLED off, the old behaviour) and handed to the
+dispatcher, and prints checkouts/s, endpoint latency, how many went to
+the waiting page or were shed because the dispatch queue was full, and
+the peak number of concurrent requests the fake API saw.
+
+After the dispatched run the queue is drained: pushes still queued past
+their deadline expire instead of being sent.
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/bench python benchmarks/bench_stk_dispatch.py --latency 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import statistics
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+import models
+from dispatch import Dispatcher
+
+
+class FakeLipia(BaseHTTPRequestHandler):
+    latency = 5.0
+    lock = threading.Lock()
+    received = 0
+    concurrent = 0
+    peak = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        cls = type(self)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with cls.lock:
+            cls.received += 1
+            cls.concurrent += 1
+            cls.peak = max(cls.peak, cls.concurrent)
+            n = cls.received
+        try:
+            time.sleep(cls.latency)
+            body = json.dumps({"message": "STK push sent", "data": {"CheckoutRequestID": f"ws_CO_fake_{n}"}}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with cls.lock:
+                cls.concurrent -= 1
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.received = cls.peak = 0
+
+
+def start_fake_lipia(latency):
+    FakeLipia.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeLipia)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def build_app():
+    app = Flask(__name__)
+    app.secret_key = 'bench'
+    app.config['MONGO_URI'] = os.environ['BENCH_MONGO_URI']
+    os.environ['MONGO_FALLBACK_TO_MEMORY'] = 'false'
+    models.ARCHIVE_INTERVAL = 0
+    models.USER_SNAPSHOT_INTERVAL = 0
+    models.init_mongo(app)
+    with app.app_context():
+        import payment
+    app.register_blueprint(payment.payment_bp)
+    return app, payment
+
+
+def run(app, username, duration):
+    client = app.test_client()
+    latencies = []
+    outcomes = {"waiting": 0, "busy": 0, "other": 0}
+    deadline = time.monotonic() + duration
+    started = time.monotonic()
+    while time.monotonic() < deadline:
+        t0 = time.perf_counter()
+        response = client.post('/payment/initiate', json={"username": username, "subscription_type": "Basic"})
+        latencies.append(time.perf_counter() - t0)
+        location = response.headers.get('Location', '')
+        if '/payment/waiting/' in location:
+            outcomes["waiting"] += 1
+        elif location.rstrip('/').endswith('/payment'):
+            outcomes["busy"] += 1
+        else:
+            outcomes["other"] += 1
+    return len(latencies) / (time.monotonic() - started), latencies, outcomes
+
+
+def main(args):
+    app, payment = build_app()
+    payment.payment_adapter.config['api_base_url'] = start_fake_lipia(args.latency)
+    payment.STK_DISPATCH_DEADLINE = args.deadline
+    username = 'stkbench'
+    if not models.user_exists(username):
+        models.create_user(username, '1234', '0712345678')
+
+    for enabled in (False, True):
+        payment.STK_DISPATCH_ENABLED = enabled
+        payment.stk_dispatcher = Dispatcher(workers=args.workers, max_queued=args.queue, name='stk')
+        FakeLipia.reset()
+        rps, latencies, outcomes = run(app, username, args.duration)
+        latencies.sort()
+        print(f"{'dispatched' if enabled else 'inline    '}: {rps:>8.2f} checkouts/s  "
+              f"p50={statistics.median(latencies) * 1000:.1f}ms  p99={latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000:.1f}ms  "
+              f"waiting={outcomes['waiting']} busy={outcomes['busy']} other={outcomes['other']}  "
+              f"api peak concurrency={FakeLipia.peak}")
+        if enabled:
+            drain_started = time.monotonic()
+            payment.stk_dispatcher.shutdown(timeout=args.deadline + args.latency + 5)
+            stats = payment.stk_dispatcher.stats()
+            print(f"  drained in {time.monotonic() - drain_started:.1f}s: sent={FakeLipia.received} "
+                  f"completed={stats['completed']} expired={stats['expired']} failed={stats['failed']} "
+                  f"max queue wait={stats['max_wait']:.1f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=5.0, help='seconds the fake API takes per STK push')
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--workers', type=int, default=8, help='dispatcher threads')
+    parser.add_argument('--queue', type=int, default=200, help='dispatcher queue limit')
+    parser.add_argument('--deadline', type=float, default=30.0, help='STK_DISPATCH_DEADLINE')
+    main(parser.parse_args())
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the login + dashboard path with and without the user cache.
+
+Each simulated session logs in via /api/login and then loads /api/user
+--views times, the way the dashboard polls the balance. Runs once with
+models.USER_CACHE_ENABLED off and once on, and prints throughput,
+latency percentiles and cache hit/miss counters.
+
+Requires a MongoDB to talk to:
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/bench python benchmarks/bench_user_cache.py
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+import models
+from auth import auth_bp
+
+
+def build_app():
+    app = Flask(__name__)
+    app.secret_key = 'bench'
+    app.register_blueprint(auth_bp)
+    app.config['MONGO_URI'] = os.environ['BENCH_MONGO_URI']
+    os.environ['MONGO_FALLBACK_TO_MEMORY'] = 'false'
+    models.init_mongo(app)
+    return app
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_sessions(app, usernames, sessions, views):
+    client = app.test_client()
+    rng = random.Random(42)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(sessions):
+        username = rng.choice(usernames)
+        t0 = time.perf_counter()
+        client.post('/api/login', json={'username': username, 'pin': '1234'})
+        latencies.append(time.perf_counter() - t0)
+        for _ in range(views):
+            t0 = time.perf_counter()
+            client.get('/api/user')
+            latencies.append(time.perf_counter() - t0)
+    return time.perf_counter() - started, latencies
+
+
+def main(users, sessions, views):
+    app = build_app()
+    usernames = [f"cachebench{i}" for i in range(users)]
+    for username in usernames:
+        if not models.user_exists(username):
+            models.create_user(username, '1234', '0712345678')
+
+    for enabled in (False, True):
+        models.USER_CACHE_ENABLED = enabled
+        models.user_cache.clear()
+        models.user_cache.hits = models.user_cache.misses = 0
+        elapsed, latencies = run_sessions(app, usernames, sessions, views)
+        stats = models.get_user_cache_stats()
+        print(f"cache {'on ' if enabled else 'off'}: {len(latencies) / elapsed:>7.0f} req/s  "
+              f"p50={statistics.median(latencies) * 1000:.2f}ms  p99={percentile(latencies, 99) * 1000:.2f}ms  "
+              f"hits={stats['hits']} misses={stats['misses']} hit_rate={stats['hit_rate']:.2%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=2000)
+    parser.add_argument('--views', type=int, default=5, help='dashboard loads per login')
+    args = parser.parse_args()
+    main(args.users, args.sessions, args.views)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Users snapshot: build time, load time, lookup latency and RSS for --users users.
+
+Writes a snapshot of synthetic users with snapshot.write (the part of
+snapshot.build after the MongoDB cursor), maps it, looks up random users
+and reports the process RSS split into anonymous and file-backed pages.
+File-backed pages are the page cache shared by every worker. For
+comparison it then loads the same users into a dict, the way a fallback
+store would hold them (synthetic users only).
+
+With BENCH_MONGO_URI set it times snapshot.build against the users
+collection there instead of synthetic users.
+
+    python benchmarks/bench_user_snapshot.py --users 1000000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snapshot
+
+
+def rss():
+    """(anonymous, file-backed) resident MB of this process"""
+    fields = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            fields[name] = value.strip()
+    return int(fields['RssAnon'].split()[0]) / 1024, int(fields['RssFile'].split()[0]) / 1024
+
+
+def synthetic_users(count):
+    for i in range(count):
+        yield {
+            "username": f"user{i:09d}",
+            "pin": f"{i % 10000:04d}",
+            "phone_number": f"07{i % 100000000:08d}",
+            "plan": "Basic",
+            "payment_status": "Paid",
+            "words_remaining": i % 5000
+        }
+
+
+def main(users, lookups):
+    path = os.path.join(tempfile.mkdtemp(), 'users_snapshot.bin')
+    anon, file_backed = rss()
+    print(f"baseline RSS: anon {anon:.0f}MB, file {file_backed:.0f}MB")
+
+    started = time.perf_counter()
+    if os.environ.get('BENCH_MONGO_URI'):
+        from pymongo import MongoClient
+        written, skipped = snapshot.build(MongoClient(os.environ['BENCH_MONGO_URI']).get_database(), path)
+    else:
+        written, skipped = snapshot.write(path, synthetic_users(users))
+    print(f"build: {written} users ({skipped} skipped) in {time.perf_counter() - started:.2f}s, "
+          f"{os.path.getsize(path) / 1048576:.0f}MB on disk")
+
+    users_snapshot = snapshot.UserSnapshot(path)
+    started = time.perf_counter()
+    count = len(users_snapshot)
+    print(f"load: {(time.perf_counter() - started) * 1000:.3f}ms (maps {count} users)")
+
+    rng = random.Random(7)
+    latencies = []
+    found = 0
+    for _ in range(lookups):
+        username = f"user{rng.randrange(count):09d}"
+        t0 = time.perf_counter()
+        found += users_snapshot.get(username) is not None
+        latencies.append(time.perf_counter() - t0)
+    latencies.sort()
+    anon, file_backed = rss()
+    print(f"lookup: {found}/{lookups} found, p50={statistics.median(latencies) * 1e6:.1f}us "
+          f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1e6:.1f}us")
+    print(f"RSS after {lookups} lookups: anon {anon:.0f}MB, file {file_backed:.0f}MB")
+
+    if not os.environ.get('BENCH_MONGO_URI'):
+        started = time.perf_counter()
+        as_dict = {user["username"]: user for user in synthetic_users(count)}
+        anon, file_backed = rss()
+        print(f"same {len(as_dict)} users in a dict: {time.perf_counter() - started:.2f}s, "
+              f"RSS anon {anon:.0f}MB, file {file_backed:.0f}MB")
+    os.unlink(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+    main(args.users, args.lookups)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Debit latency and MongoDB commands per debit, with and without word leases.
+
+Gives --users users a large balance and runs --debits small debits spread
+over them through models.consume_words with the word ledger on, once with
+leases off (one guarded ledger debit per call) and once with leases on
+(debits served from the worker's block). Afterwards it releases the leases and checks each balance
+equals the starting balance minus what was debited.
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/bench python benchmarks/bench_word_leases.py
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from pymongo import MongoClient, monitoring
+
+import models
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = 0
+
+    def started(self, event):
+        self.commands += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def measure(label, usernames, debits, words, counter):
+    rng = random.Random(5)
+    spent = dict.fromkeys(usernames, 0)
+    latencies = []
+    commands_before = counter.commands
+    for _ in range(debits):
+        username = rng.choice(usernames)
+        t0 = time.perf_counter()
+        success, _ = models.consume_words(username, words)
+        latencies.append(time.perf_counter() - t0)
+        if success:
+            spent[username] += words
+    latencies.sort()
+    print(f"{label:>10}: p50={statistics.median(latencies) * 1000:.3f}ms  "
+          f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.3f}ms  "
+          f"commands/debit={(counter.commands - commands_before) / debits:.2f}")
+    return spent
+
+
+def main(users, debits, words, balance):
+    app = Flask(__name__)
+    app.config['MONGO_URI'] = os.environ['BENCH_MONGO_URI']
+    os.environ['MONGO_FALLBACK_TO_MEMORY'] = 'false'
+    # Leases need the ledger
+    models.WORD_LEDGER_ENABLED = True
+    models.init_mongo(app)
+    counter = CommandCounter()
+    models._set_client(MongoClient(models.resolve_mongo_uri(os.environ['BENCH_MONGO_URI']),
+                                   event_listeners=[counter], **models.MONGO_POOL_OPTIONS))
+    models.USER_CACHE_ENABLED = False
+
+    prefix = f"leasebench{int(time.time())}-"
+    usernames = [f"{prefix}{u}" for u in range(users)]
+    for username in usernames:
+        models.create_user(username, '1234', '0712345678')
+        models.update_word_count(username, balance)
+    start = {u: models.get_user(u, 'balance')['words_remaining'] for u in usernames}
+
+    models.WORD_LEASES_ENABLED = False
+    spent_off = measure("leases off", usernames, debits, words, counter)
+    models.WORD_LEASES_ENABLED = True
+    spent_on = measure("leases on", usernames, debits, words, counter)
+    print(f"lease metrics: {models.get_lease_metrics()}")
+
+    models.release_word_leases()
+    models.WORD_LEASES_ENABLED = False
+    wrong = 0
+    for username in usernames:
+        expected = start[username] - spent_off[username] - spent_on[username]
+        if models.get_user(username, 'balance')['words_remaining'] != expected:
+            wrong += 1
+    print(f"balances off after release: {wrong} of {users}")
+    return wrong == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--debits', type=int, default=20000)
+    parser.add_argument('--words', type=int, default=3, help='words per debit')
+    parser.add_argument('--balance', type=int, default=100000)
+    args = parser.parse_args()
+    sys.exit(0 if main(args.users, args.debits, args.words, args.balance) else 1)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Index coverage check: no hot query may do a COLLSCAN.
+
+Drops the app's collections in the BENCH_MONGO_URI database, applies
+indexes.INDEXES, seeds a few thousand documents per collection and
+explains every query in indexes.hot_queries(). Prints the winning plan of
+each one and exits non-zero if any of them scans a whole collection, or
+if apply() reports a conflict.
+
+Point it at a throwaway local mongod, never at a real database:
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/indexcheck python benchmarks/check_index_coverage.py
+"""
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import MongoClient
+
+import indexes
+from indexes import plan_stages
+
+
+def seed(db, rows=5000):
+    now = datetime.now()
+    statuses = ("pending", "completed", "cancelled", "failed")
+    db.users.insert_many([
+        {"username": f"u{i}", "words_remaining": i, "ledger_ops": [f"op{i}"]} for i in range(rows)
+    ])
+    for name in ("payments", "payments_archive"):
+        db[name].insert_many([
+            {
+                "checkout_id": f"{name}-{i}",
+                "username": f"u{i % 100}",
+                "status": statuses[i % 4],
+                "timestamp": now - timedelta(minutes=i)
+            }
+            for i in range(rows)
+        ])
+    for name in ("transactions", "transactions_archive"):
+        db[name].insert_many([
+            {"_id": f"{name}-{i}", "username": f"u{i % 100}", "status": statuses[i % 4], "timestamp": now - timedelta(minutes=i)}
+            for i in range(rows)
+        ])
+    db.word_ledger.insert_many([
+        {"_id": uuid.uuid4().hex, "username": f"u{i % 100}", "delta": 1, "at": now - timedelta(seconds=i), "folded": i % 10 != 0}
+        for i in range(rows)
+    ])
+    db.word_leases.insert_many([
+        {"_id": uuid.uuid4().hex, "username": f"u{i % 100}", "state": ("active", "returning", "returned")[i % 3],
+         "expires_at": now - timedelta(seconds=i), "returning_at": now - timedelta(seconds=i)}
+        for i in range(rows)
+    ])
+
+
+def explain(db, query):
+    if query["distinct"]:
+        return db.command("explain", {"distinct": query["collection"], "key": query["distinct"], "query": query["filter"]})
+    cursor = db[query["collection"]].find(query["filter"])
+    if query["sort"]:
+        cursor = cursor.sort(query["sort"])
+    return cursor.limit(100).explain()
+
+
+def main():
+    db = MongoClient(os.environ['BENCH_MONGO_URI']).get_database()
+    collections = {spec["collection"] for spec in indexes.INDEXES} | {"transactions_archive"}
+    for name in collections:
+        db[name].drop()
+    summary = indexes.apply(db, log=lambda message: None)
+    print(f"applied {len(summary['created'])} indexes, {len(summary['conflicts'])} conflicts")
+    seed(db)
+
+    failures = len(summary['conflicts'])
+    for query in indexes.hot_queries():
+        stages = plan_stages(explain(db, query)['queryPlanner']['winningPlan'])
+        ok = 'COLLSCAN' not in stages
+        failures += not ok
+        print(f"{'PASS' if ok else 'FAIL'} {query['collection']:>20} {query['label']}: {' <- '.join(stages)}")
+    return failures == 0
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
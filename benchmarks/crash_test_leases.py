@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Crash test for word leases: leases left by killed workers are reclaimed.
+
+Forks --workers processes that each take leases on the same --users users,
+serve a random number of debits from them and then die with os._exit or
+SIGKILL, without returning anything. The parent waits out TTL + grace,
+runs reclaim_expired and checks every user's balance is exactly
+start - spent: no word was spent twice, returned after being spent or
+lost with a dead lease. It then checks no active or returning lease is
+left.
+
+    BENCH_MONGO_URI=mongodb://localhost:27017/bench python benchmarks/crash_test_leases.py
+"""
+import os
+import sys
+import time
+import json
+import random
+import signal
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+import models
+from leases import LeaseManager
+
+TTL = 2
+GRACE = 1
+
+
+def connect():
+    app = Flask(__name__)
+    app.config['MONGO_URI'] = os.environ['BENCH_MONGO_URI']
+    os.environ['MONGO_FALLBACK_TO_MEMORY'] = 'false'
+    models.WORD_LEDGER_ENABLED = True
+    models.init_mongo(app)
+    models.USER_CACHE_ENABLED = False
+    models.WORD_LEASES_ENABLED = True
+    models.word_leases = LeaseManager(block=200, ttl=TTL, grace=GRACE)
+
+
+def worker(usernames, seed, write_fd):
+    """Debit in a forked worker, report what was spent, then die holding the leases"""
+    models.init_worker_mongo()
+    rng = random.Random(seed)
+    spent = dict.fromkeys(usernames, 0)
+    for _ in range(rng.randrange(50, 400)):
+        username = rng.choice(usernames)
+        words = rng.randrange(1, 8)
+        success, _ = models.consume_words(username, words)
+        if success:
+            spent[username] += words
+    os.write(write_fd, (json.dumps(spent) + "\n").encode())
+    if seed % 2:
+        os.kill(os.getpid(), signal.SIGKILL)
+    os._exit(0)
+
+
+def main(workers, users, balance):
+    connect()
+    prefix = f"leasecrash{int(time.time())}-"
+    usernames = [f"{prefix}{u}" for u in range(users)]
+    for username in usernames:
+        models.create_user(username, '1234', '0712345678')
+        models.update_word_count(username, balance)
+    start = {u: models.get_user(u, 'balance')['words_remaining'] for u in usernames}
+
+    read_fd, write_fd = os.pipe()
+    pids = []
+    for seed in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            worker(usernames, seed, write_fd)
+        pids.append(pid)
+    os.close(write_fd)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    with os.fdopen(read_fd) as reports:
+        spent = dict.fromkeys(usernames, 0)
+        for line in reports:
+            for username, words in json.loads(line).items():
+                spent[username] += words
+
+    db = models.get_db()
+    leaked = db.word_leases.count_documents({"username": {"$in": usernames}, "state": "active"})
+    print(f"{workers} workers died holding {leaked} leases")
+    time.sleep(TTL + GRACE + 0.5)
+    reclaimed = models.word_leases.reclaim_expired(db)
+    print(f"reclaimed {reclaimed} leases")
+
+    failures = 0
+    for username in usernames:
+        expected = start[username] - spent[username]
+        current = models.get_user(username, 'balance')['words_remaining']
+        if current != expected:
+            failures += 1
+            print(f"{username}: balance {current}, expected {expected}")
+    left = db.word_leases.count_documents({"username": {"$in": usernames}, "state": {"$in": ["active", "returning"]}})
+    if left:
+        failures += 1
+        print(f"{left} leases still outstanding")
+    print("ok" if not failures else f"{failures} failures")
+    return failures == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--balance', type=int, default=5000)
+    args = parser.parse_args()
+    sys.exit(0 if main(args.workers, args.users, args.balance) else 1)
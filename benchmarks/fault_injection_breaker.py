@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Fault-injection test of the MongoDB circuit breaker.
+
+Starts a throwaway local mongod, writes through models while it is up,
+SIGKILLs it and checks the breaker opens and writes land in the fallback
+store, then restarts mongod on the same dbpath and checks the supervisor
+probes it, closes the breaker and syncs the fallback writes back. Prints
+the breaker metrics at the end and exits non-zero on any failed check.
+
+    MONGOD_BIN=/usr/bin/mongod python benchmarks/fault_injection_breaker.py
+"""
+import os
+import sys
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Breaker settings are read when models is imported
+os.environ.setdefault('MONGO_TIMEOUT', '2')
+os.environ.setdefault('MONGO_RETRY_DELAY', '1')
+os.environ.setdefault('MONGO_BREAKER_THRESHOLD', '3')
+os.environ.setdefault('MONGO_BREAKER_MAX_BACKOFF', '4')
+os.environ['MONGO_DBNAME'] = 'breakerfi'
+os.environ['FALLBACK_STORE'] = 'memory'
+os.environ['FALLBACK_JOURNAL_ENABLED'] = 'false'
+
+from flask import Flask
+
+import models
+
+
+def start_mongod(mongod_bin, dbpath, port):
+    proc = subprocess.Popen(
+        [mongod_bin, '--dbpath', dbpath, '--port', str(port), '--bind_ip', '127.0.0.1'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    time.sleep(2)
+    return proc
+
+
+def wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def check(label, ok):
+    print(f"{'PASS' if ok else 'FAIL'} {label}")
+    return ok
+
+
+def main(mongod_bin, port, outage_writes):
+    dbpath = tempfile.mkdtemp(prefix='breaker-fi-')
+    mongod = start_mongod(mongod_bin, dbpath, port)
+    results = []
+    try:
+        app = Flask(__name__)
+        app.config['MONGO_URI'] = f"mongodb://127.0.0.1:{port}/breakerfi"
+        os.environ['MONGO_URI'] = app.config['MONGO_URI']
+        models.init_mongo(app)
+        results.append(check("connected at startup", models.mongo_connected))
+
+        models.create_user('fi-user', '1234', '0712345678')
+        models.update_word_count('fi-user', 100)
+
+        mongod.send_signal(signal.SIGKILL)
+        mongod.wait()
+
+        # Every write during the outage must succeed against the fallback store
+        started = time.monotonic()
+        for _ in range(outage_writes):
+            models.update_word_count('fi-user', 10)
+        print(f"{outage_writes} writes during outage took {time.monotonic() - started:.1f}s")
+        results.append(check("breaker opened", models.mongo_breaker.state != models.CLOSED))
+        results.append(check("requests routed to fallback", not models.mongo_connected))
+        results.append(check("fallback holds outage writes", models.users_db.changes.dirty_count() > 0))
+
+        mongod = start_mongod(mongod_bin, dbpath, port)
+        closed = wait_for(lambda: models.mongo_breaker.state == models.CLOSED, timeout=60)
+        results.append(check("breaker closed after restart", closed))
+        results.append(check("fallback writes synced", wait_for(lambda: models.users_db.changes.dirty_count() == 0, 30)))
+
+        expected = 100 + 10 * outage_writes
+        doc = models.get_db().users.find_one({"username": "fi-user"})
+        results.append(check(f"MongoDB balance is {expected}", doc is not None and doc.get('words_remaining') == expected))
+
+        # Logical errors (duplicate checkout_id) must not trip a closed breaker
+        for _ in range(5):
+            models.record_payment('fi-user', 20, 'basic', checkout_id='fi-duplicate')
+        results.append(check("duplicate keys leave breaker closed", models.mongo_breaker.state == models.CLOSED))
+
+        metrics = models.get_breaker_metrics()
+        print(f"transitions: {metrics['transitions']}")
+        print("time in state: " + ", ".join(f"{state}={seconds:.1f}s" for state, seconds in metrics['time_in_state'].items()))
+    finally:
+        if mongod.poll() is None:
+            mongod.terminate()
+            mongod.wait()
+        shutil.rmtree(dbpath, ignore_errors=True)
+    return all(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mongod', default=os.environ.get('MONGOD_BIN', 'mongod'))
+    parser.add_argument('--port', type=int, default=27999)
+    parser.add_argument('--outage-writes', type=int, default=20)
+    args = parser.parse_args()
+    sys.exit(0 if main(args.mongod, args.port, args.outage_writes) else 1)
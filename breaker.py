@@ -0,0 +1,158 @@
+"""
+Circuit breaker guarding the MongoDB tier.
+
+closed     requests go to MongoDB; retryable failures are counted
+open       too many retryable failures inside the window; requests use the
+           fallback store while a supervisor thread waits to probe
+half_open  the supervisor is probing (ping); success closes the breaker,
+           failure re-opens it
+
+Only retryable (network/topology) errors count towards opening. Logical
+errors such as duplicate keys are the caller's problem and never take the
+whole worker off MongoDB.
+"""
+import os
+import time
+import logging
+import threading
+
+from pymongo.errors import ConnectionFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def is_retryable_error(error):
+    """Check whether an error means MongoDB is unreachable rather than the operation being wrong"""
+    # AutoReconnect, NetworkTimeout, ServerSelectionTimeoutError and friends
+    if isinstance(error, ConnectionFailure):
+        return True
+    if isinstance(error, PyMongoError):
+        return error.has_error_label('RetryableWriteError') or error.has_error_label('TransientTransactionError')
+    return False
+
+
+class CircuitBreaker:
+    def __init__(self, probe, on_state_change=None, failure_threshold=3, failure_window=30.0,
+                 open_timeout=10.0, max_open_timeout=60.0):
+        self.probe = probe
+        self.on_state_change = on_state_change
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.open_timeout = open_timeout
+        self.max_open_timeout = max_open_timeout
+        self.state = CLOSED
+        self._lock = threading.Lock()
+        self._failures = []
+        self._since = time.monotonic()
+        self._time_in_state = {CLOSED: 0.0, OPEN: 0.0, HALF_OPEN: 0.0}
+        self._transitions = {}
+        self._failed_probes = 0
+        self._supervisor = None
+        self._supervisor_pid = None
+
+    @property
+    def closed(self):
+        return self.state == CLOSED
+
+    def _transition(self, new_state, reason):
+        """Move to new_state; caller holds the lock"""
+        old_state = self.state
+        if old_state == new_state:
+            return False
+        now = time.monotonic()
+        self._time_in_state[old_state] += now - self._since
+        self._since = now
+        self.state = new_state
+        key = f"{old_state}->{new_state}"
+        self._transitions[key] = self._transitions.get(key, 0) + 1
+        logger.warning(f"MongoDB circuit breaker {key}: {reason}")
+        return True
+
+    def _notify(self, changed):
+        if changed and self.on_state_change:
+            self.on_state_change(self.state)
+
+    def record_failure(self, error):
+        """Count a retryable failure, opening the breaker past the threshold"""
+        now = time.monotonic()
+        with self._lock:
+            self._failures = [t for t in self._failures if now - t < self.failure_window]
+            self._failures.append(now)
+            changed = False
+            if self.state == CLOSED and len(self._failures) >= self.failure_threshold:
+                changed = self._transition(OPEN, f"{len(self._failures)} failures in {self.failure_window:.0f}s, last: {error}")
+        self._notify(changed)
+        if changed:
+            self._start_supervisor()
+
+    def trip(self, reason):
+        """Open the breaker immediately, e.g. when the first connection fails"""
+        with self._lock:
+            changed = self._transition(OPEN, reason)
+        self._notify(changed)
+        self._start_supervisor()
+
+    def reset(self):
+        """Close the breaker after a connection made outside the supervisor, e.g. in a fresh worker"""
+        with self._lock:
+            self._failures = []
+            self._failed_probes = 0
+            self._transition(CLOSED, "connected")
+
+    def _start_supervisor(self):
+        with self._lock:
+            alive = self._supervisor is not None and self._supervisor.is_alive() and self._supervisor_pid == os.getpid()
+            if alive:
+                return
+            self._supervisor_pid = os.getpid()
+            self._supervisor = threading.Thread(target=self._supervise, daemon=True)
+            self._supervisor.start()
+
+    def _supervise(self):
+        """Probe MongoDB with backoff until the breaker closes again"""
+        while True:
+            # Back off while probes keep failing, up to max_open_timeout
+            delay = min(self.open_timeout * (2 ** min(self._failed_probes, 6)), self.max_open_timeout)
+            time.sleep(delay)
+
+            with self._lock:
+                if self.state == CLOSED:
+                    # Reconnected meanwhile through reset()
+                    return
+                changed = self._transition(HALF_OPEN, "probing")
+            self._notify(changed)
+
+            try:
+                healthy = self.probe()
+            except Exception as e:
+                logger.warning(f"MongoDB probe failed: {e}")
+                healthy = False
+
+            with self._lock:
+                if healthy:
+                    self._failed_probes = 0
+                    self._failures = []
+                    changed = self._transition(CLOSED, "probe succeeded")
+                else:
+                    self._failed_probes += 1
+                    changed = self._transition(OPEN, "probe failed")
+            self._notify(changed)
+            if healthy:
+                return
+
+    def metrics(self):
+        with self._lock:
+            time_in_state = dict(self._time_in_state)
+            time_in_state[self.state] += time.monotonic() - self._since
+            return {
+                "state": self.state,
+                "seconds_in_state": time.monotonic() - self._since,
+                "time_in_state": time_in_state,
+                "transitions": dict(self._transitions),
+                "recent_failures": len(self._failures),
+                "failed_probes": self._failed_probes
+            }
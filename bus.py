@@ -0,0 +1,133 @@
+"""
+Host-local broadcast between the worker processes of one host.
+
+Every worker binds a Unix datagram socket named after its pid in a
+shared directory and reads it on a daemon thread. publish() sends one
+datagram to every other socket in the directory, so the directory is the
+membership list and there is no broker process to run or lose. A socket
+whose process has died refuses the datagram and is removed.
+
+Delivery is best effort: a message to a worker that has not bound its
+socket yet, or whose receive buffer is full, is dropped and counted.
+Receivers must treat what they hear as a hint that expires, never as the
+record.
+"""
+import os
+import json
+import socket
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAX_DATAGRAM = 8192
+
+
+class Bus:
+    def __init__(self, directory, handler, name="bus"):
+        self.directory = directory
+        self.handler = handler
+        self.name = name
+        self._lock = threading.Lock()
+        self._sock = None
+        self._path = None
+        self._pid = None
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.removed = 0
+
+    def start(self):
+        """Bind this process's socket and start receiving, once per process"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            path = os.path.join(self.directory, f"{os.getpid()}.sock")
+            if os.path.exists(path):
+                # Left behind by an earlier process with this pid
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(path)
+            self._sock, self._path, self._pid = sock, path, os.getpid()
+        threading.Thread(target=self._receive, args=(sock,), name=f"{self.name}-receiver", daemon=True).start()
+        logger.info(f"{self.name} listening on {path}")
+
+    def _receive(self, sock):
+        while True:
+            try:
+                data = sock.recv(MAX_DATAGRAM)
+            except OSError:
+                return
+            if not data:
+                # Shut down by close()
+                return
+            try:
+                message = json.loads(data)
+            except ValueError:
+                continue
+            with self._lock:
+                self.received += 1
+            try:
+                self.handler(message)
+            except Exception as e:
+                logger.error(f"{self.name} handler failed: {e}")
+
+    def _peers(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name) for name in names
+                if name.endswith(".sock") and os.path.join(self.directory, name) != self._path]
+
+    def publish(self, message):
+        """Send message to every other process on the bus, returns how many took it"""
+        self.start()
+        data = json.dumps(message, separators=(",", ":")).encode()
+        delivered = dropped = removed = 0
+        for path in self._peers():
+            try:
+                self._sock.sendto(data, socket.MSG_DONTWAIT, path)
+                delivered += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Nobody is bound to it: the worker is gone
+                try:
+                    os.unlink(path)
+                    removed += 1
+                except OSError:
+                    pass
+            except OSError:
+                # Receive buffer full (EAGAIN) or similar
+                dropped += 1
+        with self._lock:
+            self.sent += delivered
+            self.dropped += dropped
+            self.removed += removed
+        return delivered
+
+    def close(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            sock, path = self._sock, self._path
+            self._sock = self._path = self._pid = None
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "peers": len(self._peers()) if self._pid == os.getpid() else 0,
+                "sent": self.sent,
+                "received": self.received,
+                "dropped": self.dropped,
+                "removed": self.removed,
+            }
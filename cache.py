@@ -0,0 +1,224 @@
+"""
+Process-local read-through caches for hot MongoDB documents, single-flight
+coalescing of concurrent lookups, and the request-scoped identity map.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Size-bounded LRU cache whose entries expire after ttl seconds.
+
+    Readers take a token() before fetching from the backend and pass it to
+    set(); if the key was invalidated or the cache cleared in the meantime
+    the value is dropped, so a fetch that raced a local write can never
+    repopulate a stale entry.
+    """
+    def __init__(self, maxsize=10000, ttl=10.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # key -> monotonic time of its last invalidation
+        self._invalidated = {}
+        # Monotonic time of the last clear(), which invalidates every key
+        self._cleared = -1
+        self._last_prune = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def token(self):
+        return time.monotonic()
+
+    def get(self, key):
+        """Get a cached value, or None on a miss or expired entry"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key):
+        """Get a live cached value without counting a hit or miss or refreshing its recency"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            return entry[1]
+
+    def set(self, key, value, token=None):
+        """Cache a value fetched after token(), returns False if it raced an invalidation"""
+        now = time.monotonic()
+        with self._lock:
+            if token is not None and max(self._cleared, self._invalidated.get(key, -1)) >= token:
+                return False
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._invalidated[key] = now
+            # Invalidations only matter for fetches still in flight
+            if now - self._last_prune > 60:
+                horizon = now - 60
+                self._invalidated = {k: t for k, t in self._invalidated.items() if t > horizon}
+                self._last_prune = now
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._cleared = time.monotonic()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl
+        }
+
+
+class IdentityMap:
+    """
+    Documents one unit of work (a request) has already read or written.
+
+    Entries are keyed by (collection, id) and remember which fields they
+    hold (None for the whole document), so a read for a subset of a loaded
+    document is served from it. Writers update entries in place with the
+    values they know were stored, and discard them when they do not.
+    Not thread-safe: it belongs to one request.
+    """
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, collection, key, fields=None):
+        """Get a copy of a loaded document holding fields (all of it if None), or None"""
+        entry = self._entries.get((collection, key))
+        if entry is not None:
+            document, loaded = entry
+            if loaded is None or (fields is not None and loaded.issuperset(fields)):
+                self.hits += 1
+                return dict(document)
+        self.misses += 1
+        return None
+
+    def put(self, collection, key, document, fields=None):
+        """Remember a document read with fields (the whole document if None)"""
+        loaded = None if fields is None else frozenset(fields)
+        entry = self._entries.get((collection, key))
+        if entry is not None and loaded is not None:
+            # A partial read adds to what is already known
+            if entry[1] is None:
+                entry[0].update(document)
+                return
+            loaded |= entry[1]
+            document = dict(entry[0], **document)
+        self._entries[(collection, key)] = (dict(document), loaded)
+
+    def update(self, collection, key, changes):
+        """Apply a write's new field values to a loaded document"""
+        entry = self._entries.get((collection, key))
+        if entry is None:
+            return
+        document, loaded = entry
+        document.update(changes)
+        if loaded is not None:
+            self._entries[(collection, key)] = (document, loaded | frozenset(changes))
+
+    def discard(self, collection, key):
+        self._entries.pop((collection, key), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one backend call.
+
+    The first caller for a key runs the fetch; callers arriving while it
+    runs wait for it and share its result or exception. Nothing outlives
+    the call, so it never serves a value fetched before it was asked for,
+    and forget() lets a writer make later callers start a fresh fetch
+    instead of joining one that may have read the old document.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.calls = 0
+        self.collapsed = 0
+
+    def do(self, key, fetch):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fetch()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+    def forget(self, key):
+        """Detach an in-flight call from key; its waiters still get its result"""
+        with self._lock:
+            self._flights.pop(key, None)
+
+    def stats(self):
+        requested = self.calls + self.collapsed
+        return {
+            "calls": self.calls,
+            "collapsed": self.collapsed,
+            "collapse_rate": self.collapsed / requested if requested else 0.0,
+            "in_flight": len(self._flights)
+        }
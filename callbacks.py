@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+Payment callback ingestion service, one per host.
+
+The payment provider's callbacks are taken by a threaded HTTP server that
+only parses them and appends them to a durable host-local SQLite queue
+(WAL mode, synchronous=FULL) before answering 200, so an acknowledged
+callback survives a crash or restart of this process. Appends are
+group-committed: a thread that finds no commit in progress writes every
+callback queued so far in one transaction, and the others wait for it,
+so concurrent callbacks share one fsync.
+
+A single consumer takes queued callbacks oldest first, in batches,
+applies them with payment.process_payment_callback on a few threads (a
+settlement is a handful of MongoDB round trips, so they overlap well)
+and deletes the batch's applied rows in one transaction. Repeats of a
+checkout within a batch are acknowledged without another round of
+MongoDB reads. A callback that could not be applied stops the rest of
+the batch from starting and is retried with backoff. While MongoDB is
+unreachable (ConnectionFailure) that goes on for as long as the outage
+lasts; other failures are retried CALLBACK_MAX_ATTEMPTS times and the
+callback is then kept as dead, logged at error level, until it is put
+back with requeue-dead.
+
+    python callbacks.py                # the Procfile's callback process
+    python callbacks.py requeue-dead   # retry dead callbacks
+
+GET /stats reports queue depth, the age of the oldest queued callback
+and the consumer's lag from receipt to settlement. The port faces the
+payment provider, so it is only served with CALLBACK_STATS_ENABLED=true.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from pymongo.errors import ConnectionFailure
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY = 64 * 1024
+
+CALLBACK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS callbacks (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    checkout_id TEXT NOT NULL,
+    body TEXT NOT NULL,
+    received REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    dead INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS callbacks_live ON callbacks (seq) WHERE dead = 0;
+"""
+
+
+class _Append:
+    __slots__ = ('checkout_id', 'body', 'received', 'seq', 'error', 'done')
+
+    def __init__(self, checkout_id, body):
+        self.checkout_id = checkout_id
+        self.body = body
+        self.received = time.time()
+        self.seq = None
+        self.error = None
+        self.done = False
+
+
+class CallbackQueue:
+    """
+    Durable FIFO of received callbacks in a host-local SQLite database.
+
+    Connections are opened per thread and per process, as in
+    store.SQLiteFallbackDB.
+    """
+    def __init__(self, path, busy_timeout=5.0, synchronous='FULL'):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._appends = threading.Condition()
+        self._pending = []
+        self._committing = False
+        self.arrived = threading.Event()
+        self.metrics = {"appended": 0, "commits": 0, "acknowledged": 0, "retried": 0, "dead": 0}
+        self.connect().executescript(CALLBACK_SCHEMA)
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={self.synchronous}')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run statements in a write transaction taken up front (BEGIN IMMEDIATE)"""
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def put(self, checkout_id, body):
+        """Append a callback and return its sequence number once it is committed"""
+        append = _Append(checkout_id, body)
+        with self._appends:
+            self._pending.append(append)
+            while not append.done:
+                if self._committing:
+                    self._appends.wait()
+                    continue
+                # Commit everything queued so far, this callback included
+                batch, self._pending = self._pending, []
+                self._committing = True
+                self._appends.release()
+                error = None
+                try:
+                    with self.transaction() as conn:
+                        for item in batch:
+                            item.seq = conn.execute(
+                                'INSERT INTO callbacks (checkout_id, body, received) VALUES (?, ?, ?)',
+                                (item.checkout_id, item.body, item.received)
+                            ).lastrowid
+                except Exception as e:
+                    error = e
+                finally:
+                    self._appends.acquire()
+                    self._committing = False
+                for item in batch:
+                    item.error = error
+                    item.done = True
+                if error is None:
+                    self.metrics["appended"] += len(batch)
+                    self.metrics["commits"] += 1
+                self._appends.notify_all()
+        if append.error is not None:
+            raise append.error
+        self.arrived.set()
+        return append.seq
+
+    def ready(self, limit):
+        """Up to limit live callbacks that are due, oldest first, as (seq, checkout_id, body, received, attempts)"""
+        return self.connect().execute(
+            'SELECT seq, checkout_id, body, received, attempts FROM callbacks '
+            'WHERE dead = 0 AND not_before <= ? ORDER BY seq LIMIT ?',
+            (time.time(), limit)
+        ).fetchall()
+
+    def ack(self, seqs):
+        """Delete applied callbacks"""
+        if not seqs:
+            return
+        with self.transaction() as conn:
+            conn.executemany('DELETE FROM callbacks WHERE seq = ?', [(seq,) for seq in seqs])
+        self.metrics["acknowledged"] += len(seqs)
+
+    def retry(self, seq, attempts, error, delay, max_attempts=None):
+        """Put a callback back for a later attempt, or mark it dead after max_attempts (None: never)"""
+        dead = max_attempts is not None and attempts >= max_attempts
+        with self.transaction() as conn:
+            conn.execute('UPDATE callbacks SET attempts = ?, not_before = ?, dead = ?, error = ? WHERE seq = ?',
+                         (attempts, time.time() + delay, int(dead), str(error)[:500], seq))
+        self.metrics["dead" if dead else "retried"] += 1
+        return not dead
+
+    def requeue_dead(self):
+        """Put every dead callback back in line with its attempts reset, returns how many"""
+        with self.transaction() as conn:
+            return conn.execute(
+                'UPDATE callbacks SET dead = 0, attempts = 0, not_before = 0 WHERE dead = 1').rowcount
+
+    def stats(self):
+        depth, oldest = self.connect().execute(
+            'SELECT COUNT(*), MIN(received) FROM callbacks WHERE dead = 0').fetchone()
+        dead = self.connect().execute('SELECT COUNT(*) FROM callbacks WHERE dead = 1').fetchone()[0]
+        return dict(self.metrics, depth=depth, dead_queued=dead,
+                    oldest_age=round(time.time() - oldest, 3) if oldest is not None else 0.0)
+
+
+class CallbackConsumer:
+    """
+    Applies queued callbacks in batches on a daemon thread. The distinct
+    checkouts of a batch are applied by up to `concurrency` threads, each
+    callback inside a fresh `context()` (the Flask app context).
+    """
+    def __init__(self, queue, apply, context=None, batch_size=100, concurrency=8, poll_interval=1.0,
+                 retry_delay=2.0, retry_delay_max=300.0, max_attempts=20, outage_delay_max=30.0):
+        self.queue = queue
+        self.apply = apply
+        self.context = context or nullcontext
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.retry_delay_max = retry_delay_max
+        self.max_attempts = max_attempts
+        self.outage_delay_max = outage_delay_max
+        # Backoff while MongoDB is unreachable, shared by every callback
+        self._outage_delay = 0.0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.metrics = {"batches": 0, "applied": 0, "ignored": 0, "duplicates": 0, "failures": 0,
+                        "last_lag": 0.0, "max_lag": 0.0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="callback-consumer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self.queue.arrived.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                busy = self.run_batch()
+            except Exception as e:
+                logger.error(f"Callback consumer failed: {e}")
+                busy = 0
+            if not busy:
+                self.queue.arrived.wait(self.poll_interval)
+                self.queue.arrived.clear()
+
+    def run_batch(self):
+        """Apply one batch of due callbacks, returns how many rows it took off the queue"""
+        rows = self.queue.ready(self.batch_size)
+        if not rows:
+            return 0
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.concurrency, thread_name_prefix="callback-apply")
+
+        done, distinct, seen = [], [], set()
+        for row in rows:
+            if row[1] in seen:
+                # A provider retry of a checkout this batch settles already
+                done.append(row[0])
+            else:
+                seen.add(row[1])
+                distinct.append(row)
+        duplicates = len(done)
+
+        failed = threading.Event()
+
+        def apply(row):
+            if failed.is_set():
+                # Left queued for the next round
+                return None
+            try:
+                with self.context():
+                    return bool(self.apply(json.loads(row[2])))
+            except Exception as e:
+                # Likely MongoDB is down; callbacks not started yet wait for the next round
+                failed.set()
+                return e
+
+        applied = ignored = failures = 0
+        lag = 0.0
+        outage_delay = None
+        for (seq, checkout_id, body, received, attempts), result in zip(distinct, self._pool.map(apply, distinct)):
+            if result is None:
+                continue
+            if isinstance(result, ConnectionFailure):
+                # MongoDB is unreachable: wait for it however long that takes,
+                # without using up the callback's attempts
+                failures += 1
+                if outage_delay is None:
+                    outage_delay = self._outage_delay = min(max(self.retry_delay, self._outage_delay * 2),
+                                                            self.outage_delay_max)
+                self.queue.retry(seq, attempts, result, outage_delay)
+                logger.warning(f"MongoDB unreachable, callback for {checkout_id} retried in {outage_delay:.0f}s: {result}")
+                continue
+            if isinstance(result, Exception):
+                failures += 1
+                delay = min(self.retry_delay * 2 ** attempts, self.retry_delay_max)
+                if self.queue.retry(seq, attempts + 1, result, delay, self.max_attempts):
+                    logger.warning(f"Callback for {checkout_id} failed, retrying in {delay:.0f}s: {result}")
+                else:
+                    logger.error(f"Callback for {checkout_id} (seq {seq}) failed {attempts + 1} times and is dead; "
+                                 f"fix the cause and run python callbacks.py requeue-dead: {result}")
+                continue
+            done.append(seq)
+            applied += result
+            ignored += not result
+            lag = max(lag, time.time() - received)
+        if done:
+            self._outage_delay = 0.0
+        self.queue.ack(done)
+        with self._lock:
+            self.metrics["batches"] += 1
+            self.metrics["applied"] += applied
+            self.metrics["ignored"] += ignored
+            self.metrics["duplicates"] += duplicates
+            self.metrics["failures"] += failures
+            if done:
+                self.metrics["last_lag"] = round(lag, 3)
+                self.metrics["max_lag"] = max(self.metrics["max_lag"], round(lag, 3))
+        return len(done)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.metrics, concurrency=self.concurrency)
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlsplit(self.path).path == '/stats':
+            if not self.server.stats_enabled:
+                return self._reply(404, {"status": "error", "message": "Not found"})
+            return self._reply(200, self.server.stats())
+        self._reply(200, {"status": "success", "message": "Lipia Callback Server"})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            self.close_connection = True
+            return self._reply(413, {"status": "error", "message": "Callback too large"})
+        try:
+            callback_data = json.loads(self.rfile.read(length) or b'null')
+        except ValueError:
+            return self._reply(400, {"status": "error", "message": "Invalid JSON"})
+        if not isinstance(callback_data, dict):
+            return self._reply(400, {"status": "error", "message": "Invalid callback"})
+
+        # Our checkout ID rides along in the callback URL; older checkouts are keyed by the provider's
+        checkout_id = parse_qs(urlsplit(self.path).query).get('checkout_id', [None])[0] \
+            or callback_data.get('CheckoutRequestID')
+        if not checkout_id:
+            return self._reply(400, {"status": "error", "message": "Missing checkout ID"})
+        callback_data['checkout_id'] = checkout_id
+
+        try:
+            self.server.queue.put(checkout_id, json.dumps(callback_data))
+        except sqlite3.Error as e:
+            logger.error(f"Could not queue callback for {checkout_id}: {e}")
+            # The provider redelivers callbacks that were not acknowledged
+            return self._reply(503, {"status": "error", "message": "Callback not stored"})
+        self._reply(200, {"status": "success"})
+
+
+class CallbackServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, queue, consumer=None, stats_enabled=False):
+        self.queue = queue
+        self.consumer = consumer
+        self.stats_enabled = stats_enabled
+        super().__init__(address, CallbackHandler)
+
+    def stats(self):
+        stats = {"queue": self.queue.stats()}
+        if self.consumer is not None:
+            stats["consumer"] = self.consumer.stats()
+        return stats
+
+
+def create_app():
+    """The Flask app whose context process_payment_callback runs in"""
+    from flask import Flask
+    import models
+
+    app = Flask(__name__)
+    app.config['MONGO_URI'] = os.environ.get('MONGO_URI')
+    models.init_mongo(app)
+    return app
+
+
+def requeue_dead():
+    """Put the dead callbacks in CALLBACK_QUEUE_PATH back in line"""
+    queue = CallbackQueue(os.environ.get('CALLBACK_QUEUE_PATH', 'callback_queue.db'))
+    print(f"{queue.requeue_dead()} dead callbacks requeued, the running service applies them")
+    return 0
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', nargs='?', choices=('serve', 'requeue-dead'), default='serve')
+    if parser.parse_args(argv).command == 'requeue-dead':
+        return requeue_dead()
+
+    app = create_app()
+    from adapter import PaymentAdapter
+    from payment import process_payment_callback
+
+    config = PaymentAdapter().config
+    queue = CallbackQueue(os.environ.get('CALLBACK_QUEUE_PATH', 'callback_queue.db'))
+    consumer = CallbackConsumer(
+        queue,
+        process_payment_callback,
+        context=app.app_context,
+        batch_size=int(os.environ.get('CALLBACK_BATCH_SIZE', 100)),
+        concurrency=int(os.environ.get('CALLBACK_APPLY_THREADS', 8)),
+        max_attempts=int(os.environ.get('CALLBACK_MAX_ATTEMPTS', 20))
+    )
+    consumer.start()
+    server = CallbackServer((config['callback_host'], config['callback_port']), queue, consumer,
+                            stats_enabled=os.environ.get('CALLBACK_STATS_ENABLED', 'false').lower() == 'true')
+    logger.info(f"Callback server listening on {config['callback_host']}:{config['callback_port']}, "
+                f"{queue.stats()['depth']} callbacks queued")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        consumer.stop(timeout=10)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Bounded background dispatch of slow outbound calls.
+
+A request handler that would otherwise block on a third party hands the
+call to a Dispatcher and returns. The dispatcher runs at most `workers`
+calls at once, so a slow provider sees bounded concurrency from each
+process, and holds at most `max_queued` waiting calls; submit() refuses
+the rest so the caller can shed load instead of queueing work it will
+never get to.
+
+Every job has a deadline. A job still queued when its deadline passes is
+not started; its expired() callback runs instead. A started job is told
+how many seconds it has left and should use them as its timeout.
+
+Threads start on the first submit, so a dispatcher created at import in
+the gunicorn master starts afresh in each forked worker.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _Job:
+    __slots__ = ("run", "expired", "deadline", "submitted")
+
+    def __init__(self, run, expired, deadline):
+        self.run = run
+        self.expired = expired
+        self.submitted = time.monotonic()
+        self.deadline = self.submitted + deadline
+
+
+class Dispatcher:
+    def __init__(self, workers=8, max_queued=200, name="dispatch"):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.name = name
+        self._lock = threading.Lock()
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self.submitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.completed = 0
+        self.failed = 0
+        self.running = 0
+        self.max_wait = 0.0
+
+    def _ensure_started(self):
+        # Caller holds the lock
+        if self._pid == os.getpid() and self._threads:
+            return
+        self._queue = queue.Queue(maxsize=self.max_queued)
+        self._threads = [
+            threading.Thread(target=self._work, name=f"{self.name}-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        self._pid = os.getpid()
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, run, deadline, expired=None):
+        """
+        Queue run(remaining_seconds) to start within deadline seconds.
+
+        Returns False, without queueing it, if max_queued jobs are already
+        waiting. If no thread picks the job up in time, expired() is called
+        instead of run.
+        """
+        with self._lock:
+            self._ensure_started()
+            try:
+                self._queue.put_nowait(_Job(run, expired, deadline))
+            except queue.Full:
+                self.rejected += 1
+                return False
+            self.submitted += 1
+            return True
+
+    def _work(self):
+        jobs = self._queue
+        while True:
+            job = jobs.get()
+            if job is _STOP:
+                return
+            started = time.monotonic()
+            remaining = job.deadline - started
+            with self._lock:
+                self.max_wait = max(self.max_wait, started - job.submitted)
+                if remaining <= 0:
+                    self.expired += 1
+                else:
+                    self.running += 1
+            try:
+                if remaining <= 0:
+                    if job.expired:
+                        job.expired()
+                    continue
+                job.run(remaining)
+                with self._lock:
+                    self.completed += 1
+            except Exception as e:
+                logger.error(f"{self.name} job failed: {e}")
+                with self._lock:
+                    self.failed += 1
+            finally:
+                if remaining > 0:
+                    with self._lock:
+                        self.running -= 1
+
+    def shutdown(self, timeout=None):
+        """Let the threads finish the queued jobs and stop, waiting up to timeout seconds in all"""
+        with self._lock:
+            if self._pid != os.getpid() or not self._threads:
+                return True
+            threads, jobs = self._threads, self._queue
+            self._threads = []
+        give_up = None if timeout is None else time.monotonic() + timeout
+
+        def left():
+            return None if give_up is None else max(0.0, give_up - time.monotonic())
+
+        try:
+            # The stop markers go behind the queued jobs
+            for _ in threads:
+                jobs.put(_STOP, timeout=left())
+        except queue.Full:
+            pass
+        for thread in threads:
+            thread.join(left())
+        return not any(thread.is_alive() for thread in threads)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queued": self.max_queued,
+                "queued": self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0,
+                "running": self.running,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "expired": self.expired,
+                "completed": self.completed,
+                "failed": self.failed,
+                "max_wait": round(self.max_wait, 3),
+            }
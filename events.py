@@ -0,0 +1,105 @@
+"""
+In-process subscriptions to checkout status changes.
+
+The /payment/events stream of a waiting page subscribes to its checkout
+and blocks in wait() until a status is published or the heartbeat comes
+round; it costs a parked thread and a deque, not a poll of MongoDB every
+two seconds. Whoever changes a checkout's status in this process
+publishes it (payment._set_status).
+
+Subscriptions are capped per process. Each open stream holds one of the
+worker's threads, so subscribe() refuses once max_subscribers are open
+and the page falls back to polling instead of starving ordinary
+requests of threads.
+"""
+import time
+import threading
+from collections import deque
+
+
+class Subscription:
+    def __init__(self, broker, key):
+        self.broker = broker
+        self.key = key
+        self._changed = threading.Condition()
+        self._pending = deque()
+        self.closed = False
+
+    def _deliver(self, status):
+        with self._changed:
+            self._pending.append(status)
+            self._changed.notify()
+
+    def wait(self, timeout):
+        """The next published status, or None after timeout seconds without one"""
+        give_up = time.monotonic() + timeout
+        with self._changed:
+            while not self._pending:
+                remaining = give_up - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+            return self._pending.popleft()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broker._unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StatusBroker:
+    def __init__(self, max_subscribers=48):
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        self._open = 0
+        self.published = 0
+        self.delivered = 0
+        self.refused = 0
+
+    def subscribe(self, key):
+        """Subscribe to key's status changes, returns None if max_subscribers are open already"""
+        with self._lock:
+            if self._open >= self.max_subscribers:
+                self.refused += 1
+                return None
+            subscription = Subscription(self, key)
+            self._subscriptions.setdefault(key, set()).add(subscription)
+            self._open += 1
+            return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscriptions.get(subscription.key)
+            if subscribers and subscription in subscribers:
+                subscribers.discard(subscription)
+                self._open -= 1
+                if not subscribers:
+                    del self._subscriptions[subscription.key]
+
+    def publish(self, key, status):
+        """Hand status to every open subscription to key, returns how many there were"""
+        with self._lock:
+            subscribers = list(self._subscriptions.get(key, ()))
+            self.published += 1
+            self.delivered += len(subscribers)
+        for subscription in subscribers:
+            subscription._deliver(status)
+        return len(subscribers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "open": self._open,
+                "max_subscribers": self.max_subscribers,
+                "keys": len(self._subscriptions),
+                "published": self.published,
+                "delivered": self.delivered,
+                "refused": self.refused,
+            }
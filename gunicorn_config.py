@@ -1,4 +1,6 @@
 import os
+import sys
+import subprocess
 import multiprocessing
 
 # Server socket
@@ -7,7 +9,13 @@ backlog = 2048
 
 # Worker processes
 workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = 'sync'
+# Sync workers serve one request at a time. GUNICORN_WORKER_CLASS=gthread
+# is opt-in: it runs GUNICORN_THREADS requests at once in each worker, and
+# only then do waiting pages hold a /payment/events stream (one thread
+# each) instead of polling
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+# Gunicorn turns sync workers with more than one thread into gthread ones
+threads = int(os.environ.get('GUNICORN_THREADS', 64)) if worker_class == 'gthread' else 1
 worker_connections = 1000
 timeout = 60  # Increased timeout to handle slower MongoDB connections
 keepalive = 2
@@ -33,6 +41,18 @@ proc_name = None
 def on_starting(server):
     """Log that Gunicorn is starting the Andikar AI frontend."""
     server.log.info("Starting Andikar AI Web Frontend")
+    # Indexes are applied once per deploy here, not by every worker. It runs
+    # in a child process so the master never holds a MongoDB client to fork
+    if os.environ.get('MONGO_ENSURE_INDEXES_ON_START', 'true').lower() == 'true':
+        manage = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manage.py')
+        try:
+            result = subprocess.run([sys.executable, manage, 'ensure-indexes'], capture_output=True, text=True, timeout=300)
+            for line in (result.stdout + result.stderr).splitlines():
+                server.log.info(f"ensure-indexes: {line}")
+            if result.returncode:
+                server.log.error(f"ensure-indexes exited with {result.returncode}")
+        except Exception as e:
+            server.log.error(f"Could not apply MongoDB indexes: {e}")
 
 def on_exit(server):
     """Log that Gunicorn is shutting down."""
@@ -41,6 +61,14 @@ def on_exit(server):
 def post_fork(server, worker):
     """Set up worker after fork."""
     server.log.info(f"Worker spawned (pid: {worker.pid})")
+    # Give each worker its own MongoDB client (clients are not fork-safe) and
+    # open its pool before the worker accepts traffic
+    try:
+        import models
+        if models.init_worker_mongo():
+            server.log.info(f"MongoDB pool warmed (pid: {worker.pid})")
+    except Exception as e:
+        server.log.error(f"Could not initialize MongoDB in worker (pid: {worker.pid}): {e}")
 
 def pre_fork(server, worker):
     """Prepare to fork a worker."""
@@ -64,4 +92,18 @@ def worker_abort(worker):
 
 def worker_exit(server, worker):
     """Called when a worker exits."""
+    # Let queued STK pushes go out before the worker's threads die with it
+    payment = sys.modules.get('payment')
+    if payment is not None:
+        stats = payment.stk_dispatcher.stats()
+        if stats['queued'] or stats['running']:
+            server.log.info(f"Waiting for {stats['queued'] + stats['running']} STK requests (pid: {worker.pid})")
+        if not payment.stk_dispatcher.shutdown(timeout=payment.STK_REQUEST_TIMEOUT):
+            server.log.warning(f"STK requests still running at exit (pid: {worker.pid})")
+        # Leave the status bus so other workers stop sending to this one
+        payment.status_bus.close()
+    import models
+    returned = models.release_word_leases()
+    if returned:
+        server.log.info(f"Returned {returned} word leases (pid: {worker.pid})")
     server.log.info(f"Worker exited (pid: {worker.pid})")
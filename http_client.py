@@ -0,0 +1,217 @@
+"""
+Pooled HTTP client for the Lipia payment API.
+
+Each worker keeps one requests.Session for the Lipia host, so STK pushes
+reuse warm keep-alive connections instead of paying DNS, TCP and TLS
+setup per call. The session is created on first use in each process;
+sessions are not fork-safe.
+
+Retries are for failures that are safe to repeat:
+
+    any method   the connection could not be opened, so nothing was sent
+    idempotent   also read timeouts, dropped connections and 502/503/504
+
+An STK push is a POST, so once it reached Lipia it is never sent again;
+the caller's fallback handles it. Retries back off exponentially with
+full jitter and stop at the caller's timeout. All requests in a process
+share a RetryBudget: every request earns a fraction of a retry and every
+retry spends one, so during an outage retries stay a small fraction of
+traffic instead of multiplying it.
+"""
+import os
+import time
+import random
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE"))
+RETRY_STATUSES = frozenset((502, 503, 504))
+
+
+class RetryBudget:
+    """
+    Process-wide allowance of retries.
+
+    Each request deposits `ratio` tokens and each retry withdraws one, so
+    retries can add at most ratio of the request rate. `min_per_second`
+    tokens trickle in regardless, so a quiet worker can still retry, and
+    the balance never exceeds max_tokens.
+    """
+    def __init__(self, ratio=0.1, min_per_second=1.0, max_tokens=10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._tokens = max_tokens
+        self._refilled = time.monotonic()
+        self.denied = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._refilled) * self.min_per_second)
+        self._refilled = now
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.denied += 1
+            return False
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+
+def _not_sent(error):
+    """Whether a requests exception means the request never left this process"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        # urllib3 wraps refused and unresolvable connects as
+        # MaxRetryError(reason=NewConnectionError) and timed out ones as
+        # MaxRetryError(reason=ConnectTimeoutError). NewConnectionError only
+        # subclasses ConnectTimeoutError for backwards compatibility, so
+        # both are checked
+        return isinstance(getattr(error.args[0], "reason", None), (NewConnectionError, ConnectTimeoutError))
+    return False
+
+
+class LipiaClient:
+    def __init__(self, adapter):
+        self.adapter = adapter
+        config = adapter.config
+        self.pool_connections = config['http_pool_connections']
+        self.pool_maxsize = config['http_pool_maxsize']
+        self.max_retries = config['http_max_retries']
+        self.backoff = config['http_backoff']
+        self.backoff_max = config['http_backoff_max']
+        self.budget = RetryBudget(
+            ratio=config['http_retry_budget_ratio'],
+            min_per_second=config['http_retry_budget_min_per_second']
+        )
+        self._lock = threading.Lock()
+        self._session = None
+        self._http = None
+        self._pid = None
+        self.requests = 0
+        self.attempts = 0
+        self.retries = 0
+        self.failures = 0
+
+    def session(self):
+        """This process's session, created on first use"""
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                session.headers.update({
+                    'Authorization': f'Bearer {self.adapter.get_api_key()}',
+                    'Content-Type': 'application/json'
+                })
+                # Retries are ours (see request), so urllib3 must not add its own
+                self._http = HTTPAdapter(pool_connections=self.pool_connections,
+                                         pool_maxsize=self.pool_maxsize, max_retries=0)
+                session.mount('https://', self._http)
+                session.mount('http://', self._http)
+                self._session = session
+                self._pid = os.getpid()
+            return self._session
+
+    def _retryable(self, method, error=None, response=None):
+        if error is not None:
+            if _not_sent(error):
+                return True
+            return method in IDEMPOTENT_METHODS and isinstance(
+                error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+        return method in IDEMPOTENT_METHODS and response.status_code in RETRY_STATUSES
+
+    def request(self, method, endpoint, timeout, **kwargs):
+        """
+        Send a request to an API endpoint, retrying what is safe to retry.
+
+        timeout bounds the whole call, retries and backoff included. Returns
+        the last response, or raises the last requests exception.
+        """
+        method = method.upper()
+        url = self.adapter.get_api_url(endpoint)
+        session = self.session()
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self.requests += 1
+        self.budget.deposit()
+
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            error = response = None
+            with self._lock:
+                self.attempts += 1
+            try:
+                response = session.request(method, url, timeout=max(remaining, 0.001), **kwargs)
+            except requests.exceptions.RequestException as e:
+                error = e
+
+            if not self._retryable(method, error, response):
+                break
+            delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+            if attempt >= self.max_retries or time.monotonic() + delay >= deadline or not self.budget.withdraw():
+                break
+            attempt += 1
+            with self._lock:
+                self.retries += 1
+            logger.info(f"Retrying {method} {endpoint} in {delay:.2f}s after {error or response.status_code}")
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+
+        if error is not None:
+            with self._lock:
+                self.failures += 1
+            raise error
+        return response
+
+    def post(self, endpoint, timeout, **kwargs):
+        return self.request('POST', endpoint, timeout, **kwargs)
+
+    def get(self, endpoint, timeout, **kwargs):
+        return self.request('GET', endpoint, timeout, **kwargs)
+
+    def metrics(self):
+        """Request, retry and connection-reuse counters for this process"""
+        opened = sent = 0
+        with self._lock:
+            http = self._http if self._pid == os.getpid() else None
+            counts = {
+                "requests": self.requests,
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "failures": self.failures,
+            }
+        if http is not None:
+            pools = http.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+                    sent += pool.num_requests
+        counts.update({
+            "connections_opened": opened,
+            "connection_reuse": round(1 - opened / sent, 4) if sent else 0.0,
+            "retries_denied": self.budget.denied,
+            "retry_budget": round(self.budget.tokens, 2),
+            "pool_maxsize": self.pool_maxsize,
+        })
+        return counts
@@ -0,0 +1,186 @@
+"""
+Declarative MongoDB index spec.
+
+INDEXES lists every index the application relies on, each next to the
+queries it serves. apply() brings a database in line with it: it creates
+missing indexes, changes a TTL in place with collMod, and reports indexes
+that are not in the spec. It runs once per deploy (python manage.py
+ensure-indexes, which the gunicorn master runs on start), never on
+worker boot or reconnect.
+
+hot_queries() are the request-path and background queries, written the way
+models.py, ledger.py, leases.py and archive.py issue them.
+benchmarks/check_index_coverage.py explains each one against a seeded
+mongod and fails if any of them is a COLLSCAN. Add new queries there
+together with their index.
+"""
+import logging
+from datetime import datetime
+
+from pymongo.errors import OperationFailure
+
+import archive
+
+
+def _index(collection, keys, name, **options):
+    return {"collection": collection, "keys": keys, "name": name, "options": options}
+
+
+INDEXES = [
+    # get_user, user_exists, every users update and ledger fold
+    _index("users", [("username", 1)], "username_1", unique=True),
+
+    # get_payment, record_payment, update_payment_status, settlement claim
+    _index("payments", [("checkout_id", 1)], "checkout_id_1", unique=True),
+    # Payment history pages and export, newest first
+    _index("payments", [("username", 1), ("timestamp", -1), ("_id", -1)], "username_1_timestamp_-1__id_-1"),
+    # Abandoned pending payments expire
+    _index("payments", [("timestamp", 1)], "pending_ttl",
+           expireAfterSeconds=archive.PENDING_TTL, partialFilterExpression={"status": "pending"}),
+    # Archive batches
+    _index("payments", [("status", 1), ("timestamp", 1)], "archive_scan"),
+
+    # transactions are read by _id (the checkout id) only. Earlier releases
+    # created this index for a per-user listing that is gone; it stays in the
+    # spec, so --drop-unknown leaves it alone, until a migration drops it
+    _index("transactions", [("username", 1), ("timestamp", -1)], "username_1_timestamp_-1"),
+    _index("transactions", [("timestamp", 1)], "pending_ttl",
+           expireAfterSeconds=archive.PENDING_TTL, partialFilterExpression={"status": "pending"}),
+    _index("transactions", [("status", 1), ("timestamp", 1)], "archive_scan"),
+
+    _index("payments_archive", [("checkout_id", 1)], "checkout_id_1", unique=True),
+    _index("payments_archive", [("username", 1), ("timestamp", -1), ("_id", -1)], "username_1_timestamp_-1__id_-1"),
+
+    # Tail reads and compaction; only unfolded entries are indexed, so the
+    # index stays small however long the ledger grows
+    _index("word_ledger", [("username", 1), ("at", 1)], "ledger_tail", partialFilterExpression={"folded": False}),
+    _index("word_ledger", [("username", 1), ("at", -1)], "ledger_history"),
+
+    # Lease reclaim scans
+    _index("word_leases", [("state", 1), ("expires_at", 1)], "state_1_expires_at_1"),
+    # A user's leases, taken back when a direct debit is refused
+    _index("word_leases", [("username", 1), ("state", 1)], "username_1_state_1"),
+    _index("word_leases", [("returned_at", 1)], "returned_at_1", expireAfterSeconds=86400),
+]
+
+
+def _query(label, collection, filter, sort=None, distinct=None):
+    return {"label": label, "collection": collection, "filter": filter, "sort": sort, "distinct": distinct}
+
+
+def hot_queries(now=None):
+    """The queries apply()'s indexes have to serve, with sample values"""
+    now = now or datetime.utcnow()
+    history_after = {"$or": [{"timestamp": {"$lt": now}}, {"timestamp": now, "_id": {"$lt": "0" * 24}}]}
+    history_sort = [("timestamp", -1), ("_id", -1)]
+    final = {"$in": list(archive.FINAL_STATUSES)}
+    return [
+        _query("get_user", "users", {"username": "u"}),
+        _query("consume_words guard", "users", {"username": "u", "words_remaining": {"$gte": 1}, "ledger_ops": {"$ne": "op"}}),
+        _query("ledger.applied", "users", {"username": "u", "ledger_ops": "op"}),
+        _query("summary payment update", "users", {"username": "u", "summary.recent_payments.checkout_id": "c"}),
+        _query("get_payment", "payments", {"checkout_id": "c"}),
+        _query("settlement claim", "payments", {"checkout_id": "c", "status": "pending"}),
+        _query("record_payment guard", "payments", {"checkout_id": "c", "status": {"$in": ["pending", "completed"]}}),
+        _query("history first page", "payments", {"username": "u"}, history_sort),
+        _query("history next page", "payments", dict(history_after, username="u"), history_sort),
+        _query("archive batch", "payments", {"status": final, "timestamp": {"$lt": now}}, [("timestamp", 1)]),
+        _query("get_transaction", "transactions", {"_id": "c"}),
+        _query("settlement recovery", "transactions", {"_id": "c", "status": "pending"}),
+        _query("archive batch", "transactions", {"status": final, "timestamp": {"$lt": now}}, [("timestamp", 1)]),
+        _query("archived payment", "payments_archive", {"checkout_id": "c"}),
+        _query("archived history", "payments_archive", dict(history_after, username="u"), history_sort),
+        _query("archived transaction", "transactions_archive", {"_id": "c"}),
+        _query("ledger tail", "word_ledger", {"folded": False, "username": "u"}, [("at", 1)]),
+        _query("ledger fold", "word_ledger", {"folded": False, "username": "u", "at": {"$lt": now}}, [("at", 1)]),
+        _query("ledger compaction", "word_ledger", {"folded": False, "at": {"$lt": now}}, distinct="username"),
+        _query("ledger history", "word_ledger", {"username": "u"}, [("at", -1)]),
+        _query("ledger entry", "word_ledger", {"_id": "op", "folded": True}),
+        _query("summary usage rebuild", "word_ledger", {"username": {"$in": ["u"]}, "at": {"$gte": now}, "reason": {"$in": ["debit"]}}),
+        _query("lease reclaim", "word_leases", {"state": "active", "expires_at": {"$lt": now}}),
+        _query("user's leases", "word_leases", {"username": "u", "state": "active"}),
+        _query("stuck lease returns", "word_leases", {"state": "returning", "returning_at": {"$lt": now}}),
+    ]
+
+
+def plan_stages(node):
+    """Collect every stage name in an explain plan tree"""
+    stages = []
+    if isinstance(node, dict):
+        if 'stage' in node:
+            stages.append(node['stage'])
+        for value in node.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(node, list):
+        for value in node:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def _keys(info):
+    return [(field, int(direction) if isinstance(direction, (int, float)) else direction)
+            for field, direction in info["key"]]
+
+
+def _options(info):
+    return {k: info[k] for k in ("unique", "expireAfterSeconds", "partialFilterExpression") if k in info}
+
+
+def apply(db, drop_unknown=False, collections=None, log=logging.info):
+    """
+    Make the database's indexes match INDEXES, returns what was done.
+
+    Returns a dict of lists: created, updated (TTL changed), unknown
+    (indexes not in the spec, dropped if drop_unknown), conflicts (an
+    index with the spec's name but other keys or options, left alone).
+    """
+    summary = {"created": [], "updated": [], "unknown": [], "dropped": [], "conflicts": []}
+    specs = [spec for spec in INDEXES if collections is None or spec["collection"] in collections]
+    existing = {}
+    for spec in specs:
+        name = spec["collection"]
+        if name not in existing:
+            existing[name] = db[name].index_information()
+        info = existing[name].get(spec["name"])
+        label = f"{name}.{spec['name']}"
+
+        if info is None:
+            try:
+                db[name].create_index(spec["keys"], name=spec["name"], **spec["options"])
+            except OperationFailure as e:
+                # Usually the same keys indexed under another name
+                summary["conflicts"].append(label)
+                log(f"Could not create index {label}: {e}")
+                continue
+            summary["created"].append(label)
+            log(f"Created index {label}")
+            continue
+
+        current = _options(info)
+        wanted = dict(spec["options"])
+        current_ttl = current.pop("expireAfterSeconds", None)
+        wanted_ttl = wanted.pop("expireAfterSeconds", None)
+        if _keys(info) != spec["keys"] or current != wanted or (current_ttl is None) != (wanted_ttl is None):
+            # Only a TTL can change in place
+            summary["conflicts"].append(label)
+            log(f"Index {label} differs from the spec ({info}), drop it to rebuild")
+            continue
+        if current_ttl != wanted_ttl:
+            db.command("collMod", name, index={"name": spec["name"], "expireAfterSeconds": wanted_ttl})
+            summary["updated"].append(label)
+            log(f"Changed TTL of {label} to {wanted_ttl}s")
+
+    wanted_names = {(spec["collection"], spec["name"]) for spec in specs}
+    for name, infos in existing.items():
+        for index_name in infos:
+            if index_name == "_id_" or (name, index_name) in wanted_names:
+                continue
+            label = f"{name}.{index_name}"
+            if drop_unknown:
+                db[name].drop_index(index_name)
+                summary["dropped"].append(label)
+                log(f"Dropped index {label}")
+            else:
+                summary["unknown"].append(label)
+                log(f"Index {label} is not in the spec")
+    return summary
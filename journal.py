@@ -0,0 +1,272 @@
+"""
+Durable write-behind journal for the in-memory fallback store.
+
+Every fallback mutation that MongoDB has not acknowledged is appended to an
+on-disk journal as a full record image, so a recycled or restarted worker can
+replay it and hand it to the MongoDB sync. Records are JSON lines in
+append-only segment files named ``<pid>-<counter>.seg``; a segment is sealed
+and a new one started once it reaches the configured size.
+
+Writes are group-committed: appenders queue their line and block until a
+background flusher has written and fsynced the batch containing it, so many
+concurrent writers share one fsync. A batch that cannot be written stays
+queued and is retried, and waiters get the error until a write succeeds.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.seg'
+
+
+def _pid_alive(pid):
+    """Check whether a process with the given pid is running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Journal:
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, commit_interval=0.002, fsync=True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.commit_interval = commit_interval
+        self.fsync = fsync
+        self.metrics = {
+            "appends": 0,
+            "commits": 0,
+            "bytes_written": 0,
+            "segments_rotated": 0,
+            "segments_adopted": 0,
+            "segments_removed": 0,
+            "entries_replayed": 0,
+            "write_errors": 0
+        }
+        self._pid = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _ensure_open(self):
+        """(Re)initialize per-process state, also after a fork"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        # Serializes file writes, rotation and segment naming
+        self._io_lock = threading.Lock()
+        self._committed = threading.Condition(self._lock)
+        self._buffer = []
+        self._next_seq = 0
+        self._durable_seq = 0
+        # The last write error and the entries it failed, until a batch is written again
+        self._error = None
+        self._failed_seq = 0
+        # A failed write left a partial line at the end of the segment
+        self._torn = False
+        self._counter = 0
+        self._closed = False
+        self._file = None
+        # Segments created or adopted by this process
+        self._owned = set()
+        self._open_segment()
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def _segment_path(self, counter):
+        return os.path.join(self.directory, f"{self._pid}-{counter:08d}{SEGMENT_SUFFIX}")
+
+    def _open_segment(self):
+        self._counter += 1
+        while os.path.exists(self._segment_path(self._counter)):
+            self._counter += 1
+        path = self._segment_path(self._counter)
+        # Unbuffered, so a failed write leaves nothing behind to be written twice
+        self._file = open(path, 'ab', buffering=0)
+        self._path = path
+        self._owned.add(path)
+        self._size = 0
+
+    def _own_segments(self):
+        return sorted(path for path in self._owned if os.path.exists(path))
+
+    def append(self, kind, key, record):
+        """Queue an entry and return its sequence number (see wait)"""
+        line = json.dumps([kind, key, record], default=str, separators=(',', ':')).encode('utf-8') + b'\n'
+        self._ensure_open()
+        with self._lock:
+            self._next_seq += 1
+            self._buffer.append(line)
+            self.metrics["appends"] += 1
+            self._committed.notify_all()
+            return self._next_seq
+
+    def wait(self, seq):
+        """Block until the entry with the given sequence number is durable, raises OSError if writing it failed"""
+        with self._lock:
+            while self._durable_seq < seq and not self._closed:
+                if self._error is not None and seq <= self._failed_seq:
+                    raise OSError(self._error.errno, f"Fallback journal {self._path} is not durable: {self._error}")
+                self._committed.wait()
+
+    def write(self, kind, key, record):
+        """Append an entry and wait for it to be committed"""
+        self.wait(self.append(kind, key, record))
+
+    def _flush_loop(self):
+        retry_delay = 0
+        while True:
+            with self._lock:
+                while not self._buffer and not self._closed:
+                    self._committed.wait()
+                if self._closed and not self._buffer:
+                    return
+            # Let concurrent writers join this group before committing it
+            if self.commit_interval:
+                time.sleep(self.commit_interval)
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+                last_seq = self._next_seq
+            with self._io_lock:
+                error = self._write_batch(batch)
+            with self._lock:
+                if error is None:
+                    self._durable_seq = last_seq
+                    self._error = None
+                    retry_delay = 0
+                else:
+                    # Not durable: keep the batch, ahead of anything appended since
+                    self._buffer[:0] = batch
+                    self._error = error
+                    self._failed_seq = last_seq
+                    self.metrics["write_errors"] += 1
+                self._committed.notify_all()
+                if error is None:
+                    continue
+                if self._closed:
+                    logger.error(f"Closing fallback journal with {len(self._buffer)} entries not written: {error}")
+                    return
+                retry_delay = min(max(retry_delay * 2, 0.05), 5.0)
+                retry_at = time.monotonic() + retry_delay
+                while not self._closed and time.monotonic() < retry_at:
+                    self._committed.wait(retry_at - time.monotonic())
+
+    def _write_batch(self, batch):
+        """Write and fsync a batch, returns the OSError if it is not durable"""
+        # Start after a torn line on a line of our own, replay skips the torn one
+        data = memoryview((b'\n' if self._torn else b'') + b''.join(batch))
+        try:
+            written = 0
+            while written < len(data):
+                written += self._file.write(data[written:])
+            if self.fsync:
+                os.fsync(self._file.fileno())
+        except OSError as e:
+            logger.error(f"Error writing fallback journal {self._path}: {e}")
+            try:
+                # Drop what part of the batch got in, it is written again on retry
+                os.ftruncate(self._file.fileno(), self._size)
+            except OSError as truncate_error:
+                logger.error(f"Could not truncate fallback journal {self._path}: {truncate_error}")
+                self._torn = True
+            return e
+        self._torn = False
+        self._size += len(data)
+        self.metrics["commits"] += 1
+        self.metrics["bytes_written"] += len(data)
+        if self._size >= self.segment_bytes:
+            try:
+                self._rotate()
+            except OSError as e:
+                # The batch is durable, keep appending to this segment
+                logger.error(f"Could not start a new fallback journal segment: {e}")
+        return None
+
+    def _rotate(self):
+        previous = self._file
+        self._open_segment()
+        previous.close()
+        self._torn = False
+        self.metrics["segments_rotated"] += 1
+
+    def seal(self):
+        """Flush and rotate, returning the sealed segments this process owns"""
+        self._ensure_open()
+        self.wait(self._next_seq)
+        with self._io_lock:
+            self._rotate()
+            return [path for path in self._own_segments() if path != self._path]
+
+    def remove(self, segments):
+        """Delete sealed segments once their entries are safely in MongoDB"""
+        for path in segments:
+            self._owned.discard(path)
+            try:
+                os.remove(path)
+                self.metrics["segments_removed"] += 1
+            except FileNotFoundError:
+                pass
+
+    def adopt_orphans(self):
+        """Take ownership of segments left behind by processes that have exited"""
+        self._ensure_open()
+        orphans = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            if os.path.join(self.directory, name) in self._owned:
+                continue
+            pid = name.split('-', 1)[0]
+            # Our own pid here means a previous process that had the same pid
+            if not pid.isdigit() or (int(pid) != self._pid and _pid_alive(int(pid))):
+                continue
+            orphans.append(name)
+
+        adopted = []
+        for name in orphans:
+            with self._io_lock:
+                self._counter += 1
+                while os.path.exists(self._segment_path(self._counter)):
+                    self._counter += 1
+                target = self._segment_path(self._counter)
+                try:
+                    # rename is atomic, so only one surviving worker adopts a segment
+                    os.rename(os.path.join(self.directory, name), target)
+                except FileNotFoundError:
+                    continue
+                self._owned.add(target)
+            adopted.append(target)
+            self.metrics["segments_adopted"] += 1
+        return adopted
+
+    def replay(self, segments):
+        """Yield (kind, key, record) entries from segments in order"""
+        for path in segments:
+            try:
+                with open(path, 'rb') as f:
+                    for line in f:
+                        try:
+                            kind, key, record = json.loads(line)
+                        except ValueError:
+                            # A torn final write from a crash, skip it
+                            logger.warning(f"Skipping unreadable entry in fallback journal {path}")
+                            continue
+                        self.metrics["entries_replayed"] += 1
+                        yield kind, key, record
+            except FileNotFoundError:
+                continue
+
+    def close(self):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self._closed = True
+            self._committed.notify_all()
+        self._flusher.join()
+        self._file.close()
@@ -0,0 +1,263 @@
+"""
+Per-worker word leases.
+
+A worker reserves a block of a user's words with one guarded ledger debit
+and then serves that user's small debits from the block: each one is a
+single $inc of the lease's own word_leases document, instead of a guarded
+update of the user document plus a ledger entry. Unused words go back to
+the balance when the lease expires, the worker exits, or a debit the balance
+without them cannot cover needs them (reclaim_user).
+
+The document's remaining is what is left of the block, exactly: a debit
+is only served once its $inc matched the active lease. So a lease is
+returned in full whether its worker returns it or another worker reclaims
+it after the worker died, and no paid words are lost.
+
+Returns are credits with op id lease-return:<lease id>. The worker and a
+reclaimer first claim the lease document (active -> returning), which
+freezes remaining, so only one of them decides the amount, and whoever
+finishes the return cannot apply it twice.
+"""
+import os
+import uuid
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+import ledger
+
+
+class _Lease:
+    def __init__(self, lease_id, username, granted, base, expires_at):
+        self.id = lease_id
+        self.username = username
+        self.granted = granted
+        self.remaining = granted
+        # Balance outside the lease when it was granted, for reporting
+        self.base = base
+        self.expires_at = expires_at
+        self.lock = threading.Lock()
+
+
+class LeaseManager:
+    def __init__(self, block=500, ttl=60.0, grace=30.0):
+        self.block = block
+        self.ttl = ttl
+        self.grace = grace
+        self._lock = threading.Lock()
+        self._leases = {}
+        self._pid = os.getpid()
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.metrics = {
+            "local_debits": 0,
+            "direct_debits": 0,
+            "grants": 0,
+            "returns": 0,
+            "reclaims": 0,
+            "lost": 0
+        }
+
+    def _local(self):
+        if self._pid != os.getpid():
+            # Leases belong to the process that took them
+            self._leases = {}
+            self._pid = os.getpid()
+            self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        return self._leases
+
+    def _count(self, metric, n=1):
+        with self._lock:
+            self.metrics[metric] += n
+
+    def stats(self):
+        with self._lock:
+            return dict(self.metrics)
+
+    def local_remaining(self, username):
+        """Unused words this process holds for the user"""
+        lease = self._local().get(username)
+        return lease.remaining if lease is not None else 0
+
+    def credited(self, username, words):
+        """Account for a credit applied elsewhere in the reported balance"""
+        lease = self._local().get(username)
+        if lease is not None:
+            lease.base += words
+
+    def debit(self, db, username, words):
+        """
+        Serve a debit from a lease, returns (True, remaining).
+
+        Returns None when the debit should go to MongoDB directly: debits
+        of a block or more, balances too small to lease from, or a lease
+        lost to a reclaimer. The process's lease on the user is returned
+        first, so the direct debit sees the whole balance. A None result
+        has spent nothing.
+        """
+        if words >= self.block:
+            self.release(db, username)
+            self._count("direct_debits")
+            return None
+        leases = self._local()
+        lease = leases.get(username)
+        if lease is not None and (datetime.now() >= lease.expires_at or words > lease.remaining):
+            self.release(db, username)
+            lease = None
+        if lease is None:
+            lease = self._grant(db, username)
+            if lease is None:
+                self._count("direct_debits")
+                return None
+
+        with lease.lock:
+            usable = lease.remaining >= words and datetime.now() < lease.expires_at
+            if usable:
+                spent = db.word_leases.update_one(
+                    {"_id": lease.id, "state": "active", "remaining": {"$gte": words}},
+                    {"$inc": {"remaining": -words}}
+                )
+                if spent.matched_count:
+                    lease.remaining -= words
+                    self._count("local_debits")
+                    return True, lease.base + lease.remaining
+                lease.remaining = 0
+
+        if usable:
+            # Claimed by a reclaimer, which returned what was left
+            with self._lock:
+                if leases.get(username) is lease:
+                    del leases[username]
+            self._count("lost")
+        else:
+            # Spent or expired meanwhile by another thread
+            self.release(db, username)
+        self._count("direct_debits")
+        return None
+
+    def _grant(self, db, username):
+        lease_id = uuid.uuid4().hex
+        expires_at = datetime.now() + timedelta(seconds=self.ttl)
+        # The document goes first so a crash after the reservation still
+        # leaves something to reclaim; reclaim checks the reservation applied
+        db.word_leases.insert_one({
+            "_id": lease_id,
+            "username": username,
+            "worker": self.worker,
+            "granted": self.block,
+            "remaining": self.block,
+            "state": "active",
+            "created_at": datetime.now(),
+            "expires_at": expires_at
+        })
+        reserved = ledger.debit(db, username, self.block, f"lease:{lease_id}", "lease")
+        if not reserved or not reserved[0]:
+            db.word_leases.delete_one({"_id": lease_id})
+            return None
+
+        lease = _Lease(lease_id, username, self.block, reserved[1], expires_at)
+        with self._lock:
+            previous = self._local().get(username)
+            self._local()[username] = lease
+        if previous is not None:
+            # Another thread granted one meanwhile
+            self._return(db, previous)
+        self._count("grants")
+        return lease
+
+    def release(self, db, username):
+        """Return the unused part of this process's lease for a user, returns the words returned"""
+        with self._lock:
+            lease = self._local().pop(username, None)
+        if lease is None:
+            return 0
+        return self._return(db, lease)
+
+    def reclaim_user(self, db, username):
+        """
+        Return every lease on the user, this process's and other workers',
+        returns the words that went back to the balance.
+
+        For a direct debit the balance outside the leases could not cover.
+        Other workers find their lease claimed on their next debit and go
+        direct themselves.
+        """
+        returned = self.release(db, username)
+        for doc in db.word_leases.find({"username": username, "state": "active"}, {"_id": 1}):
+            # A lease whose block is not reserved yet holds back nothing
+            if not ledger.applied(db, username, f"lease:{doc['_id']}"):
+                continue
+            words = self._claim(db, doc["_id"], reclaimed=True)
+            if words is not None:
+                returned += words
+                self._count("reclaims")
+        return returned
+
+    def release_all(self, db):
+        """Return every lease this process holds, e.g. on shutdown"""
+        with self._lock:
+            leases = list(self._local().values())
+            self._leases = {}
+        for lease in leases:
+            self._return(db, lease)
+        return len(leases)
+
+    def release_expired(self, db):
+        now = datetime.now()
+        for username, lease in list(self._local().items()):
+            if now >= lease.expires_at:
+                self.release(db, username)
+
+    def _return(self, db, lease):
+        with lease.lock:
+            lease.remaining = 0
+        words = self._claim(db, lease.id)
+        if words is None:
+            return 0
+        self._count("returns")
+        return words
+
+    def _claim(self, db, lease_id, reserved=True, reclaimed=False):
+        """Claim an active lease and return what is left of it, returns the words or None if it was not active"""
+        update = {"state": "returning", "returning_at": datetime.now(), "reserved": reserved}
+        if reclaimed:
+            update["reclaimed"] = True
+        doc = db.word_leases.find_one_and_update(
+            {"_id": lease_id, "state": "active"},
+            {"$set": update},
+            projection={"username": 1, "remaining": 1, "reserved": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc is None:
+            return None
+        return self._finish_return(db, doc)
+
+    def _finish_return(self, db, doc):
+        # A lease whose block was never reserved has nothing to give back
+        words = doc.get("remaining", 0) if doc.get("reserved", True) else 0
+        if words > 0:
+            ledger.credit(db, doc["username"], words, f"lease-return:{doc['_id']}", "lease return")
+        db.word_leases.update_one(
+            {"_id": doc["_id"]},
+            {"$set": {"state": "returned", "returned_words": words, "returned_at": datetime.now()}}
+        )
+        return words
+
+    def reclaim_expired(self, db, limit=1000):
+        """Return leases left behind by dead workers, returns how many were reclaimed"""
+        cutoff = datetime.now() - timedelta(seconds=self.grace)
+        reclaimed = 0
+        for doc in db.word_leases.find({"state": "active", "expires_at": {"$lt": cutoff}}, {"username": 1}).limit(limit):
+            # The worker may have died before reserving anything
+            reserved = ledger.applied(db, doc["username"], f"lease:{doc['_id']}")
+            if self._claim(db, doc["_id"], reserved, reclaimed=True) is not None:
+                reclaimed += 1
+
+        # Returns interrupted after the claim; the credit is idempotent
+        for doc in db.word_leases.find({"state": "returning", "returning_at": {"$lt": cutoff}}).limit(limit):
+            self._finish_return(db, doc)
+            reclaimed += 1
+
+        self._count("reclaims", reclaimed)
+        return reclaimed
@@ -0,0 +1,243 @@
+"""
+Append-only ledger of word credits and debits.
+
+Every change to a balance is an immutable word_ledger entry whose _id is
+the operation id, so applying the same operation twice (a redelivered
+callback, a replay after an outage) records it once.
+
+The user document's words_remaining is the balance snapshot. Entries are
+folded into it either inline (credit, debit) or later by compact(), and a
+balance is the snapshot plus the small tail of entries not folded yet.
+
+Folding an entry $incs the snapshot and pushes the entry id onto the user's
+ledger_ops, guarded by ledger_ops not already holding it, then marks the
+entry folded. A fold interrupted between the two steps is finished by the
+next compaction without applying the entry twice. ledger_ops only keeps the
+last LEDGER_OP_WINDOW ids; it needs to cover the entries that are applied
+but not yet marked folded.
+
+Folding an entry whose reason is in USAGE_REASONS also counts it towards
+the user's monthly usage in the account summary (see summary.py).
+"""
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+LEDGER_OP_WINDOW = int(os.environ.get('WORD_LEDGER_OP_WINDOW', 500))
+# Entries are folded in batches well inside the window
+FOLD_BATCH_SIZE = min(200, LEDGER_OP_WINDOW // 2)
+
+_TAIL = {"folded": False}
+
+# Entries that are words spent: debits, lease reservations and the unused
+# part of a lease coming back
+USAGE_REASONS = frozenset({"debit", "lease", "lease return"})
+
+
+def new_op_id():
+    return uuid.uuid4().hex
+
+
+def _entry(op_id, username, delta, reason, folded):
+    return {
+        "_id": op_id,
+        "username": username,
+        "delta": delta,
+        "reason": reason,
+        "at": datetime.now(),
+        "folded": folded
+    }
+
+
+def _window(op_ids):
+    return {"$each": list(op_ids), "$slice": -LEDGER_OP_WINDOW}
+
+
+def usage_field(at):
+    return f"summary.usage.{at:%Y-%m}"
+
+
+def _fold_inc(entries):
+    """$inc folding entries into the snapshot and the monthly usage"""
+    inc = {"words_remaining": 0}
+    for e in entries:
+        inc["words_remaining"] += e["delta"]
+        if e.get("reason") in USAGE_REASONS:
+            field = usage_field(e["at"])
+            inc[field] = inc.get(field, 0) - e["delta"]
+    return inc
+
+
+def append(db, username, delta, op_id, reason, session=None):
+    """Record an entry without folding it, returns False if op_id was already recorded"""
+    result = db.word_ledger.update_one(
+        {"_id": op_id},
+        {"$setOnInsert": _entry(op_id, username, delta, reason, False)},
+        upsert=True,
+        session=session
+    )
+    return result.upserted_id is not None
+
+
+def tail(db, username, session=None):
+    """Get the user's unfolded entries, oldest first"""
+    query = dict(_TAIL, username=username)
+    return list(db.word_ledger.find(query, {"delta": 1}, session=session).sort("at", 1))
+
+
+def balance(db, username, session=None):
+    """Get the snapshot plus tail balance, or None if the user does not exist"""
+    # Tail first: an entry folded between the two reads is still in the tail
+    # read, and already in ledger_ops by the time the snapshot is read
+    entries = tail(db, username, session=session)
+    user = db.users.find_one(
+        {"username": username},
+        {"words_remaining": 1, "ledger_ops": 1, "_id": 0},
+        session=session
+    )
+    if user is None:
+        return None
+    return user.get("words_remaining", 0) + tail_delta(entries, user.get("ledger_ops", ()))
+
+
+def tail_delta(entries, ledger_ops):
+    """Sum the tail entries that are not already in the snapshot"""
+    folded = set(ledger_ops)
+    return sum(e["delta"] for e in entries if e["_id"] not in folded)
+
+
+def credit(db, username, words, op_id, reason, set_fields=None, session=None):
+    """
+    Record and fold a credit, returns the new snapshot balance.
+
+    Returns None if the user does not exist, and drops the entry so it is
+    not left behind unapplied. A repeated op_id is not credited again and
+    returns the current balance.
+    """
+    if not append(db, username, words, op_id, reason, session=session):
+        existing = db.word_ledger.find_one({"_id": op_id}, {"folded": 1}, session=session)
+        if existing and existing.get("folded"):
+            return balance(db, username, session=session)
+    update = {
+        "$inc": _fold_inc([{"delta": words, "reason": reason, "at": datetime.now()}]),
+        "$push": {"ledger_ops": _window([op_id])}
+    }
+    if set_fields:
+        update["$set"] = set_fields
+    user = db.users.find_one_and_update(
+        {"username": username, "ledger_ops": {"$ne": op_id}},
+        update,
+        projection={"words_remaining": 1, "_id": 0},
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    # Not matched: applied by an earlier attempt, or there is no such user
+    if user is None and db.users.find_one({"username": username, "ledger_ops": op_id}, {"_id": 1}, session=session) is None:
+        db.word_ledger.delete_one({"_id": op_id, "folded": False}, session=session)
+        return None
+    db.word_ledger.update_one({"_id": op_id}, {"$set": {"folded": True}}, session=session)
+    if user is None:
+        return balance(db, username, session=session)
+    return user.get("words_remaining", 0)
+
+
+def debit(db, username, words, op_id, reason):
+    """
+    Debit the balance if it covers words, returns (success, remaining).
+
+    Returns None if the user does not exist. Unfolded credits are folded
+    before a debit is refused. The debit is applied before its entry is
+    written, so a crash in between loses the audit entry but never the
+    balance check.
+    """
+    for attempt in range(2):
+        user = db.users.find_one_and_update(
+            {"username": username, "words_remaining": {"$gte": words}, "ledger_ops": {"$ne": op_id}},
+            {"$inc": _fold_inc([{"delta": -words, "reason": reason, "at": datetime.now()}]), "$push": {"ledger_ops": _window([op_id])}},
+            projection={"words_remaining": 1, "_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if user is not None:
+            db.word_ledger.update_one(
+                {"_id": op_id},
+                {"$setOnInsert": _entry(op_id, username, -words, reason, True)},
+                upsert=True
+            )
+            return True, user.get("words_remaining", 0)
+        if attempt or not fold_user(db, username):
+            break
+
+    current = balance(db, username)
+    if current is None:
+        return None
+    # A replayed debit that was already applied, also if its entry was never written
+    if applied(db, username, op_id):
+        return True, current
+    return False, current
+
+
+def applied(db, username, op_id):
+    """Check whether an operation reached the user's balance"""
+    if db.word_ledger.find_one({"_id": op_id, "folded": True}, {"_id": 1}):
+        return True
+    # Applied but its entry not written or marked yet
+    return db.users.find_one({"username": username, "ledger_ops": op_id}, {"_id": 1}) is not None
+
+
+def fold_user(db, username, before=None):
+    """
+    Fold the user's tail (entries older than before) into the snapshot,
+    returns entries folded.
+
+    Entries are only marked folded once they are in the user's ledger_ops,
+    so a missing user's entries stay in the tail.
+    """
+    query = dict(_TAIL, username=username)
+    if before is not None:
+        query["at"] = {"$lt": before}
+
+    folded = 0
+    while True:
+        entries = list(db.word_ledger.find(query, {"delta": 1, "reason": 1, "at": 1}).sort("at", 1).limit(FOLD_BATCH_SIZE))
+        if not entries:
+            return folded
+        op_ids = [e["_id"] for e in entries]
+        result = db.users.update_one(
+            {"username": username, "ledger_ops": {"$nin": op_ids}},
+            {"$inc": _fold_inc(entries), "$push": {"ledger_ops": _window(op_ids)}}
+        )
+        if result.matched_count == 0:
+            # Some were applied by an interrupted fold or another compactor
+            for e in entries:
+                db.users.update_one(
+                    {"username": username, "ledger_ops": {"$ne": e["_id"]}},
+                    {"$inc": _fold_inc([e]), "$push": {"ledger_ops": _window([e["_id"]])}}
+                )
+            user = db.users.find_one({"username": username}, {"ledger_ops": 1, "_id": 0})
+            in_snapshot = set(user.get("ledger_ops", ())) if user else set()
+            applied_ids = [op_id for op_id in op_ids if op_id in in_snapshot]
+        else:
+            applied_ids = op_ids
+        if applied_ids:
+            db.word_ledger.update_many({"_id": {"$in": applied_ids}}, {"$set": {"folded": True}})
+        folded += len(applied_ids)
+        if len(applied_ids) < len(op_ids):
+            # No such user; the next batch would be the same entries
+            return folded
+
+
+def compact(db, grace_seconds=60, max_users=1000):
+    """Fold tails older than grace_seconds for up to max_users users, returns (users, entries)"""
+    before = datetime.now() - timedelta(seconds=grace_seconds)
+    usernames = db.word_ledger.distinct("username", dict(_TAIL, at={"$lt": before}))[:max_users]
+    entries = 0
+    for username in usernames:
+        entries += fold_user(db, username, before)
+    return len(usernames), entries
+
+
+def history(db, username, limit=50):
+    """Get the user's most recent ledger entries"""
+    return list(db.word_ledger.find({"username": username}).sort("at", -1).limit(limit))
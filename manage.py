@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands run against the MongoDB named by MONGO_URI.
+
+    python manage.py ensure-indexes    # apply indexes.py, once per deploy
+    python manage.py migrate-tiers     # indexes, then archive the backlog
+    python manage.py archive           # one archiving pass, e.g. from cron
+    python manage.py build-user-snapshot
+    python manage.py rebuild-summaries # backfill or repair account summaries
+"""
+import os
+import sys
+import time
+import argparse
+
+from dotenv import load_dotenv
+from pymongo.errors import PyMongoError
+
+load_dotenv()
+
+import models
+import archive
+import indexes
+import snapshot
+import summary
+
+
+def connect():
+    if not os.environ.get('MONGO_URI'):
+        sys.exit("MONGO_URI is not set; name the database to run against, e.g.\n"
+                 "    MONGO_URI=mongodb://localhost:27017/lipia python manage.py ensure-indexes")
+    client = models.create_mongo_client(models.resolve_mongo_uri())
+    try:
+        client.get_database().command('ping')
+    except PyMongoError as e:
+        sys.exit(f"Could not reach MongoDB at MONGO_URI: {e}")
+    models._set_client(client)
+    return models.get_db()
+
+
+def _report(name, moved):
+    print(f"  {name}: {moved} archived", flush=True)
+
+
+def ensure_indexes(db, args):
+    """Create or update the indexes in indexes.py"""
+    applied = indexes.apply(db, drop_unknown=args.drop_unknown, log=print)
+    print(f"{len(applied['created'])} created, {len(applied['updated'])} updated, "
+          f"{len(applied['unknown']) + len(applied['dropped'])} not in the spec"
+          f"{' (dropped)' if args.drop_unknown else ''}, {len(applied['conflicts'])} conflicts")
+    return 1 if applied['conflicts'] else 0
+
+
+def run_archive(db, args):
+    """Move old final transactions and payments to the archive tier"""
+    started = time.time()
+    skipped = {}
+    moved = archive.archive(
+        db,
+        older_than_days=args.older_than_days,
+        batch_size=args.batch_size,
+        max_batches=args.max_batches,
+        progress=_report if args.verbose else None,
+        skipped=skipped
+    )
+    print(f"Archived {moved['transactions']} transactions and {moved['payments']} payments "
+          f"in {time.time() - started:.1f}s")
+    for name, ids in skipped.items():
+        if ids:
+            print(f"  {name}: {len(ids)} could not be archived and stay hot: {', '.join(sorted(map(str, ids))[:10])}")
+    return 1 if any(skipped.values()) else 0
+
+
+def migrate_tiers(db, args):
+    """Set up the hot/cold tiers on an existing database"""
+    args.drop_unknown = False
+    if ensure_indexes(db, args):
+        return 1
+    stamped = archive.stamp_missing_timestamps(db)
+    print(f"Stamped {stamped['transactions']} transactions and {stamped['payments']} payments without a timestamp")
+    return run_archive(db, args)
+
+
+def build_user_snapshot(db, args):
+    """Write the users snapshot the fallback tier reads when MongoDB is down"""
+    started = time.time()
+    built = snapshot.build(db, args.path)
+    if built is None:
+        print("Another process is building the snapshot")
+        return 1
+    print(f"Wrote {built[0]} users to {args.path} ({built[1]} skipped) in {time.time() - started:.1f}s")
+    return 0
+
+
+def rebuild_summaries(db, args):
+    """Rebuild the account summaries embedded in user documents"""
+    started = time.time()
+    counts = summary.rebuild(db, usernames=args.user or None, batch_size=args.batch_size,
+                             log=print if args.verbose else None)
+    print(f"{counts['rebuilt']} of {counts['users']} summaries rebuilt, {counts['unchanged']} unchanged, "
+          f"{counts['raced']} changed while rebuilding (run again) in {time.time() - started:.1f}s")
+    return 0
+
+
+def _archive_arguments(sub):
+    sub.add_argument('--older-than-days', type=float, default=archive.ARCHIVE_AFTER_DAYS)
+    sub.add_argument('--batch-size', type=int, default=archive.ARCHIVE_BATCH_SIZE)
+    sub.add_argument('--max-batches', type=int, default=None, help='per collection')
+    sub.add_argument('-v', '--verbose', action='store_true')
+
+
+def _index_arguments(sub):
+    sub.add_argument('--drop-unknown', action='store_true', help='drop indexes that are not in the spec')
+
+
+def _snapshot_arguments(sub):
+    sub.add_argument('--path', default=models.USER_SNAPSHOT_PATH)
+
+
+def _summary_arguments(sub):
+    sub.add_argument('--user', action='append', help='only this user (repeatable)')
+    sub.add_argument('--batch-size', type=int, default=500)
+    sub.add_argument('-v', '--verbose', action='store_true')
+
+
+COMMANDS = {
+    'ensure-indexes': (ensure_indexes, _index_arguments),
+    'migrate-tiers': (migrate_tiers, _archive_arguments),
+    'archive': (run_archive, _archive_arguments),
+    'build-user-snapshot': (build_user_snapshot, _snapshot_arguments),
+    'rebuild-summaries': (rebuild_summaries, _summary_arguments),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, (command, add_arguments) in COMMANDS.items():
+        add_arguments(subparsers.add_parser(name, help=command.__doc__.strip()))
+    args = parser.parse_args(argv)
+    return COMMANDS[args.command][0](connect(), args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,192 +1,713 @@
+from flask import g, current_app, has_request_context
 from flask_pymongo import PyMongo
 import pymongo
-from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError, OperationFailure, AutoReconnect
-from pymongo import MongoClient
+from pymongo import monitoring
+from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError, OperationFailure, AutoReconnect, BulkWriteError, DuplicateKeyError, ConfigurationError
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from bson import ObjectId
 from datetime import datetime
+import base64
+import itertools
+import json
 import logging
 import time
 import threading
+import atexit
 import os
+from store import UserStore, TransactionStore, SQLiteFallbackDB, SQLiteUserStore, SQLiteTransactionStore
+from journal import Journal
+from cache import TTLCache, IdentityMap, SingleFlight
+from breaker import CircuitBreaker, CLOSED, is_retryable_error
+import ledger
+import archive
+import snapshot
+import summary
+from leases import LeaseManager
 
 # MongoDB connection
 mongo = PyMongo()
 mongo_connected = False
 mongo_client = None
-mongo_retry_thread = None
 
-# Fallback in-memory database (only used when MongoDB is unavailable)
-users_db = {}
-transactions_db = []
+# Connection pool settings for each worker's client
+MONGO_POOL_OPTIONS = {
+    'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 20)),
+    'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', 2)),
+    'maxIdleTimeMS': int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 300000))
+}
 
-def retry_mongo_connection(app):
-    """Background thread to retry MongoDB connection"""
-    global mongo_connected, mongo_client
+# pid that created mongo_client; a client inherited through fork is not reused
+_client_pid = None
+_handles = None
+
+class MongoHandles:
+    """Database and collection handles cached for one MongoClient"""
+    def __init__(self, client):
+        self.client = client
+        self.db = client.get_database()
+        self._collections = {}
+        self._supports_transactions = None
+    
+    @property
+    def supports_transactions(self):
+        """Whether the deployment is a replica set or sharded cluster"""
+        if self._supports_transactions is None:
+            hello = self.db.command('hello')
+            self._supports_transactions = 'setName' in hello or hello.get('msg') == 'isdbgrid'
+        return self._supports_transactions
+    
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = self.db[name]
+        return collection
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+    
+    def command(self, *args, **kwargs):
+        return self.db.command(*args, **kwargs)
+
+# Send X-Mongo-Ops (commands sent while handling the request) on every
+# response; it is always sent in debug mode
+MONGO_OPS_HEADER = os.environ.get('MONGO_OPS_HEADER', 'false').lower() == 'true'
+
+class RequestOpCounter(monitoring.CommandListener):
+    """Counts the commands each request sends; listeners run on the calling thread"""
+    def started(self, event):
+        if has_request_context():
+            g.mongo_ops = g.get('mongo_ops', 0) + 1
+    
+    def succeeded(self, event):
+        pass
+    
+    def failed(self, event):
+        pass
+
+request_op_counter = RequestOpCounter()
+
+def resolve_mongo_uri(mongo_uri=None):
+    """
+    Get the MongoDB URI, the one given or else MONGO_URI, making sure it
+    names the database. Returns None when neither is set.
+    """
+    mongo_uri = mongo_uri or os.environ.get('MONGO_URI')
+    if not mongo_uri:
+        return None
+    dbname = os.environ.get('MONGO_DBNAME', 'lipia')
+    
+    # Ensure the URI has the database name
+    if f'/{dbname}' not in mongo_uri and '?' in mongo_uri:
+        mongo_uri = mongo_uri.replace('?', f'/{dbname}?')
+    elif f'/{dbname}' not in mongo_uri:
+        mongo_uri = f"{mongo_uri}/{dbname}"
+    return mongo_uri
+
+def create_mongo_client(mongo_uri):
+    """Create a pooled MongoDB client with proper timeouts"""
+    timeout = int(os.environ.get('MONGO_TIMEOUT', 15))
+    return MongoClient(
+        mongo_uri,
+        serverSelectionTimeoutMS=timeout * 1000,
+        connectTimeoutMS=timeout * 1000,
+        socketTimeoutMS=timeout * 2000,
+        event_listeners=[request_op_counter],
+        **MONGO_POOL_OPTIONS
+    )
+
+def _set_client(client):
+    """Make client this process's MongoDB client"""
+    global mongo_client, _client_pid, _handles
+    mongo_client = client
+    _client_pid = os.getpid()
+    _handles = MongoHandles(client) if client is not None else None
+
+def get_db():
+    """Get cached database and collection handles for this process's client"""
+    if _client_pid != os.getpid():
+        # Inherited from the parent through fork - PyMongo clients are not
+        # fork-safe, so open this worker's own (normally done in post_fork)
+        logging.warning("MongoDB client was created before fork, reconnecting in worker")
+        _set_client(create_mongo_client(_configured_mongo_uri()))
+    return _handles
+
+def _configured_mongo_uri():
+    """The URI init_mongo connected with, else MONGO_URI; ConfigurationError if there is none"""
+    mongo_uri = resolve_mongo_uri(_mongo_app.config.get('MONGO_URI') if _mongo_app is not None else None)
+    if mongo_uri is None:
+        raise ConfigurationError("No MongoDB URI is configured, set MONGO_URI")
+    return mongo_uri
+
+def prewarm_pool(client, connections):
+    """Open pool connections up front so no request pays for a TCP/TLS handshake"""
+    db = client.get_database()
+    # Concurrent pings each check out their own connection
+    threads = [threading.Thread(target=db.command, args=('ping',), daemon=True) for _ in range(connections)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def init_worker_mongo():
+    """Connect this worker's MongoDB client and warm its pool (gunicorn post_fork)"""
+    global mongo_connected
     
-    retry_delay = int(os.environ.get('MONGO_RETRY_DELAY', 10))
+    mongo_uri = os.environ.get('MONGO_URI')
+    if not mongo_uri:
+        return False
     
-    while not mongo_connected:
+    try:
+        client = create_mongo_client(resolve_mongo_uri(mongo_uri))
+        client.get_database().command('ping')
+        prewarm_pool(client, MONGO_POOL_OPTIONS['minPoolSize'])
+        _set_client(client)
+        mongo_connected = True
+        mongo_breaker.reset()
+        logging.info(f"MongoDB client ready in worker {os.getpid()} with {MONGO_POOL_OPTIONS['minPoolSize']} warm connections")
+        return True
+    except Exception as e:
+        logging.warning(f"MongoDB connection failed in worker {os.getpid()}: {e}")
+        mongo_connected = False
+        return False
+
+def _create_fallback_stores():
+    """Create the fallback tier selected by FALLBACK_STORE (sqlite or memory)"""
+    if os.environ.get('FALLBACK_STORE', 'sqlite').lower() == 'sqlite':
+        path = os.environ.get('FALLBACK_STORE_PATH', 'fallback_store.db')
         try:
-            app.logger.info("Attempting to reconnect to MongoDB Atlas...")
-            
-            # Get connection URI (MongoDB Atlas)
-            mongo_uri = app.config.get('MONGO_URI')
-            timeout = int(os.environ.get('MONGO_TIMEOUT', 15))
-            
-            app.logger.info(f"Trying MongoDB Atlas connection...")
-            
-            # Create MongoDB connection options
-            mongo_options = {
-                'serverSelectionTimeoutMS': timeout * 1000,
-                'connectTimeoutMS': timeout * 1000,
-                'socketTimeoutMS': timeout * 2000
-            }
-            
-            # Close previous client if it exists
-            if mongo_client:
-                try:
-                    mongo_client.close()
-                except:
-                    pass
-            
-            # Try to connect with these settings
-            try:
-                # Create a new client with proper timeouts
-                mongo_client = MongoClient(
-                    mongo_uri,
-                    **mongo_options
-                )
-                
-                # Test connection with ping
-                db = mongo_client.get_database()
-                db.command('ping')
-                
-                mongo_connected = True
-                app.logger.info(f"Successfully connected to MongoDB Atlas!")
-                
-                # Create indexes when connected
-                try:
-                    db.users.create_index("username", unique=True)
-                    db.payments.create_index("checkout_id", unique=True)
-                    db.transactions.create_index([("username", 1), ("timestamp", -1)])
-                    app.logger.info("MongoDB indexes created successfully")
-                except Exception as e:
-                    app.logger.error(f"Error creating MongoDB indexes: {e}")
-                    
-                # Sync in-memory data to MongoDB
-                sync_memory_to_mongo(app)
-                
-                # We've successfully connected
-                break
-                
-            except Exception as e:
-                app.logger.warning(f"MongoDB Atlas connection failed: {str(e)}")
-                mongo_connected = False
-            
-            # If we're not connected, wait and retry
-            if not mongo_connected:
-                app.logger.warning(f"MongoDB Atlas connection failed, retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-                
+            # Shared by every worker on the host
+            fallback_db = SQLiteFallbackDB(path)
+            return SQLiteUserStore(fallback_db), SQLiteTransactionStore(fallback_db)
         except Exception as e:
-            app.logger.error(f"Unexpected error in MongoDB reconnection thread: {str(e)}")
-            time.sleep(retry_delay)
+            logging.error(f"Could not open SQLite fallback store at {path}, using per-worker memory: {e}")
+    return UserStore(), TransactionStore()
+
+# Fallback database (only used when MongoDB is unavailable)
+users_db, transactions_db = _create_fallback_stores()
+
+# Memory-mapped snapshot of users' auth and balance fields, so the fallback
+# tier knows existing users when MongoDB is down at boot (see _fallback_user)
+USER_SNAPSHOT_PATH = os.environ.get('USER_SNAPSHOT_PATH', 'users_snapshot.bin')
+USER_SNAPSHOT_INTERVAL = int(os.environ.get('USER_SNAPSHOT_INTERVAL', 900))
+user_snapshot = snapshot.UserSnapshot(USER_SNAPSHOT_PATH)
+user_snapshot_thread = None
+
+# On-disk journal of fallback writes not yet in MongoDB (see init_fallback_journal)
+fallback_journal = None
+
+# Read-through cache of MongoDB user documents, invalidated by local writes
+USER_CACHE_ENABLED = os.environ.get('USER_CACHE_ENABLED', 'true').lower() == 'true'
+user_cache = TTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 10))
+)
+
+# Concurrent lookups of the same user or transaction in this process share
+# one MongoDB read (see _single_flight)
+SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED', 'true').lower() == 'true'
+lookups = SingleFlight()
+
+def _single_flight(key, fetch):
+    return lookups.do(key, fetch) if SINGLE_FLIGHT_ENABLED else fetch()
+
+# Field presets for get_user on hot read paths, so callers do not pull the
+# whole user document when they need a few fields
+USER_PROJECTIONS = {
+    # Credential check plus the account fields login returns
+    "auth": ("username", "pin", "words_remaining", "phone_number", "plan", "payment_status"),
+    "balance": ("username", "words_remaining", "plan", "payment_status"),
+    "profile": ("username", "words_remaining", "phone_number", "plan", "payment_status", "api_keys"),
+    "payment": ("username", "phone_number", "plan", "payment_status"),
+    # The account view: one read, with the embedded summary (see summary.py)
+    "account": ("username", "words_remaining", "plan", "payment_status", "summary")
+}
+
+# Payment history pagination (see get_user_payments_page)
+PAYMENT_HISTORY_PAGE_SIZE = int(os.environ.get('PAYMENT_HISTORY_PAGE_SIZE', 20))
+PAYMENT_HISTORY_MAX_PAGE_SIZE = 100
+PAYMENT_HISTORY_SORT = [("timestamp", -1), ("_id", -1)]
+
+# Payment status -> statuses a payment may move to it from. A payment is
+# created pending (or already settled, for free and manual payments) and
+# settles exactly once; repeating the current status is a no-op.
+PAYMENT_TRANSITIONS = {
+    "pending": ("pending",),
+    "completed": ("pending", "completed"),
+    "cancelled": ("pending", "cancelled"),
+    "failed": ("pending", "failed")
+}
+
+# Settle payments in a multi-document transaction when the deployment
+# supports them, otherwise as a short ordered batch (see settle_payment)
+SETTLE_WITH_TRANSACTION = os.environ.get('MONGO_SETTLE_WITH_TRANSACTION', 'true').lower() == 'true'
+
+def subscription_words(subscription_type):
+    """Words a completed payment for a subscription type credits"""
+    return 100 if subscription_type == 'basic' else 1000
+
+# Balances are kept through the append-only word ledger (see ledger.py); false
+# goes back to bare conditional updates of words_remaining with no audit trail
+WORD_LEDGER_ENABLED = os.environ.get('WORD_LEDGER_ENABLED', 'true').lower() == 'true'
+WORD_LEDGER_COMPACT_INTERVAL = float(os.environ.get('WORD_LEDGER_COMPACT_INTERVAL', 60))
+WORD_LEDGER_COMPACT_GRACE = float(os.environ.get('WORD_LEDGER_COMPACT_GRACE', 60))
+ledger_compactor_thread = None
+
+# Optional per-worker word leases serving small debits from a reserved block (see leases.py)
+WORD_LEASES_ENABLED = os.environ.get('WORD_LEASES_ENABLED', 'false').lower() == 'true'
+word_leases = LeaseManager(
+    block=int(os.environ.get('WORD_LEASE_BLOCK', 500)),
+    ttl=float(os.environ.get('WORD_LEASE_TTL', 60)),
+    grace=float(os.environ.get('WORD_LEASE_GRACE', 30))
+)
+lease_maintenance_thread = None
+
+# Moving old final transactions/payments to the archive tier (0 disables)
+ARCHIVE_INTERVAL = int(os.environ.get('ARCHIVE_INTERVAL', 3600))
+archiver_thread = None
+
+# Progress of memory-to-MongoDB syncs (see get_sync_metrics)
+sync_metrics = {
+    "runs": 0,
+    "users_synced": 0,
+    "transactions_synced": 0,
+    "batches": 0,
+    "errors": 0,
+    "last_duration_ms": None,
+    "last_synced_at": None,
+    "pruned": 0
+}
+
+def _probe_mongo():
+    """Breaker probe: ping MongoDB, opening a client first if this process has none"""
+    if mongo_client is None or _client_pid != os.getpid():
+        _set_client(create_mongo_client(_configured_mongo_uri()))
+    
+    # The client reconnects on its own, so a ping through it is the whole test
+    db = get_db()
+    db.command('ping')
+    prewarm_pool(mongo_client, MONGO_POOL_OPTIONS['minPoolSize'])
+    return True
+
+def _on_breaker_state(state):
+    """Route requests by breaker state and push fallback writes once MongoDB is back"""
+    global mongo_connected
+    
+    mongo_connected = state == CLOSED
+    if mongo_connected and _mongo_app is not None:
+        _mongo_app.logger.info("MongoDB is reachable again, syncing fallback writes")
+        sync_memory_to_mongo(_mongo_app)
+
+# App whose config and logger the breaker supervisor uses (set by init_mongo)
+_mongo_app = None
+
+# Opens after repeated connectivity failures and probes MongoDB in the
+# background until it answers again
+mongo_breaker = CircuitBreaker(
+    probe=_probe_mongo,
+    on_state_change=_on_breaker_state,
+    failure_threshold=int(os.environ.get('MONGO_BREAKER_THRESHOLD', 3)),
+    failure_window=float(os.environ.get('MONGO_BREAKER_WINDOW', 30)),
+    open_timeout=float(os.environ.get('MONGO_RETRY_DELAY', 10)),
+    max_open_timeout=float(os.environ.get('MONGO_BREAKER_MAX_BACKOFF', 60))
+)
+
+def _handle_mongo_error(operation, error):
+    """Log a failed MongoDB operation; only connectivity errors count against the breaker"""
+    if is_retryable_error(error):
+        logging.warning(f"MongoDB unavailable in {operation}: {error}")
+        mongo_breaker.record_failure(error)
+    else:
+        # Duplicate keys, validation errors and bugs say nothing about the server
+        logging.error(f"MongoDB error in {operation}: {error}")
+
+def get_breaker_metrics():
+    """Get MongoDB circuit breaker state, transition counts and time in each state"""
+    return mongo_breaker.metrics()
+
+def _user_sync_ops(username, user_data):
+    """Build the upsert that writes one fallback user to MongoDB"""
+    fields = {
+        "plan": user_data.get("plan", "Free"),
+        "payment_status": user_data.get("payment_status", "Pending")
+    }
+    # Users loaded from the snapshot have no api_keys to write back
+    if "api_keys" in user_data:
+        fields["api_keys"] = user_data["api_keys"]
+    query = {"username": username}
+    update = {
+        "$set": fields,
+        "$setOnInsert": {
+            "pin": user_data.get("password"),
+            "phone_number": user_data.get("phone_number", "0712345678"),
+            "created_at": datetime.now()
+        }
+    }
+    
+    pin = user_data.get("words_sync")
+    if "words_synced" not in user_data:
+        # Recorded before balance changes were tracked as deltas
+        fields["words_remaining"] = user_data.get("words_remaining", 0)
+    elif pin:
+        # The local balance change goes in as an increment on whatever MongoDB
+        # holds now, once: after it is applied the query no longer matches and
+        # the upsert fails on the duplicate username, which counts as synced
+        query["ledger_ops"] = {"$ne": pin["op"]}
+        update["$inc"] = {"words_remaining": pin["delta"]}
+        update["$push"] = {"ledger_ops": {"$each": [pin["op"]], "$slice": -ledger.LEDGER_OP_WINDOW}}
+    else:
+        update["$setOnInsert"]["words_remaining"] = user_data.get("words_remaining", 0)
+    return [("users", UpdateOne(query, update, upsert=True))]
+
+def _pin_user_balance_changes():
+    """Give each dirty user's unsynced balance change an op id, kept until MongoDB has it"""
+    for username, _ in users_db.changes.take_dirty():
+        users_db.pin_words_sync(username, f"fallback:{ledger.new_op_id()}")
+
+def _user_synced(username, user_data):
+    pin = user_data.get("words_sync")
+    if pin:
+        users_db.settle_words_sync(username, pin["op"])
+
+def _transaction_sync_ops(transaction_id, transaction):
+    """Build the upserts that write one fallback transaction and its payment"""
+    status_fields = {
+        "status": transaction.get('status'),
+        "reference": transaction.get('reference', 'N/A')
+    }
+    return [
+        ("transactions", UpdateOne(
+            {"_id": transaction_id},
+            {
+                "$set": status_fields,
+                "$setOnInsert": {
+                    "username": transaction.get('user_id'),
+                    "amount": transaction.get('amount'),
+                    "phone": transaction.get('phone_number'),
+                    "subscription_type": transaction.get('subscription_type', "unknown"),
+                    "timestamp": datetime.utcnow()
+                }
+            },
+            upsert=True
+        )),
+        ("payments", UpdateOne(
+            # Never move a payment MongoDB already settled back
+            {"checkout_id": transaction_id, "status": {"$in": list(PAYMENT_TRANSITIONS.get(transaction.get('status'), ()))}},
+            {
+                "$set": status_fields,
+                "$setOnInsert": {
+                    "username": transaction.get('user_id'),
+                    "amount": transaction.get('amount'),
+                    "subscription_type": transaction.get('subscription_type', "unknown"),
+                    "timestamp": datetime.utcnow()
+                }
+            },
+            upsert=True
+        ))
+    ]
+
+def _bulk_sync(app, db, store, build_ops, kind, batch_size, on_synced=None):
+    """Push a store's dirty records in unordered bulk_write batches, calling on_synced(key, record) for each one written"""
+    dirty = store.changes.take_dirty()
+    synced = 0
+    
+    for start in range(0, len(dirty), batch_size):
+        batch = dirty[start:start + batch_size]
+        
+        # Group ops per collection, remembering which batch entry each came from
+        requests = {}
+        records = {}
+        for index, (key, _) in enumerate(batch):
+            record = store.get(key)
+            if record is None:
+                continue
+            records[index] = record
+            for collection, op in build_ops(key, record):
+                ops, owners = requests.setdefault(collection, ([], []))
+                ops.append(op)
+                owners.append(index)
+        
+        failed = set()
+        for collection, (ops, owners) in requests.items():
+            try:
+                db[collection].bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                # A duplicate key is a guarded upsert MongoDB rejected (a payment
+                # transition, or a balance change it already has); it is settled
+                # there and must not be retried
+                write_errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != 11000]
+                failed.update(owners[error['index']] for error in write_errors)
+                if write_errors:
+                    app.logger.error(f"{len(write_errors)} {kind} failed to sync to MongoDB: {write_errors[:3]}")
+        
+        # Records with a failed op stay dirty for the next sync
+        clean = [pair for index, pair in enumerate(batch) if index not in failed]
+        if on_synced is not None:
+            for index, record in records.items():
+                if index not in failed:
+                    on_synced(batch[index][0], record)
+        store.changes.mark_clean(clean)
+        synced += len(clean)
+        sync_metrics["batches"] += 1
+        sync_metrics["errors"] += len(failed)
+        app.logger.info(f"Synced {synced}/{len(dirty)} dirty {kind} to MongoDB")
+    
+    return synced
+
+def init_fallback_journal(app):
+    """Open the fallback write journal and replay what earlier processes left behind"""
+    global fallback_journal
+    
+    if os.environ.get('FALLBACK_JOURNAL_ENABLED', 'true').lower() != 'true':
+        return None
+    
+    # The SQLite fallback store is durable and shared on its own
+    if not isinstance(users_db, UserStore):
+        return None
+    
+    if fallback_journal is None:
+        try:
+            fallback_journal = Journal(
+                os.environ.get('FALLBACK_JOURNAL_DIR', 'fallback_journal'),
+                segment_bytes=int(os.environ.get('FALLBACK_JOURNAL_SEGMENT_MB', 64)) * 1024 * 1024,
+                commit_interval=int(os.environ.get('FALLBACK_JOURNAL_COMMIT_MS', 2)) / 1000.0
+            )
+        except OSError as e:
+            app.logger.error(f"Could not open fallback journal, fallback writes will not be durable: {e}")
+            return None
+        users_db.changes.journal = fallback_journal
+        transactions_db.changes.journal = fallback_journal
+    
+    replay_fallback_journal(app)
+    return fallback_journal
+
+def replay_fallback_journal(app):
+    """Adopt journal segments of exited workers and load them into the in-memory database"""
+    if fallback_journal is None:
+        return 0
+    
+    started = time.time()
+    replayed = 0
+    segments = fallback_journal.adopt_orphans()
+    for kind, key, record in fallback_journal.replay(segments):
+        if kind == 'user':
+            users_db.restore(key, record)
+        elif kind == 'transaction':
+            transactions_db.restore(key, record)
+        replayed += 1
+    
+    if replayed:
+        app.logger.info(f"Replayed {replayed} fallback journal entries from {len(segments)} segments in {time.time() - started:.2f}s")
+    return replayed
+
+def _checkpoint_fallback_journal(sealed):
+    """Drop synced journal segments, re-journaling anything still unsynced first"""
+    last_seq = None
+    for store in (users_db, transactions_db):
+        for key, _ in store.changes.take_dirty():
+            record = store.get(key)
+            if record is not None:
+                last_seq = fallback_journal.append(store.changes.kind, key, record)
+    if last_seq is not None:
+        fallback_journal.wait(last_seq)
+    fallback_journal.remove(sealed)
+
+def get_single_flight_stats():
+    return dict(lookups.stats(), enabled=SINGLE_FLIGHT_ENABLED)
+
+def get_user_cache_stats():
+    """Get user cache hit/miss counters"""
+    return dict(user_cache.stats(), enabled=USER_CACHE_ENABLED)
+
+def get_sync_metrics():
+    """Get memory-to-MongoDB sync progress metrics"""
+    return dict(
+        sync_metrics,
+        dirty_users=users_db.changes.dirty_count(),
+        dirty_transactions=transactions_db.changes.dirty_count(),
+        journal=dict(fallback_journal.metrics) if fallback_journal is not None else None
+    )
 
 def sync_memory_to_mongo(app):
-    """Sync in-memory database to MongoDB when connection is restored"""
-    global mongo_client
+    """Sync records changed in the in-memory database to MongoDB when connection is restored"""
+    global mongo_connected, mongo_client
     
     if not mongo_client or not mongo_connected:
         app.logger.error("Cannot sync to MongoDB: No client available or not connected")
         return
-        
+    
+    batch_size = int(os.environ.get('MONGO_SYNC_BATCH_SIZE', 500))
+    started = time.time()
+    
     try:
-        db = mongo_client.get_database()
+        db = get_db()
         
-        # Sync users
-        for username, user_data in users_db.items():
-            try:
-                # Check if user exists in MongoDB
-                if db.users.count_documents({"username": username}) == 0:
-                    # Create user in MongoDB
-                    mongo_user = {
-                        "username": username,
-                        "pin": user_data.get("password"),
-                        "words_remaining": user_data.get("words_remaining", 0),
-                        "phone_number": user_data.get("phone_number", "0712345678"),
-                        "created_at": datetime.now(),
-                        "plan": user_data.get("plan", "Free"),
-                        "payment_status": user_data.get("payment_status", "Pending"),
-                        "api_keys": user_data.get("api_keys", {})
-                    }
-                    db.users.insert_one(mongo_user)
-                    app.logger.info(f"Synced user {username} to MongoDB")
-                else:
-                    # Update user in MongoDB
-                    db.users.update_one(
-                        {"username": username},
-                        {"$set": {
-                            "words_remaining": user_data.get("words_remaining", 0),
-                            "plan": user_data.get("plan", "Free"),
-                            "payment_status": user_data.get("payment_status", "Pending"),
-                            "api_keys": user_data.get("api_keys", {})
-                        }}
-                    )
-                    app.logger.info(f"Updated user {username} in MongoDB")
-            except Exception as e:
-                app.logger.error(f"Error syncing user {username} to MongoDB: {e}")
-                
-        # Sync transactions
-        for transaction in transactions_db:
-            try:
-                # Check if transaction exists in MongoDB
-                transaction_id = transaction.get('transaction_id')
-                if db.transactions.count_documents({"_id": transaction_id}) == 0:
-                    # Create transaction in MongoDB
-                    mongo_transaction = {
-                        "_id": transaction_id,
-                        "username": transaction.get('user_id'),
-                        "amount": transaction.get('amount'),
-                        "phone": transaction.get('phone_number'),
-                        "subscription_type": transaction.get('subscription_type', "unknown"),
-                        "timestamp": datetime.now(),
-                        "status": transaction.get('status'),
-                        "reference": transaction.get('reference', 'N/A')
-                    }
-                    db.transactions.insert_one(mongo_transaction)
-                    app.logger.info(f"Synced transaction {transaction_id} to MongoDB")
-                    
-                    # Also record as payment
-                    db.payments.insert_one({
-                        "username": transaction.get('user_id'),
-                        "amount": transaction.get('amount'),
-                        "reference": transaction.get('reference', 'N/A'),
-                        "checkout_id": transaction_id,
-                        "subscription_type": transaction.get('subscription_type', "unknown"),
-                        "timestamp": datetime.now(),
-                        "status": transaction.get('status')
-                    })
-            except Exception as e:
-                app.logger.error(f"Error syncing transaction {transaction.get('transaction_id')} to MongoDB: {e}")
-                
-        app.logger.info("Memory-to-MongoDB sync completed")
+        # Pick up writes journaled by workers that exited during the outage
+        sealed = []
+        if fallback_journal is not None:
+            replay_fallback_journal(app)
+            sealed = fallback_journal.seal()
+        
+        _pin_user_balance_changes()
+        users_synced = _bulk_sync(app, db, users_db, _user_sync_ops, "users", batch_size, on_synced=_user_synced)
+        transactions_synced = _bulk_sync(app, db, transactions_db, _transaction_sync_ops, "transactions", batch_size)
+        
+        sync_metrics["runs"] += 1
+        sync_metrics["users_synced"] += users_synced
+        sync_metrics["transactions_synced"] += transactions_synced
+        sync_metrics["last_duration_ms"] = int((time.time() - started) * 1000)
+        sync_metrics["last_synced_at"] = datetime.now().isoformat()
+        
+        if fallback_journal is not None:
+            _checkpoint_fallback_journal(sealed)
+        
+        # Healthy writes only follow records kept here, so drop what is synced
+        sync_metrics["pruned"] += users_db.prune_clean() + transactions_db.prune_clean()
+        
+        # Synced fallback writes may be newer than what other requests cached
+        user_cache.clear()
+        
+        app.logger.info(
+            f"Memory-to-MongoDB sync completed: {users_synced} users, "
+            f"{transactions_synced} transactions in {sync_metrics['last_duration_ms']}ms"
+        )
     except Exception as e:
-        app.logger.error(f"Error in sync_memory_to_mongo: {e}")
-        mongo_connected = False
+        _handle_mongo_error("sync_memory_to_mongo", e)
+
+def compact_word_ledger(app):
+    """Fold word ledger entries older than the grace period into the users' balance snapshots"""
+    if not (mongo_connected and mongo_client):
+        return None
+    started = time.time()
+    try:
+        users, entries = ledger.compact(get_db(), grace_seconds=WORD_LEDGER_COMPACT_GRACE)
+    except Exception as e:
+        _handle_mongo_error("compact_word_ledger", e)
+        return None
+    if entries:
+        user_cache.clear()
+        app.logger.info(f"Folded {entries} word ledger entries for {users} users in {int((time.time() - started) * 1000)}ms")
+    return users, entries
+
+def _ledger_compaction_loop(app):
+    """Background thread running compact_word_ledger; concurrent compactors are safe"""
+    while True:
+        time.sleep(WORD_LEDGER_COMPACT_INTERVAL)
+        try:
+            compact_word_ledger(app)
+        except Exception as e:
+            app.logger.error(f"Unexpected error in word ledger compaction: {e}")
+
+def _lease_maintenance_loop(app):
+    """Background thread returning this worker's expired leases and reclaiming dead workers' ones"""
+    while True:
+        time.sleep(word_leases.ttl / 2)
+        if not (mongo_connected and mongo_client):
+            continue
+        try:
+            db = get_db()
+            word_leases.release_expired(db)
+            reclaimed = word_leases.reclaim_expired(db)
+            if reclaimed:
+                app.logger.warning(f"Reclaimed {reclaimed} word leases left by dead workers")
+        except Exception as e:
+            _handle_mongo_error("lease maintenance", e)
+
+def _check_lease_settings(app):
+    """Warn when word leases are switched on without the ledger they reserve from"""
+    if WORD_LEASES_ENABLED and not WORD_LEDGER_ENABLED:
+        app.logger.warning("WORD_LEASES_ENABLED is set but WORD_LEDGER_ENABLED is not: "
+                           "word leases need the ledger, debits will not use them")
+        return False
+    return True
+
+def release_word_leases():
+    """Return this worker's unused leased words (worker shutdown)"""
+    if not (WORD_LEASES_ENABLED and mongo_connected and mongo_client):
+        return 0
+    try:
+        return word_leases.release_all(get_db())
+    except Exception as e:
+        _handle_mongo_error("release_word_leases", e)
+        return 0
+
+def get_lease_metrics():
+    """Get word lease counters for this worker"""
+    return dict(word_leases.stats(), enabled=WORD_LEDGER_ENABLED and WORD_LEASES_ENABLED)
+
+def archive_old_records(app):
+    """Move final transactions and payments older than ARCHIVE_AFTER_DAYS to the archive tier"""
+    if not (mongo_connected and mongo_client):
+        return None
+    started = time.time()
+    skipped = {}
+    try:
+        moved = archive.archive(get_db(), skipped=skipped)
+    except Exception as e:
+        _handle_mongo_error("archive_old_records", e)
+        return None
+    if any(moved.values()):
+        app.logger.info(f"Archived {moved['transactions']} transactions and {moved['payments']} payments "
+                        f"in {int((time.time() - started) * 1000)}ms")
+    for name, ids in skipped.items():
+        if ids:
+            app.logger.warning(f"Could not archive {len(ids)} {name}, left in the hot tier: {sorted(map(str, ids))[:10]}")
+    return moved
+
+def _archive_loop(app):
+    """Background thread running archive_old_records; concurrent archivers are safe"""
+    while True:
+        time.sleep(ARCHIVE_INTERVAL)
+        try:
+            archive_old_records(app)
+        except Exception as e:
+            app.logger.error(f"Unexpected error archiving records: {e}")
+
+def build_user_snapshot(app):
+    """Rewrite the users snapshot from MongoDB, unless another worker is doing it"""
+    if not (mongo_connected and mongo_client):
+        return None
+    started = time.time()
+    try:
+        built = snapshot.build(get_db(), USER_SNAPSHOT_PATH)
+    except Exception as e:
+        _handle_mongo_error("build_user_snapshot", e)
+        return None
+    if built is not None:
+        app.logger.info(f"Wrote users snapshot with {built[0]} users ({built[1]} skipped) "
+                        f"in {int((time.time() - started) * 1000)}ms")
+    return built
+
+def _user_snapshot_loop(app):
+    """Background thread keeping the users snapshot no older than USER_SNAPSHOT_INTERVAL"""
+    while True:
+        try:
+            age = snapshot.age(USER_SNAPSHOT_PATH)
+            if age is None or age >= USER_SNAPSHOT_INTERVAL:
+                build_user_snapshot(app)
+        except Exception as e:
+            app.logger.error(f"Unexpected error building users snapshot: {e}")
+        time.sleep(USER_SNAPSHOT_INTERVAL / 4)
 
 def init_mongo(app):
     """Initialize MongoDB connection with retry logic"""
-    global mongo_connected, mongo_retry_thread, mongo_client
+    global mongo_connected, mongo_client, _mongo_app, ledger_compactor_thread, lease_maintenance_thread, archiver_thread, user_snapshot_thread
     
-    # Get MongoDB URI from environment or app config
-    mongo_uri = os.environ.get('MONGO_URI', app.config.get('MONGO_URI'))
-    timeout = int(os.environ.get('MONGO_TIMEOUT', 15))
-    dbname = os.environ.get('MONGO_DBNAME', 'lipia')
+    _mongo_app = app
+    init_request_scope(app)
     
-    # Ensure the URI has the database name
-    if f'/{dbname}' not in mongo_uri and '?' in mongo_uri:
-        mongo_uri = mongo_uri.replace('?', f'/{dbname}?')
-    elif f'/{dbname}' not in mongo_uri:
-        mongo_uri = f"{mongo_uri}/{dbname}"
+    # Get MongoDB URI from app config or environment
+    mongo_uri = resolve_mongo_uri(app.config.get('MONGO_URI'))
+    if mongo_uri is None:
+        if os.environ.get('MONGO_FALLBACK_TO_MEMORY', 'true').lower() != 'true':
+            raise ConfigurationError("MONGO_URI is not set and MONGO_FALLBACK_TO_MEMORY is off")
+        # Nothing to connect to or probe; serve everything from the fallback tier
+        app.logger.warning("MONGO_URI is not set, using the fallback store only")
+        mongo_connected = False
+        init_fallback_journal(app)
+        return mongo
+    timeout = int(os.environ.get('MONGO_TIMEOUT', 15))
     
     # Update app config with the URI
     app.config['MONGO_URI'] = mongo_uri
@@ -206,38 +727,26 @@ def init_mongo(app):
     try:
         app.logger.info(f"Testing direct connection to MongoDB Atlas...")
         
-        # Create MongoDB connection options
-        mongo_options = {
-            'serverSelectionTimeoutMS': timeout * 1000,
-            'connectTimeoutMS': timeout * 1000,
-            'socketTimeoutMS': timeout * 2000
-        }
-        
         try:
-            # Create a direct connection with timeout
-            client = MongoClient(
-                mongo_uri,
-                **mongo_options
-            )
-            
-            # Test connection with ping
-            db = client.get_database()
-            db.command('ping')
-            
-            # Store the client for reuse
-            mongo_client = client
-            mongo_connected = True
+            if mongo_connected and mongo_client and _client_pid == os.getpid():
+                # Already connected and warmed by the gunicorn post_fork hook
+                db = get_db()
+            else:
+                # Create a direct pooled connection with timeout
+                client = create_mongo_client(mongo_uri)
+                
+                # Test connection with ping, then open the minimum pool
+                client.get_database().command('ping')
+                prewarm_pool(client, MONGO_POOL_OPTIONS['minPoolSize'])
+                
+                # Store the client for reuse
+                _set_client(client)
+                db = get_db()
+                mongo_connected = True
             
             app.logger.info(f"MongoDB Atlas connection test successful!")
             
-            # Create indexes
-            try:
-                db.users.create_index("username", unique=True)
-                db.payments.create_index("checkout_id", unique=True)
-                db.transactions.create_index([("username", 1), ("timestamp", -1)])
-                app.logger.info("MongoDB indexes created successfully")
-            except Exception as e:
-                app.logger.error(f"Error creating MongoDB indexes: {e}")
+            mongo_breaker.reset()
             
         except Exception as e:
             app.logger.warning(f"MongoDB Atlas direct connection test failed: {str(e)}")
@@ -260,57 +769,198 @@ def init_mongo(app):
     # Initialize Flask-PyMongo with the URI
     mongo.init_app(app)
     
-    # Start background thread to retry connection if not connected
+    # Recover fallback writes journaled before a restart, push them if we can
+    # and drop the fallback records MongoDB already has
+    init_fallback_journal(app)
+    if mongo_connected and (len(users_db) or len(transactions_db)):
+        sync_memory_to_mongo(app)
+    
+    # Open the breaker so its supervisor keeps probing until MongoDB answers
     if not mongo_connected and os.environ.get('MONGO_FALLBACK_TO_MEMORY', 'true').lower() == 'true':
         app.logger.info("Will attempt to reconnect to MongoDB Atlas in background")
-        
-        if not mongo_retry_thread or not mongo_retry_thread.is_alive():
-            mongo_retry_thread = threading.Thread(
-                target=retry_mongo_connection, 
-                args=(app,),
-                daemon=True
-            )
-            mongo_retry_thread.start()
+        mongo_breaker.trip("initial connection failed")
+    
+    if WORD_LEDGER_ENABLED and (ledger_compactor_thread is None or not ledger_compactor_thread.is_alive()):
+        ledger_compactor_thread = threading.Thread(target=_ledger_compaction_loop, args=(app,), daemon=True)
+        ledger_compactor_thread.start()
+    
+    _check_lease_settings(app)
+    if WORD_LEASES_ENABLED and (lease_maintenance_thread is None or not lease_maintenance_thread.is_alive()):
+        lease_maintenance_thread = threading.Thread(target=_lease_maintenance_loop, args=(app,), daemon=True)
+        lease_maintenance_thread.start()
+        atexit.register(release_word_leases)
+    
+    if ARCHIVE_INTERVAL > 0 and (archiver_thread is None or not archiver_thread.is_alive()):
+        archiver_thread = threading.Thread(target=_archive_loop, args=(app,), daemon=True)
+        archiver_thread.start()
+    
+    if USER_SNAPSHOT_INTERVAL > 0 and (user_snapshot_thread is None or not user_snapshot_thread.is_alive()):
+        user_snapshot_thread = threading.Thread(target=_user_snapshot_loop, args=(app,), daemon=True)
+        user_snapshot_thread.start()
     
     return mongo
 
+# Request-scoped identity map: a request reads each document from MongoDB
+# at most once, and sees its own writes without reading them back
+def request_documents():
+    """The current request's IdentityMap, or None outside a request"""
+    if not has_request_context():
+        return None
+    documents = g.get('mongo_documents')
+    if documents is None:
+        documents = g.mongo_documents = IdentityMap()
+    return documents
+
+def _recall(collection, key, fields=None):
+    documents = request_documents()
+    return documents.get(collection, key, fields) if documents is not None else None
+
+def _remember(collection, key, document, fields=None):
+    documents = request_documents()
+    if documents is not None:
+        documents.put(collection, key, document, fields)
+
+def _remember_write(collection, key, changes):
+    documents = request_documents()
+    if documents is not None:
+        documents.update(collection, key, changes)
+
+def _forget(collection, key):
+    documents = request_documents()
+    if documents is not None:
+        documents.discard(collection, key)
+
+def _add_mongo_ops_header(response):
+    if MONGO_OPS_HEADER or current_app.debug:
+        response.headers['X-Mongo-Ops'] = str(g.get('mongo_ops', 0))
+    return response
+
+def _flush_request_documents(error=None):
+    documents = g.pop('mongo_documents', None)
+    if documents is not None:
+        documents.clear()
+
+def init_request_scope(app):
+    """Register the identity map teardown and the X-Mongo-Ops header on app"""
+    if 'mongo_request_scope' in app.extensions:
+        return
+    app.extensions['mongo_request_scope'] = True
+    app.after_request(_add_mongo_ops_header)
+    app.teardown_request(_flush_request_documents)
+
 # User models
-def get_user(username):
-    """Get user by username"""
+def _project(user, projection):
+    """Trim a user document to a projection preset's fields"""
+    if projection is None:
+        return user
+    return {field: user[field] for field in USER_PROJECTIONS[projection] if field in user}
+
+def _invalidate_user(username):
+    """Drop every cached shape of a user's document"""
+    user_cache.invalidate((username, None))
+    lookups.forget(("users", username, None))
+    for projection in USER_PROJECTIONS:
+        user_cache.invalidate((username, projection))
+        lookups.forget(("users", username, projection))
+
+def _with_leased_words(user):
+    """Count words this worker holds on lease for the user as part of the balance"""
+    if WORD_LEASES_ENABLED and "words_remaining" in user:
+        user["words_remaining"] += word_leases.local_remaining(user.get("username"))
+    return user
+
+def _fallback_user(username):
+    """A user's fallback record, loaded from the users snapshot the first time it is needed"""
+    record = users_db.get(username)
+    if record is None:
+        user = user_snapshot.get(username)
+        if user is not None:
+            # Its balance may be stale; debits against it reach MongoDB as
+            # increments (see _user_sync_ops), not as a balance to overwrite
+            record = users_db.put_if_absent(username, {
+                "password": user["pin"],
+                "plan": user["plan"] or "Free",
+                "words_used": 0,
+                "words_remaining": user["words_remaining"],
+                "phone_number": user["phone_number"],
+                "payment_status": user["payment_status"] or "Pending"
+            })
+    return record
+
+def _fetch_user(username, projection):
+    """Read a user from MongoDB with its ledger balance and cache it, or None"""
+    token = user_cache.token()
+    db = get_db()
+    fields = {"ledger_ops": 0}
+    if projection is not None:
+        fields = dict.fromkeys(USER_PROJECTIONS[projection], 1)
+        fields["_id"] = 0
+    
+    # words_remaining is the ledger snapshot; add the unfolded tail
+    with_balance = WORD_LEDGER_ENABLED and (projection is None or "words_remaining" in fields)
+    if with_balance:
+        entries = ledger.tail(db, username)
+        if entries:
+            fields = None if projection is None else dict(fields, ledger_ops=1)
+    
+    user = db.users.find_one({"username": username}, fields)
+    if user:
+        if with_balance and entries:
+            user["words_remaining"] = user.get("words_remaining", 0) + ledger.tail_delta(entries, user.pop("ledger_ops", ()))
+        if USER_CACHE_ENABLED:
+            user_cache.set((username, projection), user, token)
+    return user
+
+def get_user(username, projection=None):
+    """Get user by username, optionally only the fields of a USER_PROJECTIONS preset"""
     global mongo_connected, mongo_client
     
     # Try MongoDB first if connected
     if mongo_connected and mongo_client:
+        wanted = None if projection is None else USER_PROJECTIONS[projection]
+        user = _recall("users", username, wanted)
+        if user is not None:
+            return _with_leased_words(_project(user, projection))
+        
+        cache_key = (username, projection)
+        if USER_CACHE_ENABLED:
+            cached = user_cache.get(cache_key)
+            if cached is not None:
+                _remember("users", username, cached, wanted)
+                return _with_leased_words(dict(cached))
+        
         try:
-            db = mongo_client.get_database()
-            user = db.users.find_one({"username": username})
+            # Concurrent misses for the same user share one read
+            user = _single_flight(("users", username, projection), lambda: _fetch_user(username, projection))
             if user:
-                return user
+                _remember("users", username, user, wanted)
+                return _with_leased_words(dict(user))
         except Exception as e:
-            logging.error(f"MongoDB error in get_user: {e}")
-            mongo_connected = False
+            _handle_mongo_error("get_user", e)
     
     # Fallback to in-memory database
-    if username in users_db:
-        return {
+    record = _fallback_user(username)
+    if record is not None:
+        return _project({
             "username": username,
-            "pin": users_db[username].get("password"),
-            "words_remaining": users_db[username].get("words_remaining", 0),
-            "phone_number": users_db[username].get("phone_number", "0712345678"),
-            "plan": users_db[username].get("plan", "Free"),
-            "payment_status": users_db[username].get("payment_status", "Pending"),
-            "api_keys": users_db[username].get("api_keys", {})
-        }
+            "pin": record.get("password"),
+            "words_remaining": record.get("words_remaining", 0),
+            "phone_number": record.get("phone_number", "0712345678"),
+            "plan": record.get("plan", "Free"),
+            "payment_status": record.get("payment_status", "Pending"),
+            "api_keys": record.get("api_keys", {})
+        }, projection)
     return None
 
 def create_user(username, pin, phone_number):
     """Create a new user"""
     global mongo_connected, mongo_client
+    persisted = False
     
     # Create user in MongoDB if connected
     if mongo_connected and mongo_client:
         try:
-            db = mongo_client.get_database()
+            db = get_db()
             mongo_user = {
                 "username": username,
                 "pin": pin,
@@ -322,15 +972,20 @@ def create_user(username, pin, phone_number):
                 "api_keys": {
                     "gpt_zero": "",
                     "originality": ""
-                }
+                },
+                "summary": summary.empty()
             }
             db.users.insert_one(mongo_user)
+            persisted = True
+            _invalidate_user(username)
         except Exception as e:
-            logging.error(f"MongoDB error in create_user: {e}")
-            mongo_connected = False
+            _handle_mongo_error("create_user", e)
     
-    # Always create in in-memory database as fallback
-    users_db[username] = {
+    # Only keep the user in the fallback store when MongoDB missed it; the
+    # users snapshot covers fallback reads for users MongoDB holds
+    if persisted:
+        return True
+    users_db.put(username, {
         "password": pin,
         "plan": "Free",
         "joined_date": datetime.now().strftime('%Y-%m-%d'),
@@ -342,104 +997,137 @@ def create_user(username, pin, phone_number):
             "gpt_zero": "",
             "originality": ""
         }
-    }
+    }, dirty=True)
     return True
 
 def update_user(username, update_data):
     """Update user info"""
     global mongo_connected, mongo_client
+    persisted = False
     
     # Update in MongoDB if connected
     if mongo_connected and mongo_client:
         try:
-            db = mongo_client.get_database()
+            db = get_db()
             db.users.update_one(
                 {"username": username},
                 {"$set": update_data}
             )
+            persisted = True
         except Exception as e:
-            logging.error(f"MongoDB error in update_user: {e}")
-            mongo_connected = False
+            _handle_mongo_error("update_user", e)
+        finally:
+            _invalidate_user(username)
+        if persisted and not any('.' in field for field in update_data):
+            _remember_write("users", username, update_data)
+        else:
+            _forget("users", username)
     
     # Always update in-memory database
-    if username in users_db:
-        for key, value in update_data.items():
-            if key == "words_remaining":
-                users_db[username]["words_remaining"] = value
-            elif key == "api_keys":
-                users_db[username]["api_keys"] = value
-            else:
-                users_db[username][key] = value
+    if not persisted:
+        _fallback_user(username)
+    users_db.update_fields(username, update_data, dirty=not persisted)
     return True
 
-def update_word_count(username, words_to_add):
-    """Update user word count"""
+def update_word_count(username, words_to_add, op_id=None):
+    """Credit words to a user, returns the new balance; a repeated op_id is only credited once"""
     global mongo_connected, mongo_client
     
     # Update in MongoDB if connected
     if mongo_connected and mongo_client:
         try:
-            db = mongo_client.get_database()
-            db.users.update_one(
-                {"username": username},
-                {"$inc": {"words_remaining": words_to_add}}
-            )
-            # Get updated count from MongoDB
-            user = db.users.find_one({"username": username})
-            if user:
-                # Also update in-memory database
-                if username in users_db:
-                    users_db[username]["words_remaining"] = user.get("words_remaining", 0)
-                return user.get("words_remaining", 0)
+            db = get_db()
+            if WORD_LEDGER_ENABLED:
+                new_count = ledger.credit(db, username, words_to_add, op_id or ledger.new_op_id(), "credit")
+                _invalidate_user(username)
+                if new_count is not None:
+                    _remember_write("users", username, {"words_remaining": new_count})
+                    word_leases.credited(username, words_to_add)
+                    users_db.update_fields(username, {"words_remaining": new_count}, dirty=False)
+                    return new_count
+            else:
+                # The updated document comes back with the write
+                user = db.users.find_one_and_update(
+                    {"username": username},
+                    {"$inc": {"words_remaining": words_to_add}},
+                    return_document=ReturnDocument.AFTER
+                )
+                _invalidate_user(username)
+                if user:
+                    _remember("users", username, user)
+                    # Also update in-memory database
+                    users_db.update_fields(username, {"words_remaining": user.get("words_remaining", 0)}, dirty=False)
+                    return user.get("words_remaining", 0)
         except Exception as e:
-            logging.error(f"MongoDB error in update_word_count: {e}")
-            mongo_connected = False
+            _handle_mongo_error("update_word_count", e)
+            # The credit may have been applied before the error
+            _invalidate_user(username)
+            _forget("users", username)
     
     # Fallback to in-memory database
-    if username in users_db:
-        current_words = users_db[username].get("words_remaining", 0)
-        users_db[username]["words_remaining"] = current_words + words_to_add
-        return current_words + words_to_add
-    return 0
-
-def consume_words(username, words_to_use):
-    """Consume words from user's account"""
+    _fallback_user(username)
+    new_count = users_db.add_words(username, words_to_add)
+    return new_count if new_count is not None else 0
+
+def consume_words(username, words_to_use, op_id=None):
+    """Consume words from user's account, returns (success, remaining)"""
     global mongo_connected, mongo_client
     
     # Try MongoDB first if connected
     if mongo_connected and mongo_client:
         try:
-            db = mongo_client.get_database()
-            user = db.users.find_one({"username": username})
-            if user:
-                current_words = user.get("words_remaining", 0)
-                
-                if current_words < words_to_use:
-                    return False, current_words
-                
-                # Update in MongoDB
-                db.users.update_one(
-                    {"username": username},
-                    {"$inc": {"words_remaining": -words_to_use}}
+            db = get_db()
+            if WORD_LEDGER_ENABLED and WORD_LEASES_ENABLED and op_id is None:
+                served = word_leases.debit(db, username, words_to_use)
+                if served is not None:
+                    # A lease grant moves words out of the stored balance
+                    _forget("users", username)
+                    return served
+            if WORD_LEDGER_ENABLED:
+                op_id = op_id or ledger.new_op_id()
+                result = ledger.debit(db, username, words_to_use, op_id, "debit")
+                if result and not result[0] and WORD_LEASES_ENABLED and word_leases.reclaim_user(db, username):
+                    # Words on lease were not in the balance the debit checked
+                    result = ledger.debit(db, username, words_to_use, op_id, "debit")
+                _invalidate_user(username)
+                if result is not None:
+                    _remember_write("users", username, {"words_remaining": result[1]})
+                    users_db.update_fields(username, {"words_remaining": result[1]}, dirty=False)
+                    return result
+            else:
+                # Conditional debit: only matches when the balance covers the request,
+                # so the check and the decrement happen in a single round trip
+                user = db.users.find_one_and_update(
+                    {"username": username, "words_remaining": {"$gte": words_to_use}},
+                    {"$inc": {"words_remaining": -words_to_use, ledger.usage_field(datetime.now()): words_to_use}},
+                    projection={"words_remaining": 1, "_id": 0},
+                    return_document=ReturnDocument.AFTER
                 )
-                
-                # Also update in-memory database
-                if username in users_db:
-                    users_db[username]["words_remaining"] = current_words - words_to_use
+                if user:
+                    _invalidate_user(username)
+                    remaining = user.get("words_remaining", 0)
+                    _remember_write("users", username, {"words_remaining": remaining})
+                    
+                    # Also update in-memory database
+                    users_db.update_fields(username, {"words_remaining": remaining}, dirty=False)
                     
-                return True, current_words - words_to_use
+                    return True, remaining
+                
+                # Debit rejected - read the balance to report it (or find no user)
+                user = db.users.find_one({"username": username}, {"words_remaining": 1, "_id": 0})
+                if user:
+                    _remember("users", username, user, ("words_remaining",))
+                    return False, user.get("words_remaining", 0)
         except Exception as e:
-            logging.error(f"MongoDB error in consume_words: {e}")
-            mongo_connected = False
+            _handle_mongo_error("consume_words", e)
+            # The debit may have been applied before the error
+            _invalidate_user(username)
+            _forget("users", username)
     
     # Fallback to in-memory database
-    if username in users_db:
-        current_words = users_db[username].get("words_remaining", 0)
-        if current_words < words_to_use:
-            return False, current_words
-        users_db[username]["words_remaining"] = current_words - words_to_use
-        return True, current_words - words_to_use
-    return False, 0
+    _fallback_user(username)
+    result = users_db.consume_words(username, words_to_use)
+    return result if result is not None else (False, 0)
 
 def user_exists(username):
     """Check if user exists"""
@@ -447,51 +1135,98 @@ def user_exists(username):
     
     # Try MongoDB first if connected
     if mongo_connected and mongo_client:
+        if _recall("users", username, ()) is not None:
+            return True
         try:
-            db = mongo_client.get_database()
+            db = get_db()
             return db.users.count_documents({"username": username}) > 0
         except Exception as e:
-            logging.error(f"MongoDB error in user_exists: {e}")
-            mongo_connected = False
+            _handle_mongo_error("user_exists", e)
     
     # Fallback to in-memory database
-    return username in users_db
+    return _fallback_user(username) is not None
 
 # Payment models
 def record_payment(username, amount, subscription_type, status='pending', reference='N/A', checkout_id='N/A'):
-    """Record a payment attempt"""
+    """
+    Record a payment or move it to a new status.
+
+    There is one payment document per checkout id. The first call creates it
+    and later calls only apply the transitions in PAYMENT_TRANSITIONS.
+    Returns False if the payment is already in a state that cannot move to
+    status, e.g. a callback completing a cancelled payment.
+    """
     global mongo_connected, mongo_client
+    persisted = False
+    allowed_from = PAYMENT_TRANSITIONS[status]
     
-    payment = {
+    # Keep a real reference; 'N/A' only fills in a new record
+    status_fields = {"status": status}
+    insert_fields = {
         "username": username,
         "amount": amount,
-        "reference": reference,
-        "checkout_id": checkout_id,
         "subscription_type": subscription_type,
-        "timestamp": datetime.now(),
-        "status": status
+        "timestamp": datetime.utcnow()
     }
+    if reference != 'N/A':
+        status_fields["reference"] = reference
+    else:
+        insert_fields["reference"] = reference
     
     # Record in MongoDB if connected
     if mongo_connected and mongo_client:
         try:
-            db = mongo_client.get_database()
-            db.payments.insert_one(payment)
+            db = get_db()
+            guard = {"checkout_id": checkout_id, "status": {"$in": list(allowed_from)}}
+            try:
+                created = db.payments.update_one(
+                    guard, {"$set": status_fields, "$setOnInsert": insert_fields}, upsert=True
+                ).upserted_id is not None
+            except DuplicateKeyError:
+                # The guard missed an existing payment, or lost an insert race;
+                # only the latter can still be applied
+                if db.payments.update_one(guard, {"$set": status_fields}).matched_count == 0:
+                    logging.warning(f"Rejected payment transition to {status} for {checkout_id}")
+                    return False
+                created = False
+            persisted = True
+            _remember_write("payments", checkout_id, status_fields)
+            
+            # Keep the account summary's recent payments in step
+            if created:
+                summary.push_payment(db, username, dict(insert_fields, checkout_id=checkout_id, **status_fields))
+            else:
+                summary.update_payment(db, username, checkout_id, status_fields)
+            _invalidate_user(username)
+            _forget("users", username)
         except Exception as e:
-            logging.error(f"MongoDB error in record_payment: {e}")
-            mongo_connected = False
+            _handle_mongo_error("record_payment", e)
     
-    # Always record in in-memory database
-    transactions_db.append({
-        'transaction_id': checkout_id,
+    fields = {
         'user_id': username,
-        'phone_number': users_db.get(username, {}).get('phone_number', '0712345678'),
         'amount': amount,
-        'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
         'status': status,
-        'reference': reference,
         'subscription_type': subscription_type
-    })
+    }
+    if reference != 'N/A':
+        fields['reference'] = reference
+    
+    # MongoDB has the final say once it accepted the transition; only a
+    # local copy kept from an outage follows it
+    if persisted:
+        transactions_db.update(checkout_id, fields, dirty=False)
+        return True
+    
+    defaults = {
+        'phone_number': (users_db.get(username) or {}).get('phone_number', '0712345678'),
+        'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    if reference == 'N/A':
+        defaults['reference'] = reference
+    record = transactions_db.upsert(checkout_id, fields, defaults=defaults, allowed_from=allowed_from)
+    if record is None:
+        logging.warning(f"Rejected payment transition to {status} for {checkout_id} in fallback store")
+        return False
     return True
 
 def get_payment(checkout_id):
@@ -500,106 +1235,361 @@ def get_payment(checkout_id):
     
     # Try MongoDB first if connected
     if mongo_connected and mongo_client:
+        payment = _recall("payments", checkout_id)
+        if payment is not None:
+            return payment
         try:
-            db = mongo_client.get_database()
-            payment = db.payments.find_one({"checkout_id": checkout_id})
+            db = get_db()
+            payment = archive.find_one(db, "payments", {"checkout_id": checkout_id})
             if payment:
+                _remember("payments", checkout_id, payment)
                 return payment
         except Exception as e:
-            logging.error(f"MongoDB error in get_payment: {e}")
-            mongo_connected = False
+            _handle_mongo_error("get_payment", e)
     
     # Fallback to in-memory database
-    for t in transactions_db:
-        if t.get('transaction_id') == checkout_id:
-            return {
-                "username": t.get('user_id'),
-                "amount": t.get('amount'),
-                "reference": t.get('reference', 'N/A'),
-                "checkout_id": checkout_id,
-                "timestamp": datetime.now(),
-                "status": t.get('status'),
-                "subscription_type": t.get('subscription_type', 'unknown')
-            }
+    t = transactions_db.get(checkout_id)
+    if t:
+        return {
+            "username": t.get('user_id'),
+            "amount": t.get('amount'),
+            "reference": t.get('reference', 'N/A'),
+            "checkout_id": checkout_id,
+            "timestamp": datetime.utcnow(),
+            "status": t.get('status'),
+            "subscription_type": t.get('subscription_type', 'unknown')
+        }
     return None
 
 def update_payment_status(checkout_id, status, reference=None):
-    """Update payment status"""
+    """Move an existing payment to status, returns False if it is missing or the transition is not allowed"""
     global mongo_connected, mongo_client
+    persisted = False
+    allowed_from = PAYMENT_TRANSITIONS[status]
+    
+    update_data = {"status": status}
+    if reference:
+        update_data["reference"] = reference
     
     # Update in MongoDB if connected
     if mongo_connected and mongo_client:
         try:
-            db = mongo_client.get_database()
-            update_data = {"status": status}
-            if reference:
-                update_data["reference"] = reference
-            
-            db.payments.update_one(
-                {"checkout_id": checkout_id},
-                {"$set": update_data}
+            db = get_db()
+            payment = db.payments.find_one_and_update(
+                {"checkout_id": checkout_id, "status": {"$in": list(allowed_from)}},
+                {"$set": update_data},
+                projection={"username": 1, "_id": 0}
             )
+            if payment is None:
+                return False
+            persisted = True
+            _remember_write("payments", checkout_id, update_data)
+            summary.update_payment(db, payment.get("username"), checkout_id, update_data)
+            _invalidate_user(payment.get("username"))
+            _forget("users", payment.get("username"))
         except Exception as e:
-            logging.error(f"MongoDB error in update_payment_status: {e}")
-            mongo_connected = False
+            _handle_mongo_error("update_payment_status", e)
     
-    # Always update in-memory database
-    for t in transactions_db:
-        if t.get('transaction_id') == checkout_id:
-            t['status'] = status
+    # Update a local copy kept from an outage, or the fallback store
+    if persisted:
+        transactions_db.update(checkout_id, dict(update_data), dirty=False)
+        return True
+    return transactions_db.update(checkout_id, dict(update_data), allowed_from=allowed_from)
+
+def _apply_settlement(db, checkout_id, reference, session=None):
+    """Claim a pending payment and apply its settlement, returns (payment, balance) or None if it is not pending"""
+    status_fields = {"status": "completed"}
+    if reference:
+        status_fields["reference"] = reference
+    
+    # The claim is the exactly-once guard: only one callback moves it off pending
+    payment = db.payments.find_one_and_update(
+        {"checkout_id": checkout_id, "status": "pending"},
+        {"$set": status_fields},
+        projection={"username": 1, "subscription_type": 1, "_id": 0},
+        session=session
+    )
+    if payment is None:
+        return None
+    
+    db.transactions.update_one({"_id": checkout_id}, {"$set": status_fields}, session=session)
+    summary.update_payment(db, payment["username"], checkout_id, status_fields, session=session)
+    words = subscription_words(payment.get("subscription_type"))
+    if WORD_LEDGER_ENABLED:
+        balance = ledger.credit(
+            db, payment["username"], words, f"payment:{checkout_id}", "payment",
+            set_fields={"payment_status": "Paid"}, session=session
+        )
+        return payment, balance
+    user = db.users.find_one_and_update(
+        {"username": payment["username"]},
+        {"$inc": {"words_remaining": words}, "$set": {"payment_status": "Paid"}},
+        projection={"words_remaining": 1, "_id": 0},
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    return payment, user.get("words_remaining", 0) if user else None
+
+def _settle_in_mongo(db, checkout_id, reference):
+    if SETTLE_WITH_TRANSACTION and db.supports_transactions:
+        with db.client.start_session() as session:
+            return session.with_transaction(lambda s: _apply_settlement(db, checkout_id, reference, s))
+    # Standalone server: claim first, so a failure part way leaves a
+    # completed payment to repair rather than a double credit
+    return _apply_settlement(db, checkout_id, reference)
+
+def settle_payment(checkout_id, reference=None, fallback=True):
+    """
+    Complete a pending payment as one unit of work.
+
+    Moves the payment and its transaction to completed, marks the user Paid
+    and credits the subscription's words. Returns the user's new balance,
+    or None if checkout_id has no pending payment (unknown, or already
+    completed/cancelled/failed) and nothing was applied.
+
+    With fallback=False it raises instead of settling in the fallback
+    store while MongoDB is unavailable, for callers that can retry.
+    """
+    global mongo_connected, mongo_client
+    
+    if not fallback and not (mongo_connected and mongo_client and mongo_breaker.closed):
+        raise ConnectionFailure("MongoDB is unavailable")
+    
+    if mongo_connected and mongo_client:
+        try:
+            db = get_db()
+            settled = _settle_in_mongo(db, checkout_id, reference)
+            if settled is None:
+                # The payment row is missing if recording the initiation failed;
+                # create it from the transaction and claim again
+                # Read whole, so a caller looking the transaction up next
+                # (e.g. to tell unknown from settled) gets it from this request
+                transaction = db.transactions.find_one({"_id": checkout_id})
+                if transaction:
+                    _remember("transactions", checkout_id, transaction)
+                if transaction and transaction.get("status") == "pending" and record_payment(
+                    transaction.get("username"), transaction.get("amount"),
+                    transaction.get("subscription_type", "unknown"), 'pending', 'N/A', checkout_id
+                ):
+                    settled = _settle_in_mongo(db, checkout_id, reference)
+            if settled is None:
+                return None
+            
+            payment, balance = settled
+            username = payment["username"]
+            balance = balance or 0
+            word_leases.credited(username, subscription_words(payment.get("subscription_type")))
+            _invalidate_user(username)
+            
+            # Also update in-memory database
+            fields = {'status': 'completed'}
             if reference:
-                t['reference'] = reference
-            return True
-    return False
+                fields['reference'] = reference
+            _remember_write("payments", checkout_id, fields)
+            _remember_write("transactions", checkout_id, fields)
+            lookups.forget(("transactions", checkout_id))
+            # The summary's copy of the payment changed too
+            _forget("users", username)
+            transactions_db.update(checkout_id, fields, dirty=False)
+            users_db.update_fields(username, {"words_remaining": balance, "payment_status": "Paid"}, dirty=False)
+            return balance
+        except Exception as e:
+            _handle_mongo_error("settle_payment", e)
+            if not fallback:
+                raise
+    
+    # Fallback: the shared transaction/payment record is the claim
+    fields = {'status': 'completed'}
+    if reference:
+        fields['reference'] = reference
+    if not transactions_db.update(checkout_id, fields, allowed_from=("pending",)):
+        return None
+    t = transactions_db.get(checkout_id)
+    username = t.get('user_id')
+    _fallback_user(username)
+    users_db.update_fields(username, {"payment_status": "Paid"})
+    balance = users_db.add_words(username, subscription_words(t.get('subscription_type')))
+    return balance if balance is not None else 0
 
-def get_user_payments(username):
-    """Get all payments for a user"""
+def encode_history_cursor(timestamp, key):
+    """Build an opaque keyset cursor pointing after a payment"""
+    payload = json.dumps({"t": timestamp.isoformat(), "i": str(key)})
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_history_cursor(cursor):
+    """Parse a cursor from encode_history_cursor, raises ValueError if malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return datetime.fromisoformat(data["t"]), data["i"]
+    except Exception:
+        raise ValueError("Invalid payment history cursor")
+
+def _fallback_payment(t):
+    """Shape a fallback transaction record like a payments document"""
+    try:
+        timestamp = datetime.strptime(t.get('date'), '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        timestamp = datetime.utcnow()
+    return {
+        "username": t.get('user_id'),
+        "amount": t.get('amount'),
+        "reference": t.get('reference', 'N/A'),
+        "checkout_id": t.get('transaction_id'),
+        "timestamp": timestamp,
+        "status": t.get('status'),
+        "subscription_type": t.get('subscription_type', 'unknown')
+    }
+
+def _fallback_payment_history(username, cursor=None):
+    """A user's fallback payments newest first, after the cursor if given"""
+    payments = sorted(
+        (_fallback_payment(t) for t in transactions_db.for_user(username)),
+        key=lambda p: (p["timestamp"], p["checkout_id"]),
+        reverse=True
+    )
+    if cursor:
+        after = decode_history_cursor(cursor)
+        payments = [p for p in payments if (p["timestamp"], p["checkout_id"]) < after]
+    return payments
+
+def _history_key(payment):
+    return payment["timestamp"], payment["_id"]
+
+def payment_history_query(username, cursor=None):
+    """Filter for a user's payments after a keyset cursor"""
+    query = {"username": username}
+    if cursor:
+        timestamp, key = decode_history_cursor(cursor)
+        if ObjectId.is_valid(key):
+            key = ObjectId(key)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": key}}
+        ]
+    return query
+
+def get_user_payments_page(username, cursor=None, page_size=None):
+    """Get one page of a user's payments, newest first, as (payments, next_cursor)"""
     global mongo_connected, mongo_client
     
+    page_size = max(1, min(page_size or PAYMENT_HISTORY_PAGE_SIZE, PAYMENT_HISTORY_MAX_PAGE_SIZE))
+    
     # Try MongoDB first if connected
     if mongo_connected and mongo_client:
+        query = payment_history_query(username, cursor)
         try:
-            db = mongo_client.get_database()
-            payments = list(db.payments.find({"username": username}).sort("timestamp", -1))
-            if payments:
-                return payments
+            db = get_db()
+            # Each tier is served from its (username, timestamp, _id) index, no
+            # in-memory sort; one extra document tells us whether there is a next page
+            hot = db.payments.find(query).sort(PAYMENT_HISTORY_SORT).limit(page_size + 1)
+            cold = db.payments_archive.find(query).sort(PAYMENT_HISTORY_SORT).limit(page_size + 1)
+            payments = list(itertools.islice(archive.merge_newest_first(list(hot), cold, _history_key), page_size + 1))
+            next_cursor = None
+            if len(payments) > page_size:
+                payments = payments[:page_size]
+                next_cursor = encode_history_cursor(payments[-1]["timestamp"], payments[-1]["_id"])
+            return payments, next_cursor
         except Exception as e:
-            logging.error(f"MongoDB error in get_user_payments: {e}")
-            mongo_connected = False
+            _handle_mongo_error("get_user_payments_page", e)
     
     # Fallback to in-memory database
-    return [
-        {
-            "username": t.get('user_id'),
-            "amount": t.get('amount'),
-            "reference": t.get('reference', 'N/A'),
-            "checkout_id": t.get('transaction_id'),
-            "timestamp": datetime.now(),
-            "status": t.get('status'),
-            "subscription_type": t.get('subscription_type', 'unknown')
-        }
-        for t in transactions_db if t.get('user_id') == username
-    ]
+    payments = _fallback_payment_history(username, cursor)
+    next_cursor = None
+    if len(payments) > page_size:
+        payments = payments[:page_size]
+        next_cursor = encode_history_cursor(payments[-1]["timestamp"], payments[-1]["checkout_id"])
+    return payments, next_cursor
+
+def iter_user_payments(username, batch_size=500):
+    """Stream all of a user's payments newest first, for export"""
+    global mongo_connected, mongo_client
+    
+    # Try MongoDB first if connected
+    if mongo_connected and mongo_client:
+        try:
+            db = get_db()
+            hot = db.payments.find({"username": username}).sort(PAYMENT_HISTORY_SORT).batch_size(batch_size)
+            cold = db.payments_archive.find({"username": username}).sort(PAYMENT_HISTORY_SORT).batch_size(batch_size)
+            # Streamed, so unlike a page a row archived mid-export can be missed
+            cursor = archive.merge_newest_first(hot, cold, _history_key)
+        except Exception as e:
+            _handle_mongo_error("iter_user_payments", e)
+        else:
+            try:
+                for payment in cursor:
+                    yield payment
+            except Exception as e:
+                _handle_mongo_error(f"iter_user_payments({username})", e)
+            return
+    
+    # Fallback to in-memory database
+    for payment in _fallback_payment_history(username):
+        yield payment
+
+def get_user_payments(username):
+    """Get all payments for a user"""
+    return list(iter_user_payments(username))
+
+def get_account(username):
+    """
+    The account view, or None if the user does not exist.
+
+    Balance, plan, payment status, recent payments and this month's usage
+    come from one read of the user document. A user whose summary has not
+    been built yet (see summary.rebuild) is summarized from payments and
+    word_ledger instead.
+    """
+    global mongo_connected, mongo_client
+    
+    user = get_user(username, 'account')
+    if user is None:
+        return None
+    
+    account_summary = user.get("summary") or {}
+    if not account_summary.get("built_at"):
+        account_summary = {}
+        if mongo_connected and mongo_client:
+            try:
+                account_summary = summary.build(get_db(), username)
+            except Exception as e:
+                _handle_mongo_error("get_account", e)
+        if not account_summary:
+            payments = _fallback_payment_history(username)[:summary.SUMMARY_PAYMENTS]
+            account_summary = {"recent_payments": [summary.payment_entry(p) for p in payments]}
+    
+    return {
+        "username": username,
+        "words_remaining": user.get("words_remaining", 0),
+        "plan": user.get("plan", "Free"),
+        "payment_status": user.get("payment_status", "Pending"),
+        "recent_payments": account_summary.get("recent_payments", []),
+        "words_used_this_month": summary.month_to_date(account_summary)
+    }
 
 # Transaction models
 def save_transaction(transaction_id, data):
     """Save transaction data"""
     global mongo_connected, mongo_client
+    persisted = False
     
     # Save in MongoDB if connected
     if mongo_connected and mongo_client:
         try:
-            db = mongo_client.get_database()
+            db = get_db()
             mongo_data = data.copy()
             mongo_data["_id"] = transaction_id
             db.transactions.insert_one(mongo_data)
+            persisted = True
+            _remember("transactions", transaction_id, mongo_data)
+            lookups.forget(("transactions", transaction_id))
         except Exception as e:
-            logging.error(f"MongoDB error in save_transaction: {e}")
-            mongo_connected = False
+            _handle_mongo_error("save_transaction", e)
     
-    # Always save in in-memory database
-    transactions_db.append({
-        'transaction_id': transaction_id,
+    # The fallback store only keeps what MongoDB does not have
+    if persisted:
+        return True
+    transactions_db.upsert(transaction_id, {
         'user_id': data.get('username'),
         'phone_number': data.get('phone'),
         'amount': data.get('amount'),
@@ -616,55 +1606,66 @@ def get_transaction(transaction_id):
     
     # Try MongoDB first if connected
     if mongo_connected and mongo_client:
+        transaction = _recall("transactions", transaction_id)
+        if transaction is not None:
+            return transaction
         try:
-            db = mongo_client.get_database()
-            transaction = db.transactions.find_one({"_id": transaction_id})
+            db = get_db()
+            # Pollers of the same checkout share one read
+            transaction = _single_flight(
+                ("transactions", transaction_id),
+                lambda: archive.find_one(db, "transactions", {"_id": transaction_id})
+            )
             if transaction:
+                transaction = dict(transaction)
+                _remember("transactions", transaction_id, transaction)
                 return transaction
         except Exception as e:
-            logging.error(f"MongoDB error in get_transaction: {e}")
-            mongo_connected = False
+            _handle_mongo_error("get_transaction", e)
     
     # Fallback to in-memory database
-    for t in transactions_db:
-        if t.get('transaction_id') == transaction_id:
-            return {
-                "username": t.get('user_id'),
-                "amount": t.get('amount'),
-                "checkout_id": transaction_id,
-                "phone": t.get('phone_number'),
-                "timestamp": datetime.now(),
-                "status": t.get('status'),
-                "reference": t.get('reference', 'N/A'),
-                "subscription_type": t.get('subscription_type', 'unknown')
-            }
+    t = transactions_db.get(transaction_id)
+    if t:
+        return {
+            "username": t.get('user_id'),
+            "amount": t.get('amount'),
+            "checkout_id": transaction_id,
+            "phone": t.get('phone_number'),
+            "timestamp": datetime.utcnow(),
+            "status": t.get('status'),
+            "reference": t.get('reference', 'N/A'),
+            "subscription_type": t.get('subscription_type', 'unknown')
+        }
     return None
 
 def update_transaction_status(transaction_id, status, reference=None):
-    """Update transaction status"""
+    """Move a transaction to status, returns False if it is missing or the transition is not allowed"""
     global mongo_connected, mongo_client
+    persisted = False
+    allowed_from = PAYMENT_TRANSITIONS[status]
+    
+    update_data = {"status": status}
+    if reference:
+        update_data["reference"] = reference
     
     # Update in MongoDB if connected
     if mongo_connected and mongo_client:
         try:
-            db = mongo_client.get_database()
-            update_data = {"status": status}
-            if reference:
-                update_data["reference"] = reference
-            
-            db.transactions.update_one(
-                {"_id": transaction_id},
+            db = get_db()
+            result = db.transactions.update_one(
+                {"_id": transaction_id, "status": {"$in": list(allowed_from)}},
                 {"$set": update_data}
             )
+            if not result.matched_count:
+                return False
+            persisted = True
+            _remember_write("transactions", transaction_id, update_data)
+            lookups.forget(("transactions", transaction_id))
         except Exception as e:
-            logging.error(f"MongoDB error in update_transaction_status: {e}")
-            mongo_connected = False
+            _handle_mongo_error("update_transaction_status", e)
     
-    # Always update in-memory database
-    for t in transactions_db:
-        if t.get('transaction_id') == transaction_id:
-            t['status'] = status
-            if reference:
-                t['reference'] = reference
-            return True
-    return False
+    # Update a local copy kept from an outage, or the fallback store
+    if persisted:
+        transactions_db.update(transaction_id, dict(update_data), dirty=False)
+        return True
+    return transactions_db.update(transaction_id, dict(update_data), allowed_from=allowed_from)
@@ -1,35 +1,143 @@
 # Updated payment.py with Lipia payment functionality
 
-from flask import Blueprint, request, jsonify, current_app, url_for, render_template, flash, redirect, session
+from flask import Blueprint, request, jsonify, current_app, url_for, render_template, flash, redirect, session, Response, stream_with_context
 import os
-import requests
+import csv
+import io
 import json
 import uuid
-import queue
-import threading
-import socket
 import time
+import tempfile
 from datetime import datetime
-from models import get_user, update_word_count, record_payment, save_transaction, get_transaction, update_transaction_status
+from models import get_user, update_word_count, record_payment, update_payment_status, settle_payment, save_transaction, get_transaction, update_transaction_status, get_user_payments_page, iter_user_payments
+from models import get_breaker_metrics, get_sync_metrics, get_user_cache_stats, get_single_flight_stats, get_lease_metrics
 from config import pricing_plans
+from dispatch import Dispatcher
+from events import StatusBroker
+from bus import Bus
+from cache import TTLCache
+from adapter import PaymentAdapter
+from http_client import LipiaClient
 
 # Initialize payment blueprint
 payment_bp = Blueprint('payment', __name__, url_prefix='/payment')
 
 # API constants - use the real credentials from Python script
-API_BASE_URL = os.environ.get('LIPIA_API_URL', "https://lipia-api.kreativelabske.com/api")
-API_KEY = os.environ.get('LIPIA_API_KEY', "7c8a3202ae14857e71e3a9db78cf62139772cae6")
-PAYMENT_URL = os.environ.get('PAYMENT_URL', "https://lipia-online.vercel.app/link/andikartill")
+payment_adapter = PaymentAdapter()
+API_BASE_URL = payment_adapter.get_api_url()
+API_KEY = payment_adapter.get_api_key()
+PAYMENT_URL = payment_adapter.get_payment_url()
+CALLBACK_URL = payment_adapter.config['callback_url']
+
+# Per-worker pooled session for the payment API (see http_client.py)
+lipia = LipiaClient(payment_adapter)
+
+# STK pushes are sent by a bounded per-worker pool (see dispatch.py) so a slow
+# payment API never holds a request worker. A push not started within
+# STK_DISPATCH_DEADLINE seconds of checkout is given up on
+STK_DISPATCH_ENABLED = os.environ.get('STK_DISPATCH_ENABLED', 'true').lower() == 'true'
+STK_DISPATCH_DEADLINE = float(os.environ.get('STK_DISPATCH_DEADLINE', 30))
+STK_REQUEST_TIMEOUT = float(os.environ.get('STK_REQUEST_TIMEOUT', 15))
+stk_dispatcher = Dispatcher(
+    workers=int(os.environ.get('STK_DISPATCH_WORKERS', 8)),
+    max_queued=int(os.environ.get('STK_DISPATCH_QUEUE', 200)),
+    name='stk'
+)
 
-# Global callback queue for communication between server and request handlers
-CALLBACK_QUEUE = queue.Queue()
 ACTIVE_TRANSACTIONS = {}
 
-# Callback server setup
-CALLBACK_HOST = "0.0.0.0"  # Listen on all interfaces
-CALLBACK_PORT = int(os.environ.get('CALLBACK_PORT', 8000))
-callback_server = None
-callback_thread = None
+# Serve this worker's counters at /payment/stats (always on in debug mode)
+PAYMENT_STATS_ENABLED = os.environ.get('PAYMENT_STATS_ENABLED', 'false').lower() == 'true'
+
+# Waiting pages follow their checkout over /payment/events instead of polling
+# when workers are threaded (GUNICORN_WORKER_CLASS=gthread); under sync
+# workers a stream would hold the whole worker, so the pages poll.
+# A stream holds one worker thread, so each worker serves at most
+# PAYMENT_EVENTS_MAX_STREAMS, never more than its GUNICORN_THREADS less a
+# reserve for ordinary requests, and turns the rest away to poll. Streams
+# re-check the checkout every heartbeat, in case the status bus lost a
+# settlement landing on another worker. They end at a final status or after
+# PAYMENT_EVENTS_TIMEOUT, and the page's EventSource reconnects after
+# PAYMENT_EVENTS_RETRY_MS, so no stream holds its thread for long
+PAYMENT_EVENTS_ENABLED = os.environ.get(
+    'PAYMENT_EVENTS_ENABLED', str(os.environ.get('GUNICORN_WORKER_CLASS', 'sync') == 'gthread')
+).lower() == 'true'
+PAYMENT_EVENTS_HEARTBEAT = float(os.environ.get('PAYMENT_EVENTS_HEARTBEAT', 10))
+PAYMENT_EVENTS_TIMEOUT = float(os.environ.get('PAYMENT_EVENTS_TIMEOUT', 30))
+PAYMENT_EVENTS_RETRY_MS = int(os.environ.get('PAYMENT_EVENTS_RETRY_MS', 2000))
+
+def events_stream_cap(threads, wanted=None):
+    """Streams a worker with threads threads may hold: a quarter of them, at least 4, stay free"""
+    cap = max(0, threads - max(4, threads // 4))
+    return cap if wanted is None else max(0, min(wanted, cap))
+
+_max_streams = os.environ.get('PAYMENT_EVENTS_MAX_STREAMS')
+status_events = StatusBroker(max_subscribers=events_stream_cap(
+    int(os.environ.get('GUNICORN_THREADS', 64)), int(_max_streams) if _max_streams else None
+))
+FINAL_STATUSES = ('completed', 'cancelled', 'failed')
+
+# /payment/check answers from this worker's status cache. Workers broadcast
+# the statuses they write to the host's other workers over the status bus
+# (see bus.py), so a callback settled by one worker reaches the cache of
+# the worker the page polls. Messages can be lost, so entries expire after
+# STATUS_CACHE_TTL seconds; without the bus only final statuses are trusted
+STATUS_BUS_ENABLED = os.environ.get('STATUS_BUS_ENABLED', 'true').lower() == 'true'
+STATUS_BUS_DIR = os.environ.get('STATUS_BUS_DIR', os.path.join(tempfile.gettempdir(), 'lipia-status-bus'))
+status_cache = TTLCache(
+    maxsize=int(os.environ.get('STATUS_CACHE_SIZE', 50000)),
+    ttl=float(os.environ.get('STATUS_CACHE_TTL', 30))
+)
+STATUS_FIELDS = ('reference', 'amount', 'subscription_type')
+
+def _set_status(checkout_id, status, fields=None, broadcast=False):
+    """
+    Record a checkout's status in this worker and tell its event streams if
+    it changed. Writers pass broadcast=True to tell the host's other workers.
+    """
+    current = ACTIVE_TRANSACTIONS.get(checkout_id)
+    if current in FINAL_STATUSES and status != current:
+        # Final statuses never change: this is a read that started before
+        # the settlement reached this worker, or a late or reordered message
+        return
+    known = {k: v for k, v in (fields or {}).items() if k in STATUS_FIELDS}
+    status_cache.set(checkout_id, dict(status_cache.peek(checkout_id) or {}, **known, status=status))
+    if current != status:
+        ACTIVE_TRANSACTIONS[checkout_id] = status
+        status_events.publish(checkout_id, status)
+    if broadcast and STATUS_BUS_ENABLED:
+        try:
+            status_bus.publish({"checkout_id": checkout_id, "status": status, "fields": known})
+        except OSError as e:
+            current_app.logger.warning(f"Could not broadcast status of {checkout_id}: {e}")
+
+def _on_bus_status(message):
+    _set_status(message["checkout_id"], message["status"], message.get("fields"))
+
+status_bus = Bus(STATUS_BUS_DIR, _on_bus_status, name='status-bus')
+
+def _current_status(checkout_id):
+    """A checkout's status and STATUS_FIELDS, from the status cache or MongoDB; None if it is unknown"""
+    cached = status_cache.get(checkout_id)
+    if cached is not None and 'amount' in cached and (STATUS_BUS_ENABLED or cached['status'] in FINAL_STATUSES):
+        return cached
+    transaction = get_transaction(checkout_id)
+    if not transaction:
+        return None
+    _set_status(checkout_id, transaction.get('status', 'unknown'), transaction)
+    return transaction
+
+@payment_bp.record_once
+def init_status_bus(state):
+    """Join the host's status bus when the blueprint is registered (in each worker)"""
+    if STATUS_BUS_ENABLED:
+        try:
+            status_bus.start()
+        except OSError as e:
+            state.app.logger.error(f"Could not join the status bus in {STATUS_BUS_DIR}: {e}")
+
+def get_status_cache_stats():
+    return dict(status_cache.stats(), bus=status_bus.stats() if STATUS_BUS_ENABLED else None)
 
 # Format phone number for API (same as in Python script)
 def format_phone_for_api(phone):
@@ -57,159 +165,131 @@ def format_phone_for_api(phone):
     current_app.logger.debug(f"Original phone: {phone} -> Formatted for API: {phone}")
     return phone
 
-# Import socket and HTTPServer for callback server
-try:
-    from http.server import HTTPServer, BaseHTTPRequestHandler
-except ImportError:
-    current_app.logger.error("Failed to import HTTPServer. Callbacks may not work.")
-
-# Callback server handler
-class CallbackHandler(BaseHTTPRequestHandler):
-    def log_message(self, format, *args):
-        # Override to use Flask logger
-        if hasattr(current_app, 'logger'):
-            current_app.logger.info(format % args)
-        else:
-            BaseHTTPRequestHandler.log_message(self, format, *args)
-    
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(b'Lipia Callback Server')
-
-    def do_POST(self):
-        try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            
-            # Parse the JSON data from the callback
-            callback_data = json.loads(post_data.decode('utf-8'))
-            if hasattr(current_app, 'logger'):
-                current_app.logger.info(f"Received payment callback: {callback_data}")
-            
-            # Put in queue for processing
-            CALLBACK_QUEUE.put(callback_data)
-            
-            # Send response
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "success"}).encode())
-            
-        except Exception as e:
-            if hasattr(current_app, 'logger'):
-                current_app.logger.error(f"Error in callback handler: {e}")
-            self.send_response(400)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
-
-# Start callback server in a separate thread
-def run_callback_server(host, port):
-    try:
-        server = HTTPServer((host, port), CallbackHandler)
-        if hasattr(current_app, 'logger'):
-            current_app.logger.info(f"Starting callback server on {host}:{port}")
-        server.serve_forever()
-    except Exception as e:
-        if hasattr(current_app, 'logger'):
-            current_app.logger.error(f"Error starting callback server: {e}")
-
-# Find an available port for the callback server
-def find_available_port(start_port=8000, end_port=9000):
-    global CALLBACK_PORT
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    for port in range(start_port, end_port):
-        try:
-            s.bind((CALLBACK_HOST, port))
-            s.close()
-            CALLBACK_PORT = port
-            return port
-        except Exception:
-            continue
-    s.close()
-    return None
-
 # Process callback data
 def process_payment_callback(callback_data):
-    """Process payment callback data"""
-    try:
-        checkout_id = callback_data.get('CheckoutRequestID')
-        if not checkout_id:
-            current_app.logger.warning("Callback missing CheckoutRequestID")
-            return False
+    """
+    Apply a queued payment callback (see callbacks.py). Returns True if it
+    settled the checkout and False if MongoDB has nothing to settle; raises
+    while MongoDB is unavailable, so the callback stays queued and is retried.
+    """
+    checkout_id = callback_data.get('checkout_id') or callback_data.get('CheckoutRequestID')
+    if not checkout_id:
+        current_app.logger.warning("Callback missing CheckoutRequestID")
+        return False
 
-        # Look up transaction
-        transaction = get_transaction(checkout_id)
-        if not transaction:
+    # Settle payment, transaction, user status and credit in one unit of work.
+    # Never in this host's fallback store: the checkout may not be there, and
+    # acknowledging the callback would drop the payment for good
+    reference = callback_data.get('reference')
+    new_word_count = settle_payment(checkout_id, reference, fallback=False)
+    if new_word_count is None:
+        if not get_transaction(checkout_id):
             current_app.logger.warning(f"Transaction not found for checkout_id: {checkout_id}")
-            return False
-
-        # Update transaction status
-        reference = callback_data.get('reference')
-        update_transaction_status(checkout_id, 'completed', reference)
+        else:
+            current_app.logger.warning(f"Ignoring completion callback for settled payment {checkout_id}")
+        return False
 
-        # Update payment record
-        username = transaction['username']
-        amount = transaction['amount']
-        subscription_type = transaction['subscription_type']
+    # Tell this host's workers
+    _set_status(checkout_id, 'completed', {'reference': reference}, broadcast=True)
 
-        # Record payment
-        record_payment(
-            username,
-            amount,
-            subscription_type,
-            'completed',
-            reference,
-            checkout_id
-        )
+    current_app.logger.info(f"Payment {checkout_id} processed, balance now {new_word_count} words")
+    return True
 
-        # Update word count based on subscription type (same as Python script)
-        words_to_add = 100 if subscription_type == 'basic' else 1000
+# STK push dispatch
+def _settle_manually(checkout_id, reason):
+    """Fall back to manual payment processing for a checkout the payment API did not take"""
+    current_app.logger.error(f"Error with payment API for {checkout_id}: {reason}")
+    current_app.logger.info("Falling back to manual payment processing")
+    # Only a checkout that is still pending settles, so a cancelled one stays cancelled
+    reference = f"MANUAL-{checkout_id[4:12]}"
+    if settle_payment(checkout_id, reference) is not None:
+        _set_status(checkout_id, 'completed', {'reference': reference}, broadcast=True)
+
+def send_stk_request(checkout_id, payload, timeout=STK_REQUEST_TIMEOUT):
+    """Send a pending checkout's STK push and apply the API's answer"""
+    if ACTIVE_TRANSACTIONS.get(checkout_id) == 'cancelled':
+        current_app.logger.info(f"Not sending payment request {checkout_id}, it was cancelled")
+        return
+    
+    try:
+        response = lipia.post('request/stk', json=payload, timeout=timeout)
         
-        new_word_count = update_word_count(username, words_to_add)
-
-        # Update ACTIVE_TRANSACTIONS
-        ACTIVE_TRANSACTIONS[checkout_id] = 'completed'
-
-        current_app.logger.info(f"Payment processed for user {username}, added {words_to_add} words")
-        return True
+        current_app.logger.info(f"API Response for {checkout_id}: {response.status_code} - {response.text}")
+        
+        if response.status_code != 200:
+            raise Exception(f"API returned status code {response.status_code}: {response.text}")
+        
+        response_data = response.json()
+        data = response_data.get('data') or {}
+        if response_data.get('message') == 'callback received successfully' and 'data' in response_data:
+            # API returned success
+            reference = data.get('refference')  # Note API spelling
+            if settle_payment(checkout_id, reference) is not None:
+                _set_status(checkout_id, 'completed', {'reference': reference}, broadcast=True)
+        elif 'CheckoutRequestID' in data:
+            # Payment initiated, waiting for callback
+            current_app.logger.info(f"Payment request {checkout_id} sent as {data['CheckoutRequestID']}")
+        else:
+            raise Exception(f"Unexpected API response: {response_data}")
     except Exception as e:
-        current_app.logger.error(f"Error processing callback: {e}")
-        return False
+        _settle_manually(checkout_id, e)
 
-# Function to check queue for callbacks - called periodically
-def check_callbacks():
-    """Check for queued callbacks"""
-    try:
-        while not CALLBACK_QUEUE.empty():
-            callback_data = CALLBACK_QUEUE.get_nowait()
-            process_payment_callback(callback_data)
-    except Exception as e:
-        current_app.logger.error(f"Error in check_callbacks: {e}")
+def _fail_checkout(checkout_id):
+    """Mark a pending checkout whose STK push was never sent as failed, returns False if it had moved on"""
+    if not update_payment_status(checkout_id, 'failed'):
+        return False
+    update_transaction_status(checkout_id, 'failed')
+    _set_status(checkout_id, 'failed', broadcast=True)
+    return True
 
-# Initialize callback server
-def init_callback_server():
-    global callback_server, callback_thread, CALLBACK_PORT
+def dispatch_stk_request(checkout_id, payload):
+    """Queue a pending checkout's STK push, returns False if too many are waiting already"""
+    if not STK_DISPATCH_ENABLED:
+        send_stk_request(checkout_id, payload)
+        return True
     
-    # Find available port
-    port = find_available_port()
-    if not port:
-        current_app.logger.error("Could not find available port for callback server")
-        return False
+    app = current_app._get_current_object()
     
-    current_app.logger.info(f"Starting callback server on port {port}")
+    def run(remaining):
+        with app.app_context():
+            send_stk_request(checkout_id, payload, timeout=min(STK_REQUEST_TIMEOUT, remaining))
     
-    # Start server in a thread
-    callback_thread = threading.Thread(
-        target=run_callback_server, 
-        args=(CALLBACK_HOST, port),
-        daemon=True
-    )
-    callback_thread.start()
+    def expired():
+        with app.app_context():
+            # Nothing was requested from the customer, so nothing is settled
+            current_app.logger.error(f"STK request for {checkout_id} not sent within {STK_DISPATCH_DEADLINE:g}s")
+            _fail_checkout(checkout_id)
     
-    return True
+    return stk_dispatcher.submit(run, STK_DISPATCH_DEADLINE, expired=expired)
+
+def get_stk_dispatch_stats():
+    return stk_dispatcher.stats()
+
+def get_lipia_http_metrics():
+    return lipia.metrics()
+
+@payment_bp.route('/stats', methods=['GET'])
+def payment_stats():
+    """This worker's MongoDB, cache and payment counters"""
+    if not (PAYMENT_STATS_ENABLED or current_app.debug):
+        return jsonify({"status": "error", "message": "Not found"}), 404
+    return jsonify({
+        "status": "success",
+        "pid": os.getpid(),
+        "mongo": {
+            "breaker": get_breaker_metrics(),
+            "sync": get_sync_metrics(),
+            "user_cache": get_user_cache_stats(),
+            "single_flight": get_single_flight_stats(),
+            "word_leases": get_lease_metrics()
+        },
+        "payment": {
+            "stk_dispatch": get_stk_dispatch_stats(),
+            "lipia_http": get_lipia_http_metrics(),
+            "status_cache": get_status_cache_stats(),
+            "events": status_events.stats()
+        }
+    }), 200
 
 # Routes
 @payment_bp.route('/', methods=['GET'])
@@ -221,7 +301,7 @@ def payment_page():
         flash('Please login first', 'error')
         return redirect(url_for('login'))
     
-    user = get_user(username)
+    user = get_user(username, 'payment')
     if not user:
         flash('User not found', 'error')
         return redirect(url_for('login'))
@@ -268,7 +348,7 @@ def initiate_payment():
     
     # Get user data
     try:
-        user = get_user(username)
+        user = get_user(username, 'payment')
         if not user:
             return jsonify({"error": "User not found"}), 404
         
@@ -304,7 +384,7 @@ def initiate_payment():
                 'amount': 0,
                 'phone': phone,
                 'subscription_type': subscription_type,
-                'timestamp': datetime.now(),
+                'timestamp': datetime.utcnow(),
                 'status': 'completed',
                 'reference': f"FREE-PLAN-{checkout_id[:8]}"
             }
@@ -332,15 +412,16 @@ def initiate_payment():
             flash(f"Free plan activated! {words_to_add} words have been added to your account.", "success")
             return redirect(url_for('dashboard'))
         
-        # For paid plans, proceed with payment API
-        # Prepare API request
-        headers = {
-            'Authorization': f'Bearer {API_KEY}',
-            'Content-Type': 'application/json'
-        }
+        # For paid plans, record the checkout as pending and send the STK push
+        # in the background; the waiting page polls until the callback settles it
+        checkout_id = f"STK-{uuid.uuid4()}"
         
-        # Add callback URL to payload
-        callback_url = url_for('payment.payment_callback', _external=True)
+        # The callback names the provider's CheckoutRequestID; ours rides along in the URL.
+        # Where the host runs the callback service (callbacks.py) the provider is sent there
+        if CALLBACK_URL:
+            callback_url = f"{CALLBACK_URL}?checkout_id={checkout_id}"
+        else:
+            callback_url = url_for('payment.payment_callback', checkout_id=checkout_id, _external=True)
         
         payload = {
             'phone': formatted_phone,
@@ -348,145 +429,39 @@ def initiate_payment():
             'callback_url': callback_url
         }
         
-        current_app.logger.info(f"Sending payment request with phone: {formatted_phone}, amount: {amount}")
+        transaction_data = {
+            'checkout_id': checkout_id,
+            'username': username,
+            'amount': amount,
+            'phone': phone,
+            'subscription_type': subscription_type,
+            'timestamp': datetime.utcnow(),
+            'status': 'pending'
+        }
+        save_transaction(checkout_id, transaction_data)
+        record_payment(
+            username,
+            amount,
+            subscription_type,
+            'pending',
+            'N/A',
+            checkout_id
+        )
+        # Every worker can answer the waiting page's polls from here on
+        _set_status(checkout_id, 'pending', transaction_data, broadcast=True)
         
-        # Send payment request to API
-        try:
-            # Try the real API first
-            response = requests.post(
-                f"{API_BASE_URL}/request/stk",
-                headers=headers,
-                json=payload,
-                timeout=15  # Wait up to 15 seconds for response
-            )
-            
-            current_app.logger.info(f"API Response: {response.status_code} - {response.text}")
-            
-            # Process API response
-            if response.status_code == 200:
-                response_data = response.json()
-                if response_data.get('message') == 'callback received successfully' and 'data' in response_data:
-                    # API returned success
-                    data = response_data['data']
-                    checkout_id = data.get('CheckoutRequestID')
-                    reference = data.get('refference')  # Note API spelling
-                    
-                    # Save transaction
-                    transaction_data = {
-                        'checkout_id': checkout_id,
-                        'username': username,
-                        'amount': amount,
-                        'phone': phone,
-                        'subscription_type': subscription_type,
-                        'timestamp': datetime.now(),
-                        'status': 'completed',
-                        'reference': reference
-                    }
-                    save_transaction(checkout_id, transaction_data)
-                    
-                    # Record payment
-                    record_payment(
-                        username,
-                        amount,
-                        subscription_type,
-                        'completed',
-                        reference,
-                        checkout_id
-                    )
-                    
-                    # Update user status
-                    from models import update_user
-                    update_user(username, {'payment_status': 'Paid'})
-                    
-                    # Update word count - modified to match Python script logic
-                    words_to_add = 100 if subscription_type == 'basic' else 1000
-                    new_word_count = update_word_count(username, words_to_add)
-                    
-                    flash(f"Payment successful! {words_to_add} words have been added to your account.", "success")
-                    return redirect(url_for('dashboard'))
-                    
-                elif 'data' in response_data and 'CheckoutRequestID' in response_data['data']:
-                    # Payment initiated, waiting for callback
-                    checkout_id = response_data['data']['CheckoutRequestID']
-                    
-                    # Save transaction
-                    transaction_data = {
-                        'checkout_id': checkout_id,
-                        'username': username,
-                        'amount': amount,
-                        'phone': phone,
-                        'subscription_type': subscription_type,
-                        'timestamp': datetime.now(),
-                        'status': 'pending'
-                    }
-                    save_transaction(checkout_id, transaction_data)
-                    
-                    # Record pending payment
-                    record_payment(
-                        username,
-                        amount,
-                        subscription_type,
-                        'pending',
-                        'N/A',
-                        checkout_id
-                    )
-                    
-                    # Add to ACTIVE_TRANSACTIONS
-                    ACTIVE_TRANSACTIONS[checkout_id] = 'pending'
-                    
-                    # Redirect to payment waiting page
-                    return redirect(url_for('payment.payment_waiting', 
-                                          checkout_id=checkout_id, 
-                                          amount=amount, 
-                                          phone=formatted_phone))
-                else:
-                    # Error in API response
-                    raise Exception(f"Unexpected API response: {response_data}")
-            else:
-                # API returned error status code
-                raise Exception(f"API returned status code {response.status_code}: {response.text}")
-                
-        except Exception as e:
-            current_app.logger.error(f"Error with payment API: {e}")
-            current_app.logger.info("Falling back to manual payment processing")
-            
-            # Fall back to manual processing
-            checkout_id = f"MANUAL-{uuid.uuid4()}"
-            
-            # Save transaction data
-            transaction_data = {
-                'checkout_id': checkout_id,
-                'username': username,
-                'amount': amount,
-                'phone': phone,
-                'subscription_type': subscription_type,
-                'timestamp': datetime.now(),
-                'status': 'completed',
-                'reference': f"MANUAL-{checkout_id[:8]}"
-            }
-            
-            save_transaction(checkout_id, transaction_data)
-            
-            # Record payment
-            record_payment(
-                username,
-                amount,
-                subscription_type,
-                'completed',
-                transaction_data['reference'],
-                checkout_id
-            )
-            
-            # Update user status
-            from models import update_user
-            update_user(username, {'payment_status': 'Paid'})
-            
-            # Update word count
-            words_to_add = 100 if subscription_type == 'basic' else 1000
-            new_word_count = update_word_count(username, words_to_add)
-            
-            flash(f"Payment processed manually. {words_to_add} words have been added to your account.", "success")
-            return redirect(url_for('dashboard'))
+        current_app.logger.info(f"Queueing payment request {checkout_id} with phone: {formatted_phone}, amount: {amount}")
+        
+        if not dispatch_stk_request(checkout_id, payload):
+            # Too many pushes already waiting on the payment API
+            _fail_checkout(checkout_id)
+            flash("The payment service is busy. Please try again in a minute.", "error")
+            return redirect(url_for('payment.payment_page'))
+        
+        return redirect(url_for('payment.payment_waiting', 
+                              checkout_id=checkout_id, 
+                              amount=amount, 
+                              phone=formatted_phone))
         
     except Exception as e:
         current_app.logger.error(f"Error processing payment: {str(e)}")
@@ -502,7 +477,8 @@ def payment_waiting(checkout_id):
     return render_template('payment_waiting.html', 
                           checkout_id=checkout_id,
                           amount=amount,
-                          phone=phone)
+                          phone=phone,
+                          events_enabled=PAYMENT_EVENTS_ENABLED)
 
 @payment_bp.route('/callback', methods=['POST'])
 def payment_callback():
@@ -512,70 +488,31 @@ def payment_callback():
         callback_data = request.json
         current_app.logger.info(f"Received payment callback: {callback_data}")
         
-        # Put in queue for processing
-        CALLBACK_QUEUE.put(callback_data)
-        
-        # Process immediately
-        checkout_id = callback_data.get('CheckoutRequestID')
+        # Checkouts sent by dispatch_stk_request carry our
+        # checkout ID in the callback URL; older ones are keyed by the provider's
+        checkout_id = request.args.get('checkout_id') or callback_data.get('CheckoutRequestID')
         if not checkout_id:
             return jsonify({"status": "error", "message": "Missing checkout ID"}), 400
         
-        # Look up transaction
-        try:
-            transaction = get_transaction(checkout_id)
-            if not transaction:
-                return jsonify({"status": "error", "message": "Transaction not found"}), 404
-        except Exception as e:
-            current_app.logger.error(f"Error getting transaction: {e}")
-            return jsonify({"status": "error", "message": f"Error retrieving transaction: {str(e)}"}), 500
-        
-        # Update transaction status
+        # Settle payment, transaction, user status and credit in one unit of work
         reference = callback_data.get('reference')
         try:
-            update_transaction_status(checkout_id, 'completed', reference)
+            new_word_count = settle_payment(checkout_id, reference)
         except Exception as e:
-            current_app.logger.error(f"Error updating transaction status: {e}")
-            # Continue even if update fails
-        
-        # Update payment record
-        username = transaction['username']
-        amount = transaction['amount']
-        subscription_type = transaction['subscription_type']
+            current_app.logger.error(f"Error settling payment: {e}")
+            return jsonify({"status": "error", "message": f"Error settling payment: {str(e)}"}), 500
         
-        # Record payment
-        try:
-            record_payment(
-                username,
-                amount,
-                subscription_type,
-                'completed',
-                reference,
-                checkout_id
-            )
-        except Exception as e:
-            current_app.logger.error(f"Error recording payment: {e}")
-            # Continue even if record fails
-        
-        # Update user status
-        try:
-            from models import update_user
-            update_user(username, {'payment_status': 'Paid'})
-        except Exception as e:
-            current_app.logger.error(f"Error updating user status: {e}")
-            # Continue even if update fails
+        if new_word_count is None:
+            if not get_transaction(checkout_id):
+                return jsonify({"status": "error", "message": "Transaction not found"}), 404
+            current_app.logger.warning(f"Ignoring completion callback for settled payment {checkout_id}")
+            # Acknowledge so the provider stops redelivering it
+            return jsonify({"status": "success", "message": "Payment already settled"}), 200
         
-        # Update word count
-        try:
-            # Modified to match Python script logic
-            words_to_add = 100 if subscription_type == 'basic' else 1000
-            new_word_count = update_word_count(username, words_to_add)
-            current_app.logger.info(f"Payment callback processed for {username}, {words_to_add} words added")
-        except Exception as e:
-            current_app.logger.error(f"Error updating word count: {e}")
-            # Continue even if update fails
+        current_app.logger.info(f"Payment callback processed for {checkout_id}, balance now {new_word_count} words")
         
-        # Update ACTIVE_TRANSACTIONS
-        ACTIVE_TRANSACTIONS[checkout_id] = 'completed'
+        # Tell this host's workers
+        _set_status(checkout_id, 'completed', {'reference': reference}, broadcast=True)
         
         return jsonify({
             "status": "success",
@@ -593,25 +530,8 @@ def payment_callback():
 def check_payment_status(checkout_id):
     """Check payment status"""
     try:
-        # Check in-memory ACTIVE_TRANSACTIONS first for faster response
-        if checkout_id in ACTIVE_TRANSACTIONS:
-            status = ACTIVE_TRANSACTIONS[checkout_id]
-            if status == 'completed':
-                transaction = get_transaction(checkout_id)
-                return jsonify({
-                    "status": "success",
-                    "transaction": {
-                        "checkout_id": checkout_id,
-                        "status": "completed",
-                        "reference": transaction.get('reference', 'N/A'),
-                        "amount": transaction.get('amount', 0),
-                        "subscription_type": transaction.get('subscription_type', 'unknown'),
-                        "timestamp": datetime.now().isoformat()
-                    }
-                }), 200
-        
-        # Fall back to database check
-        transaction = get_transaction(checkout_id)
+        # This worker's status cache first: settlements anywhere on the host reach it
+        transaction = _current_status(checkout_id)
         
         if not transaction:
             return jsonify({
@@ -619,9 +539,6 @@ def check_payment_status(checkout_id):
                 "message": "Transaction not found"
             }), 404
         
-        # Update ACTIVE_TRANSACTIONS for future checks
-        ACTIVE_TRANSACTIONS[checkout_id] = transaction.get('status', 'unknown')
-        
         return jsonify({
             "status": "success",
             "transaction": {
@@ -640,18 +557,143 @@ def check_payment_status(checkout_id):
             "message": f"Error retrieving transaction: {str(e)}"
         }), 500
 
+def _status_event(event, checkout_id, status=None):
+    """A server-sent event frame"""
+    data = {"checkout_id": checkout_id}
+    if status is not None:
+        data["status"] = status
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@payment_bp.route('/events/<checkout_id>', methods=['GET'])
+def payment_events(checkout_id):
+    """Stream a checkout's status as server-sent events until it settles"""
+    if not PAYMENT_EVENTS_ENABLED:
+        return jsonify({"status": "error", "message": "Event streams are disabled, poll /payment/check"}), 404
+    try:
+        transaction = _current_status(checkout_id)
+        if not transaction:
+            return jsonify({"status": "error", "message": "Transaction not found"}), 404
+        status = transaction.get('status', 'unknown')
+    except Exception as e:
+        current_app.logger.error(f"Error reading payment status: {e}")
+        return jsonify({"status": "error", "message": f"Error retrieving transaction: {str(e)}"}), 500
+    
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if status in FINAL_STATUSES:
+        return Response(_status_event('status', checkout_id, status), mimetype='text/event-stream', headers=headers)
+    
+    subscription = status_events.subscribe(checkout_id)
+    if subscription is None:
+        # Every stream thread of this worker is taken; the page polls instead
+        return jsonify({"status": "error", "message": "Too many open event streams"}), 503, {'Retry-After': '2'}
+    
+    app = current_app._get_current_object()
+    
+    def generate(status):
+        with subscription, app.app_context():
+            yield f"retry: {PAYMENT_EVENTS_RETRY_MS}\n" + _status_event('status', checkout_id, status)
+            end = time.monotonic() + PAYMENT_EVENTS_TIMEOUT
+            while True:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    # The page reconnects for the next stretch
+                    return
+                changed = subscription.wait(min(PAYMENT_EVENTS_HEARTBEAT, remaining))
+                if changed is None:
+                    # The write also tells a closed connection's stream to stop
+                    yield ": heartbeat\n\n"
+                    try:
+                        transaction = _current_status(checkout_id)
+                    except Exception as e:
+                        current_app.logger.error(f"Error reading payment status: {e}")
+                        continue
+                    if not transaction:
+                        continue
+                    changed = transaction.get('status', 'unknown')
+                if changed != status:
+                    status = changed
+                    yield _status_event('status', checkout_id, status)
+                    if status in FINAL_STATUSES:
+                        return
+    
+    response = Response(generate(status), mimetype='text/event-stream', headers=headers)
+    # A stream the server never starts is closed without running generate
+    response.call_on_close(subscription.close)
+    return response
+
 @payment_bp.route('/cancel/<checkout_id>', methods=['POST'])
 def cancel_payment(checkout_id):
-    """Cancel a pending payment"""
-    if checkout_id in ACTIVE_TRANSACTIONS:
-        ACTIVE_TRANSACTIONS[checkout_id] = 'cancelled'
-    
+    """Cancel a pending payment, answers 409 if it has already completed or failed"""
     try:
+        # The payment's transition is the guard, a settled payment stays settled
+        if not update_payment_status(checkout_id, 'cancelled'):
+            return jsonify({"status": "error", "message": "Payment can no longer be cancelled"}), 409
         update_transaction_status(checkout_id, 'cancelled')
+        _set_status(checkout_id, 'cancelled', broadcast=True)
         return jsonify({"status": "success", "message": "Payment cancelled"}), 200
     except Exception as e:
         current_app.logger.error(f"Error cancelling payment: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
-# Start the callback server when this module is imported
-init_callback_server()
\ No newline at end of file
+def _payment_summary(payment):
+    """Public fields of a payment record"""
+    timestamp = payment.get('timestamp')
+    return {
+        "checkout_id": payment.get('checkout_id'),
+        "amount": payment.get('amount', 0),
+        "status": payment.get('status', 'unknown'),
+        "reference": payment.get('reference', 'N/A'),
+        "subscription_type": payment.get('subscription_type', 'unknown'),
+        "timestamp": timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp
+    }
+
+@payment_bp.route('/history', methods=['GET'])
+def payment_history():
+    """Get a page of the current user's payment history"""
+    username = session.get('user_id')
+    if not username:
+        return jsonify({"status": "error", "message": "Authentication required"}), 401
+    
+    try:
+        payments, next_cursor = get_user_payments_page(
+            username,
+            cursor=request.args.get('cursor'),
+            page_size=request.args.get('limit', type=int)
+        )
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Error retrieving payment history: {e}")
+        return jsonify({"status": "error", "message": "Error retrieving payment history"}), 500
+    
+    return jsonify({
+        "status": "success",
+        "payments": [_payment_summary(p) for p in payments],
+        "next_cursor": next_cursor
+    }), 200
+
+@payment_bp.route('/history/export', methods=['GET'])
+def export_payment_history():
+    """Stream the current user's full payment history as CSV"""
+    username = session.get('user_id')
+    if not username:
+        return jsonify({"status": "error", "message": "Authentication required"}), 401
+    
+    fields = ["checkout_id", "amount", "status", "reference", "subscription_type", "timestamp"]
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fields)
+        writer.writeheader()
+        for payment in iter_user_payments(username):
+            writer.writerow(_payment_summary(payment))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={"Content-Disposition": f"attachment; filename=payments-{username}.csv"}
+    )
\ No newline at end of file
@@ -0,0 +1,177 @@
+"""
+On-disk snapshot of the users collection for the fallback tier.
+
+When MongoDB is unreachable at boot the fallback stores start empty. The
+snapshot keeps the auth and balance fields of every user in a file that
+workers memory-map and binary-search in place: nothing is parsed or copied
+up front, the kernel shares the pages between workers, and a lookup touches
+a handful of pages.
+
+Layout: a fixed header, then fixed-width records sorted by the username's
+UTF-8 bytes (NUL padded), which is MongoDB's simple collation order.
+
+    header  magic, version, record size, record count, built_at
+    record  username, pin, phone_number, plan, payment_status, words_remaining
+
+Users with a field too long for its slot are left out and counted. A new
+snapshot is written to a temporary file and renamed over the old one, so
+readers see either snapshot whole; they notice the rename and remap.
+"""
+import os
+import mmap
+import time
+import fcntl
+import struct
+import logging
+import threading
+
+MAGIC = b"LPUSNAP1"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQd")
+RECORD = struct.Struct("<64s16s16s16s16sq")
+USERNAME_BYTES = 64
+
+# Fields stored in each record, in record order
+FIELDS = ("username", "pin", "phone_number", "plan", "payment_status")
+
+
+def _pack(user):
+    values = []
+    for field, size in zip(FIELDS, (64, 16, 16, 16, 16)):
+        value = (user.get(field) or "").encode("utf-8")
+        if len(value) > size:
+            return None
+        values.append(value)
+    return RECORD.pack(*values, int(user.get("words_remaining", 0)))
+
+
+def write(path, users):
+    """Write users (dicts sorted by username) as a snapshot, returns (written, skipped)"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    written = skipped = 0
+    previous = None
+    with open(tmp, "wb") as f:
+        os.chmod(tmp, 0o600)
+        f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, 0, 0.0))
+        for user in users:
+            record = _pack(user)
+            if record is None:
+                skipped += 1
+                continue
+            key = record[:USERNAME_BYTES]
+            if previous is not None and key <= previous:
+                os.unlink(tmp)
+                raise ValueError(f"Users are not sorted by username at {user.get('username')!r}")
+            previous = key
+            f.write(record)
+            written += 1
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, written, time.time()))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return written, skipped
+
+
+def build(db, path, batch_size=5000):
+    """Write a snapshot of db.users, returns (written, skipped) or None if another process is building"""
+    with open(f"{path}.lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        projection = dict.fromkeys(FIELDS + ("words_remaining",), 1)
+        projection["_id"] = 0
+        # Served in order by the unique username index
+        users = db.users.find({}, projection).sort("username", 1).batch_size(batch_size)
+        return write(path, users)
+
+
+def age(path):
+    """Seconds since the snapshot was written, or None if there is none"""
+    try:
+        return time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+class UserSnapshot:
+    """Lazily mapped, read-only view of a snapshot file"""
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mapped = None
+        self._identity = None
+        self._checked_at = 0.0
+
+    def _open(self):
+        try:
+            with open(self.path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size < HEADER.size:
+                    return None
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        magic, version, record_size, count, built_at = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size \
+                or HEADER.size + count * record_size > len(mapped):
+            logging.error(f"Ignoring user snapshot {self.path}: unrecognised or truncated")
+            mapped.close()
+            return None
+        self._identity = (stat.st_ino, stat.st_mtime_ns)
+        return mapped, count, built_at
+
+    def _current(self):
+        now = time.monotonic()
+        if self._mapped is not None and now - self._checked_at < self.check_interval:
+            return self._mapped
+        with self._lock:
+            if self._mapped is None or now - self._checked_at >= self.check_interval:
+                self._checked_at = now
+                try:
+                    stat = os.stat(self.path)
+                    changed = (stat.st_ino, stat.st_mtime_ns) != self._identity
+                except FileNotFoundError:
+                    changed = False
+                if self._mapped is None or changed:
+                    # The old map stays valid for readers still holding it
+                    self._mapped = self._open() or self._mapped
+            return self._mapped
+
+    def __len__(self):
+        current = self._current()
+        return current[1] if current else 0
+
+    @property
+    def built_at(self):
+        current = self._current()
+        return current[2] if current else None
+
+    def get(self, username):
+        """Get a user's snapshot fields as a dict, or None"""
+        current = self._current()
+        if current is None:
+            return None
+        mapped, count, _ = current
+        key = username.encode("utf-8")
+        if len(key) > USERNAME_BYTES:
+            return None
+        key = key.ljust(USERNAME_BYTES, b"\0")
+
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER.size + mid * RECORD.size
+            probe = mapped[offset:offset + USERNAME_BYTES]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                values = RECORD.unpack_from(mapped, offset)
+                user = {field: value.rstrip(b"\0").decode("utf-8") for field, value in zip(FIELDS, values)}
+                user["words_remaining"] = values[-1]
+                return user
+        return None
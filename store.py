@@ -0,0 +1,673 @@
+"""
+Fallback stores used by models.py while MongoDB is unavailable.
+
+UserStore and TransactionStore keep records in the worker's memory.
+SQLiteUserStore and SQLiteTransactionStore implement the same interface on
+a host-local SQLite database shared by all gunicorn workers.
+
+A user record's words_synced is the MongoDB balance its words_remaining
+was last aligned with. Local debits and credits move words_remaining
+only, so their difference is the change still to be applied to MongoDB as
+an increment. Writes that mirror MongoDB (dirty=False) move both and keep
+that difference.
+"""
+import os
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class DirtyTracker:
+    """
+    Tracks which keys changed since they were last written to MongoDB.
+
+    Every change bumps a generation number so a record modified while a sync
+    is in flight stays dirty after that sync acknowledges the older version.
+    When a journal is attached, each change is also appended to it as a full
+    record image.
+    """
+    def __init__(self, kind):
+        self.kind = kind
+        self.journal = None
+        self._dirty_lock = threading.Lock()
+        self._dirty = {}
+        self._generation = 0
+
+    def mark_dirty(self, key, record=None):
+        """Record a change, returns a journal sequence number to commit() or None"""
+        with self._dirty_lock:
+            self._generation += 1
+            self._dirty[key] = self._generation
+        if self.journal is not None and record is not None:
+            return self.journal.append(self.kind, key, record)
+        return None
+
+    def commit(self, seq):
+        """Wait for a change returned by mark_dirty to be durable"""
+        if seq is not None:
+            self.journal.wait(seq)
+
+    def dirty_count(self):
+        return len(self._dirty)
+
+    def take_dirty(self):
+        """Snapshot the dirty keys as (key, generation) pairs"""
+        with self._dirty_lock:
+            return list(self._dirty.items())
+
+    def mark_clean(self, pairs):
+        """Clear keys whose generation has not moved since take_dirty"""
+        with self._dirty_lock:
+            for key, generation in pairs:
+                if self._dirty.get(key) == generation:
+                    del self._dirty[key]
+
+
+def _mirror(record, fields):
+    """Merge fields MongoDB already has into a record, keeping its unsynced balance change"""
+    if "words_remaining" in fields:
+        pending = record.get("words_remaining", 0) - record.get("words_synced", 0)
+        record.update(fields)
+        record["words_synced"] = fields["words_remaining"]
+        record["words_remaining"] = fields["words_remaining"] + pending
+    else:
+        record.update(fields)
+
+
+def _pin_words_sync(record, op):
+    """Fix the record's unsynced balance change under op unless one is pinned, returns True if pinned"""
+    if "words_synced" not in record or record.get("words_sync"):
+        return False
+    delta = record.get("words_remaining", 0) - record["words_synced"]
+    if not delta:
+        return False
+    record["words_sync"] = {"op": op, "delta": delta}
+    return True
+
+
+def _settle_words_sync(record, op):
+    """Count a pinned balance change as applied in MongoDB, once"""
+    pin = record.get("words_sync")
+    if pin and pin["op"] == op:
+        record["words_synced"] = record.get("words_synced", 0) + pin["delta"]
+        record["words_sync"] = None
+
+
+class UserStore(dict):
+    """
+    Fallback users keyed by username, in the in-memory shape models.py uses
+    (password, plan, words_remaining, phone_number, payment_status, ...).
+
+    Reads behave like a plain dict. Writes go through __setitem__ or
+    update_fields so they can be tracked for the MongoDB sync.
+    """
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.RLock()
+        self.changes = DirtyTracker('user')
+        # Per-user locks serializing balance changes
+        self._balance_locks = {}
+
+    def __setitem__(self, username, record):
+        self.put(username, record)
+
+    def put(self, username, record, dirty=True):
+        """Replace a user's record"""
+        seq = None
+        with self.lock:
+            if not dirty:
+                record["words_synced"] = record.get("words_remaining", 0)
+            record.setdefault("words_synced", 0)
+            super().__setitem__(username, record)
+            if dirty:
+                seq = self.changes.mark_dirty(username, record)
+        self.changes.commit(seq)
+
+    def put_if_absent(self, username, record):
+        """Add a user MongoDB already has unless one is stored, returns the stored record"""
+        with self.lock:
+            if username not in self:
+                self.put(username, record, dirty=False)
+            return self.get(username)
+
+    def update_fields(self, username, fields, dirty=True):
+        """Merge fields into an existing user, returns False if missing"""
+        seq = None
+        with self.lock:
+            record = self.get(username)
+            if record is None:
+                return False
+            if dirty:
+                record.update(fields)
+                seq = self.changes.mark_dirty(username, record)
+            else:
+                _mirror(record, fields)
+        self.changes.commit(seq)
+        return True
+
+    def pin_words_sync(self, username, op):
+        """Pin the user's unsynced balance change under op, see _pin_words_sync"""
+        seq = None
+        with self.lock:
+            record = self.get(username)
+            if record is None or not _pin_words_sync(record, op):
+                return False
+            seq = self.changes.mark_dirty(username, record)
+        self.changes.commit(seq)
+        return True
+
+    def settle_words_sync(self, username, op):
+        """Count the user's balance change pinned as op as applied in MongoDB"""
+        with self.lock:
+            record = self.get(username)
+            if record is not None:
+                _settle_words_sync(record, op)
+
+    def restore(self, username, record):
+        """Load a replayed record as unsynced, without journaling it again"""
+        with self.lock:
+            super().__setitem__(username, record)
+            self.changes.mark_dirty(username)
+
+    def prune_clean(self):
+        """Drop users with no change left to sync to MongoDB, returns how many"""
+        with self.lock:
+            dirty = {username for username, _ in self.changes.take_dirty()}
+            clean = [username for username in self if username not in dirty]
+            for username in clean:
+                del self[username]
+        return len(clean)
+
+    def _balance_lock(self, username):
+        with self.lock:
+            lock = self._balance_locks.get(username)
+            if lock is None:
+                lock = self._balance_locks[username] = threading.Lock()
+            return lock
+
+    def add_words(self, username, words_to_add):
+        """Credit words, returns the new balance or None if the user is missing"""
+        with self._balance_lock(username):
+            record = self.get(username)
+            if record is None:
+                return None
+            new_count = record.get("words_remaining", 0) + words_to_add
+            self.update_fields(username, {"words_remaining": new_count})
+            return new_count
+
+    def consume_words(self, username, words_to_use):
+        """Compare-and-decrement, returns (success, remaining) or None if the user is missing"""
+        with self._balance_lock(username):
+            record = self.get(username)
+            if record is None:
+                return None
+            current_words = record.get("words_remaining", 0)
+            if current_words < words_to_use:
+                return False, current_words
+            self.update_fields(username, {"words_remaining": current_words - words_to_use})
+            return True, current_words - words_to_use
+
+
+class TransactionStore:
+    """
+    Fallback transaction/payment records with a primary hash index on the
+    transaction (checkout) id and secondary indexes by username and status.
+
+    Records use the in-memory shape models.py has always used:
+    transaction_id, user_id, phone_number, amount, date, status, reference,
+    subscription_type.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._records = {}
+        # username -> {transaction_id: None}, a dict keeps insertion order
+        self._by_user = {}
+        # status -> {transaction_id}
+        self._by_status = {}
+        self.changes = DirtyTracker('transaction')
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._records
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._records.values()))
+
+    def _index(self, transaction_id, record):
+        user = record.get('user_id')
+        if user is not None:
+            self._by_user.setdefault(user, {})[transaction_id] = None
+        self._by_status.setdefault(record.get('status'), set()).add(transaction_id)
+
+    def _unindex(self, transaction_id, record):
+        user_ids = self._by_user.get(record.get('user_id'))
+        if user_ids is not None:
+            user_ids.pop(transaction_id, None)
+            if not user_ids:
+                del self._by_user[record.get('user_id')]
+        status_ids = self._by_status.get(record.get('status'))
+        if status_ids is not None:
+            status_ids.discard(transaction_id)
+            if not status_ids:
+                del self._by_status[record.get('status')]
+
+    def get(self, transaction_id):
+        """Get a record by transaction id, or None"""
+        return self._records.get(transaction_id)
+
+    def upsert(self, transaction_id, fields, defaults=None, dirty=True, allowed_from=None):
+        """
+        Insert or merge a record; defaults are only applied on insert.
+
+        With allowed_from, an existing record is only merged while its status
+        is one of those and None is returned otherwise.
+        """
+        seq = None
+        with self._lock:
+            record = self._records.get(transaction_id)
+            if record is not None and allowed_from is not None and record.get('status') not in allowed_from:
+                return None
+            if record is None:
+                record = dict(defaults or {})
+                record.update(fields)
+                record['transaction_id'] = transaction_id
+                self._records[transaction_id] = record
+            else:
+                self._unindex(transaction_id, record)
+                record.update(fields)
+            self._index(transaction_id, record)
+            if dirty:
+                seq = self.changes.mark_dirty(transaction_id, record)
+        self.changes.commit(seq)
+        return record
+
+    def update(self, transaction_id, fields, dirty=True, allowed_from=None):
+        """Update an existing record, returns False if it does not exist or its status is not in allowed_from"""
+        seq = None
+        with self._lock:
+            record = self._records.get(transaction_id)
+            if record is None or (allowed_from is not None and record.get('status') not in allowed_from):
+                return False
+            self._unindex(transaction_id, record)
+            record.update(fields)
+            self._index(transaction_id, record)
+            if dirty:
+                seq = self.changes.mark_dirty(transaction_id, record)
+        self.changes.commit(seq)
+        return True
+
+    def restore(self, transaction_id, record):
+        """Load a replayed record as unsynced, without journaling it again"""
+        with self._lock:
+            existing = self._records.get(transaction_id)
+            if existing is not None:
+                self._unindex(transaction_id, existing)
+            self._records[transaction_id] = record
+            self._index(transaction_id, record)
+            self.changes.mark_dirty(transaction_id)
+
+    def for_user(self, username):
+        """Get a user's records in insertion order"""
+        with self._lock:
+            return [self._records[t] for t in self._by_user.get(username, ())]
+
+    def with_status(self, status):
+        """Get all records currently in the given status"""
+        with self._lock:
+            return [self._records[t] for t in self._by_status.get(status, ())]
+
+    def prune_clean(self):
+        """Drop records with no change left to sync to MongoDB, returns how many"""
+        with self._lock:
+            dirty = {transaction_id for transaction_id, _ in self.changes.take_dirty()}
+            clean = [transaction_id for transaction_id in self._records if transaction_id not in dirty]
+            for transaction_id in clean:
+                self._unindex(transaction_id, self._records.pop(transaction_id))
+        return len(clean)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._by_user.clear()
+            self._by_status.clear()
+
+
+class SQLiteFallbackDB:
+    """
+    Host-local SQLite database (WAL mode) shared by every worker process as
+    the fallback tier, so users and transactions written by one gunicorn
+    worker during an outage are visible to all of them.
+
+    Connections are opened per thread and per process, so the object can be
+    created before gunicorn forks.
+    """
+    def __init__(self, path, busy_timeout=5.0, synchronous='NORMAL'):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self.connect().executescript(SQLITE_SCHEMA)
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={self.synchronous}')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run statements in a write transaction taken up front (BEGIN IMMEDIATE)"""
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    record TEXT NOT NULL,
+    words_remaining INTEGER NOT NULL DEFAULT 0,
+    dirty INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_dirty ON users (dirty) WHERE dirty > 0;
+CREATE TABLE IF NOT EXISTS transactions (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    transaction_id TEXT NOT NULL UNIQUE,
+    user_id TEXT,
+    status TEXT,
+    record TEXT NOT NULL,
+    dirty INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS transactions_user ON transactions (user_id, seq);
+CREATE INDEX IF NOT EXISTS transactions_status ON transactions (status);
+CREATE INDEX IF NOT EXISTS transactions_dirty ON transactions (dirty) WHERE dirty > 0;
+"""
+
+
+def _dumps(record):
+    return json.dumps(record, default=str, separators=(',', ':'))
+
+
+class SQLiteChanges:
+    """
+    Dirty tracking for a SQLite fallback table. The dirty column holds a
+    per-row generation that every unsynced write bumps; 0 means in sync.
+    """
+    journal = None
+
+    def __init__(self, db, kind, table, key):
+        self.db = db
+        self.kind = kind
+        self._table = table
+        self._key = key
+
+    def mark_dirty(self, key, record=None):
+        with self.db.transaction() as conn:
+            conn.execute(f"UPDATE {self._table} SET dirty = dirty + 1 WHERE {self._key} = ?", (key,))
+        return None
+
+    def commit(self, seq):
+        pass
+
+    def dirty_count(self):
+        return self.db.connect().execute(f"SELECT COUNT(*) FROM {self._table} WHERE dirty > 0").fetchone()[0]
+
+    def take_dirty(self):
+        return self.db.connect().execute(
+            f"SELECT {self._key}, dirty FROM {self._table} WHERE dirty > 0"
+        ).fetchall()
+
+    def mark_clean(self, pairs):
+        with self.db.transaction() as conn:
+            conn.executemany(
+                f"UPDATE {self._table} SET dirty = 0 WHERE {self._key} = ? AND dirty = ?",
+                [(key, generation) for key, generation in pairs]
+            )
+
+
+class SQLiteUserStore:
+    """UserStore backed by the shared SQLite fallback database"""
+    def __init__(self, db):
+        self.db = db
+        self.changes = SQLiteChanges(db, 'user', 'users', 'username')
+
+    def _load(self, row):
+        record = json.loads(row[0])
+        record["words_remaining"] = row[1]
+        return record
+
+    def __contains__(self, username):
+        return self.db.connect().execute(
+            "SELECT 1 FROM users WHERE username = ?", (username,)
+        ).fetchone() is not None
+
+    def __len__(self):
+        return self.db.connect().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def __getitem__(self, username):
+        record = self.get(username)
+        if record is None:
+            raise KeyError(username)
+        return record
+
+    def __setitem__(self, username, record):
+        self.put(username, record)
+
+    def get(self, username, default=None):
+        row = self.db.connect().execute(
+            "SELECT record, words_remaining FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        return self._load(row) if row else default
+
+    def items(self):
+        rows = self.db.connect().execute("SELECT username, record, words_remaining FROM users").fetchall()
+        return [(row[0], self._load(row[1:])) for row in rows]
+
+    def put(self, username, record, dirty=True):
+        """Replace a user's record"""
+        if not dirty:
+            record["words_synced"] = record.get("words_remaining", 0)
+        record.setdefault("words_synced", 0)
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO users (username, record, words_remaining, dirty) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (username) DO UPDATE SET record = excluded.record, "
+                "words_remaining = excluded.words_remaining, dirty = dirty + excluded.dirty",
+                (username, _dumps(record), record.get("words_remaining", 0), 1 if dirty else 0)
+            )
+
+    def put_if_absent(self, username, record):
+        """Add a user MongoDB already has unless one is stored, returns the stored record"""
+        record = dict(record, words_synced=record.get("words_remaining", 0))
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO users (username, record, words_remaining, dirty) VALUES (?, ?, ?, 0)",
+                (username, _dumps(record), record.get("words_remaining", 0))
+            )
+        return self.get(username)
+
+    def update_fields(self, username, fields, dirty=True):
+        """Merge fields into an existing user, returns False if missing"""
+        # Mirroring MongoDB only touches users stored here, check without the write lock
+        if not dirty and username not in self:
+            return False
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                "SELECT record, words_remaining FROM users WHERE username = ?", (username,)
+            ).fetchone()
+            if row is None:
+                return False
+            record = self._load(row)
+            if dirty:
+                record.update(fields)
+            else:
+                _mirror(record, fields)
+            conn.execute(
+                "UPDATE users SET record = ?, words_remaining = ?, dirty = dirty + ? WHERE username = ?",
+                (_dumps(record), record.get("words_remaining", 0), 1 if dirty else 0, username)
+            )
+            return True
+
+    def restore(self, username, record):
+        self.put(username, record)
+
+    def prune_clean(self):
+        """Drop users with no change left to sync to MongoDB, returns how many"""
+        with self.db.transaction() as conn:
+            return conn.execute("DELETE FROM users WHERE dirty = 0").rowcount
+
+    def pin_words_sync(self, username, op):
+        """Pin the user's unsynced balance change under op, see _pin_words_sync"""
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                "SELECT record, words_remaining FROM users WHERE username = ?", (username,)
+            ).fetchone()
+            if row is None:
+                return False
+            record = self._load(row)
+            if not _pin_words_sync(record, op):
+                return False
+            conn.execute(
+                "UPDATE users SET record = ?, dirty = dirty + 1 WHERE username = ?",
+                (_dumps(record), username)
+            )
+            return True
+
+    def settle_words_sync(self, username, op):
+        """Count the user's balance change pinned as op as applied in MongoDB"""
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                "SELECT record, words_remaining FROM users WHERE username = ?", (username,)
+            ).fetchone()
+            if row is not None:
+                record = self._load(row)
+                _settle_words_sync(record, op)
+                conn.execute("UPDATE users SET record = ? WHERE username = ?", (_dumps(record), username))
+
+    def add_words(self, username, words_to_add):
+        """Credit words, returns the new balance or None if the user is missing"""
+        with self.db.transaction() as conn:
+            conn.execute(
+                "UPDATE users SET words_remaining = words_remaining + ?, dirty = dirty + 1 WHERE username = ?",
+                (words_to_add, username)
+            )
+            row = conn.execute("SELECT words_remaining FROM users WHERE username = ?", (username,)).fetchone()
+            return row[0] if row else None
+
+    def consume_words(self, username, words_to_use):
+        """Compare-and-decrement, returns (success, remaining) or None if the user is missing"""
+        with self.db.transaction() as conn:
+            debited = conn.execute(
+                "UPDATE users SET words_remaining = words_remaining - ?, dirty = dirty + 1 "
+                "WHERE username = ? AND words_remaining >= ?",
+                (words_to_use, username, words_to_use)
+            ).rowcount
+            row = conn.execute("SELECT words_remaining FROM users WHERE username = ?", (username,)).fetchone()
+            if row is None:
+                return None
+            return bool(debited), row[0]
+
+
+class SQLiteTransactionStore:
+    """TransactionStore backed by the shared SQLite fallback database"""
+    def __init__(self, db):
+        self.db = db
+        self.changes = SQLiteChanges(db, 'transaction', 'transactions', 'transaction_id')
+
+    def __len__(self):
+        return self.db.connect().execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+
+    def __contains__(self, transaction_id):
+        return self.db.connect().execute(
+            "SELECT 1 FROM transactions WHERE transaction_id = ?", (transaction_id,)
+        ).fetchone() is not None
+
+    def __iter__(self):
+        rows = self.db.connect().execute("SELECT record FROM transactions ORDER BY seq").fetchall()
+        return iter([json.loads(row[0]) for row in rows])
+
+    def get(self, transaction_id):
+        """Get a record by transaction id, or None"""
+        row = self.db.connect().execute(
+            "SELECT record FROM transactions WHERE transaction_id = ?", (transaction_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, conn, transaction_id, record, dirty):
+        conn.execute(
+            "INSERT INTO transactions (transaction_id, user_id, status, record, dirty) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (transaction_id) DO UPDATE SET user_id = excluded.user_id, status = excluded.status, "
+            "record = excluded.record, dirty = dirty + excluded.dirty",
+            (transaction_id, record.get('user_id'), record.get('status'), _dumps(record), 1 if dirty else 0)
+        )
+
+    def upsert(self, transaction_id, fields, defaults=None, dirty=True, allowed_from=None):
+        """Insert or merge a record; see TransactionStore.upsert"""
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                "SELECT record FROM transactions WHERE transaction_id = ?", (transaction_id,)
+            ).fetchone()
+            if row is None:
+                record = dict(defaults or {})
+                record['transaction_id'] = transaction_id
+            else:
+                record = json.loads(row[0])
+                if allowed_from is not None and record.get('status') not in allowed_from:
+                    return None
+            record.update(fields)
+            self._write(conn, transaction_id, record, dirty)
+            return record
+
+    def update(self, transaction_id, fields, dirty=True, allowed_from=None):
+        """Update an existing record, returns False if it does not exist or its status is not in allowed_from"""
+        # Mirroring MongoDB only touches records stored here, check without the write lock
+        if not dirty and transaction_id not in self:
+            return False
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                "SELECT record FROM transactions WHERE transaction_id = ?", (transaction_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            record = json.loads(row[0])
+            if allowed_from is not None and record.get('status') not in allowed_from:
+                return False
+            record.update(fields)
+            self._write(conn, transaction_id, record, dirty)
+            return True
+
+    def restore(self, transaction_id, record):
+        with self.db.transaction() as conn:
+            self._write(conn, transaction_id, record, True)
+
+    def prune_clean(self):
+        """Drop records with no change left to sync to MongoDB, returns how many"""
+        with self.db.transaction() as conn:
+            return conn.execute("DELETE FROM transactions WHERE dirty = 0").rowcount
+
+    def for_user(self, username):
+        """Get a user's records in insertion order"""
+        rows = self.db.connect().execute(
+            "SELECT record FROM transactions WHERE user_id = ? ORDER BY seq", (username,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def with_status(self, status):
+        """Get all records currently in the given status"""
+        rows = self.db.connect().execute(
+            "SELECT record FROM transactions WHERE status = ?", (status,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
@@ -0,0 +1,166 @@
+"""
+Account summary embedded in the user document.
+
+The account view needs the balance, plan, payment status, the last few
+payments and this month's usage. The first three are fields of the user
+document already; the summary sub-document adds the rest, so the view is
+one point read by username:
+
+    summary.recent_payments  newest first, at most SUMMARY_PAYMENTS
+    summary.usage.<YYYY-MM>  words spent that month
+    summary.built_at         set when the summary was built in full
+
+It is kept up to date by the writes that change its sources: the ledger
+adds usage as it folds debits (ledger.USAGE_REASONS), record_payment
+pushes new payments, and status changes - settlement included - update
+the payment's entry in place. rebuild() recomputes summaries from
+payments and word_ledger in bulk, for users created before summaries and
+to repair drift. A summary without built_at has not been rebuilt yet and
+readers should not trust it.
+"""
+import os
+import itertools
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+import archive
+import ledger
+
+SUMMARY_PAYMENTS = int(os.environ.get('ACCOUNT_SUMMARY_PAYMENTS', 5))
+SUMMARY_MONTHS = int(os.environ.get('ACCOUNT_SUMMARY_MONTHS', 3))
+
+# Payment fields copied into summary.recent_payments
+PAYMENT_FIELDS = ("checkout_id", "amount", "subscription_type", "status", "reference", "timestamp")
+
+HISTORY_SORT = [("timestamp", -1), ("_id", -1)]
+
+
+def empty():
+    """The summary of a user with no payments or usage"""
+    return {"recent_payments": [], "usage": {}, "built_at": datetime.now()}
+
+
+def payment_entry(payment):
+    return {field: payment.get(field) for field in PAYMENT_FIELDS}
+
+
+def push_payment(db, username, payment, session=None):
+    """Add a new payment to the front of the user's recent payments, once"""
+    db.users.update_one(
+        {"username": username, "summary.recent_payments.checkout_id": {"$ne": payment["checkout_id"]}},
+        {"$push": {"summary.recent_payments": {
+            "$each": [payment_entry(payment)], "$position": 0, "$slice": SUMMARY_PAYMENTS
+        }}},
+        session=session
+    )
+
+
+def update_payment(db, username, checkout_id, fields, session=None):
+    """Apply a payment's new field values to its entry in the user's recent payments, if it has one"""
+    # Matching the entry in the filter makes this a no-op for payments
+    # that dropped off the list and for users without a summary
+    db.users.update_one(
+        {"username": username, "summary.recent_payments.checkout_id": checkout_id},
+        {"$set": {f"summary.recent_payments.$.{field}": value for field, value in fields.items()}},
+        session=session
+    )
+
+
+def month_to_date(account_summary, now=None):
+    """Words spent this month according to a summary"""
+    return account_summary.get("usage", {}).get(f"{now or datetime.now():%Y-%m}", 0)
+
+
+def _first_of_month(now, months_back):
+    year, month = now.year, now.month - months_back
+    while month < 1:
+        year, month = year - 1, month + 12
+    return datetime(year, month, 1)
+
+
+def _recent_payments(db, username):
+    """The user's newest payments across both tiers"""
+    hot = db.payments.find({"username": username}).sort(HISTORY_SORT).limit(SUMMARY_PAYMENTS)
+    cold = db.payments_archive.find({"username": username}).sort(HISTORY_SORT).limit(SUMMARY_PAYMENTS)
+    merged = archive.merge_newest_first(list(hot), cold, lambda p: (p["timestamp"], p["_id"]))
+    return [payment_entry(p) for p in itertools.islice(merged, SUMMARY_PAYMENTS)]
+
+
+def _usage(db, usernames, now):
+    """{username: {month: words}} for the last SUMMARY_MONTHS months, from the ledger"""
+    pipeline = [
+        {"$match": {
+            "username": {"$in": list(usernames)},
+            "at": {"$gte": _first_of_month(now, SUMMARY_MONTHS - 1)},
+            "reason": {"$in": sorted(ledger.USAGE_REASONS)}
+        }},
+        {"$group": {
+            "_id": {"username": "$username", "month": {"$dateToString": {"format": "%Y-%m", "date": "$at"}}},
+            "words": {"$sum": {"$subtract": [0, "$delta"]}}
+        }}
+    ]
+    usage = {}
+    for row in db.word_ledger.aggregate(pipeline):
+        usage.setdefault(row["_id"]["username"], {})[row["_id"]["month"]] = row["words"]
+    return usage
+
+
+def build(db, username, now=None):
+    """Compute a user's summary from payments and word_ledger"""
+    now = now or datetime.now()
+    return dict(empty(), recent_payments=_recent_payments(db, username), usage=_usage(db, [username], now).get(username, {}))
+
+
+def rebuild(db, usernames=None, batch_size=500, log=None):
+    """
+    Rebuild summaries from payments and word_ledger, returns counts.
+
+    Rebuilds every user, or just usernames. Each write only applies if
+    the user's summary and ledger_ops are unchanged since they were read,
+    so a rebuild never overwrites a payment or debit that landed while it
+    ran; those users are counted as raced and picked up by the next run.
+    """
+    counts = {"users": 0, "rebuilt": 0, "unchanged": 0, "raced": 0}
+    query = {} if usernames is None else {"username": {"$in": list(usernames)}}
+    cursor = db.users.find(query, {"username": 1, "summary": 1, "ledger_ops": 1}).sort("username", 1).batch_size(batch_size)
+
+    batch = []
+    for user in cursor:
+        batch.append(user)
+        if len(batch) >= batch_size:
+            _rebuild_batch(db, batch, counts)
+            batch = []
+            if log:
+                log(f"Rebuilt account summaries: {counts}")
+    if batch:
+        _rebuild_batch(db, batch, counts)
+    return counts
+
+
+def _rebuild_batch(db, users, counts):
+    now = datetime.now()
+    usage = _usage(db, [user["username"] for user in users], now)
+    ops = []
+    for user in users:
+        counts["users"] += 1
+        username = user["username"]
+        current = user.get("summary")
+        rebuilt = {
+            "recent_payments": _recent_payments(db, username),
+            "usage": usage.get(username, {}),
+        }
+        if current is not None and current.get("built_at") and all(current.get(k) == v for k, v in rebuilt.items()):
+            counts["unchanged"] += 1
+            continue
+        rebuilt["built_at"] = now
+        guard = {
+            "username": username,
+            "summary": current if current is not None else {"$exists": False},
+            "ledger_ops": user["ledger_ops"] if "ledger_ops" in user else {"$exists": False}
+        }
+        ops.append(UpdateOne(guard, {"$set": {"summary": rebuilt}}))
+    if ops:
+        result = db.users.bulk_write(ops, ordered=False)
+        counts["rebuilt"] += result.modified_count
+        counts["raced"] += len(ops) - result.matched_count
@@ -0,0 +1,72 @@
+"""
+Tests run against the modules in the repository root. They keep the fallback
+store in memory and their files in a temporary directory, and tests that
+need a live MongoDB read its URI from TEST_MONGO_URI and are skipped when
+it is unset or unreachable. Tests of MongoDB logic that needs no server
+features use mock_db, an in-process mongomock database.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_scratch = tempfile.mkdtemp(prefix='lipia-tests-')
+os.environ.setdefault('FALLBACK_STORE', 'memory')
+os.environ.setdefault('FALLBACK_JOURNAL_ENABLED', 'false')
+os.environ.setdefault('USER_SNAPSHOT_PATH', os.path.join(_scratch, 'users_snapshot.bin'))
+os.environ.setdefault('STATUS_BUS_DIR', os.path.join(_scratch, 'status-bus'))
+# No background archiving or snapshot writes behind a test's back
+os.environ.setdefault('ARCHIVE_INTERVAL', '0')
+os.environ.setdefault('USER_SNAPSHOT_INTERVAL', '0')
+
+
+@pytest.fixture
+def app():
+    from flask import Flask
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture(scope='session')
+def mongo_db():
+    """A live test database, dropped afterwards; skips the test without one"""
+    uri = os.environ.get('TEST_MONGO_URI')
+    if not uri:
+        pytest.skip("TEST_MONGO_URI is not set")
+    import models
+    os.environ.setdefault('MONGO_DBNAME', 'lipia_test')
+    client = models.create_mongo_client(models.resolve_mongo_uri(uri))
+    try:
+        client.admin.command('ping')
+    except Exception as e:
+        pytest.skip(f"MongoDB at TEST_MONGO_URI is unreachable: {e}")
+    db = client.get_database()
+    yield db
+    client.drop_database(db.name)
+    client.close()
+
+
+@pytest.fixture
+def mock_db():
+    """A fresh in-process mongomock database"""
+    mongomock = pytest.importorskip('mongomock')
+    return mongomock.MongoClient('mongodb://localhost/lipia_test').get_database()
+
+
+@pytest.fixture
+def mock_mongo(monkeypatch, mock_db):
+    """models connected to mock_db, put back afterwards"""
+    import models
+    for name in ('mongo_client', '_client_pid', '_handles'):
+        monkeypatch.setattr(models, name, getattr(models, name))
+    monkeypatch.setattr(models, 'mongo_connected', True)
+    models._set_client(mock_db.client)
+    models.user_cache.clear()
+    yield mock_db
+    models.user_cache.clear()
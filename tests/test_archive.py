@@ -0,0 +1,64 @@
+"""
+Archiving passes against TEST_MONGO_URI: rows move in timestamp order, and a
+row the archive refuses stays hot without holding up the rows behind it.
+mongomock's bulk_write does not take pymongo's ReplaceOne, so these need a
+server.
+"""
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import archive
+
+
+@pytest.fixture
+def db(mongo_db):
+    """A database of its own, archiving scans whole collections"""
+    db = mongo_db.client[f"{mongo_db.name}_archive_{uuid.uuid4().hex[:8]}"]
+    yield db
+    mongo_db.client.drop_database(db.name)
+
+
+def seed(db, count, age_days=100, status="completed"):
+    old = datetime.utcnow() - timedelta(days=age_days)
+    db.transactions.insert_many([
+        {"_id": f"ws_CO_{i}", "checkout_id": f"ws_CO_{i}", "status": status, "timestamp": old + timedelta(seconds=i)}
+        for i in range(count)
+    ])
+
+
+def test_old_final_rows_move_in_batches(db):
+    seed(db, 5)
+    seed_recent = datetime.utcnow() - timedelta(days=1)
+    db.transactions.insert_one({"_id": "recent", "status": "completed", "timestamp": seed_recent})
+
+    moved = archive.archive(db, older_than_days=90, batch_size=2)
+
+    assert moved == {"transactions": 5, "payments": 0}
+    assert [d["_id"] for d in db.transactions.find()] == ["recent"]
+    assert db.transactions_archive.count_documents({}) == 5
+
+
+def test_a_row_the_archive_refuses_is_skipped(db):
+    seed(db, 5)
+    # The oldest row's checkout id is already archived under another _id
+    db.transactions_archive.create_index("checkout_id", unique=True)
+    db.transactions_archive.insert_one({"_id": "other", "checkout_id": "ws_CO_0"})
+    skipped = {}
+
+    moved = archive.archive(db, older_than_days=90, batch_size=2, skipped=skipped)
+
+    assert moved["transactions"] == 4
+    assert skipped["transactions"] == {"ws_CO_0"}
+    assert [d["_id"] for d in db.transactions.find()] == ["ws_CO_0"]
+
+
+def test_cutoff_is_utc(db):
+    # Ten minutes past the cut-off in UTC, whatever the host's timezone
+    db.transactions.insert_one({
+        "_id": "edge", "status": "completed",
+        "timestamp": datetime.utcnow() - timedelta(days=90, minutes=10)
+    })
+
+    assert archive.archive(db, older_than_days=90)["transactions"] == 1
@@ -0,0 +1,157 @@
+import threading
+import time
+
+from cache import TTLCache, SingleFlight
+
+
+def test_fetch_that_raced_an_invalidation_is_not_cached():
+    cache = TTLCache()
+    token = cache.token()
+    # A write lands while the fetch is in flight
+    cache.invalidate('alice')
+
+    assert not cache.set('alice', {'words_remaining': 100}, token)
+    assert cache.get('alice') is None
+
+
+def test_fetch_that_raced_a_clear_is_not_cached():
+    cache = TTLCache()
+    token = cache.token()
+    cache.clear()
+
+    assert not cache.set('alice', {'words_remaining': 100}, token)
+    assert cache.get('alice') is None
+
+
+def test_fetch_started_after_a_clear_is_cached():
+    cache = TTLCache()
+    cache.clear()
+    token = cache.token()
+
+    assert cache.set('alice', {'words_remaining': 100}, token)
+    assert cache.get('alice') == {'words_remaining': 100}
+
+
+def test_invalidation_only_affects_its_key():
+    cache = TTLCache()
+    token = cache.token()
+    cache.invalidate('bob')
+
+    assert cache.set('alice', 1, token)
+
+
+class Gate:
+    """A fetch that blocks until released, counting how often it ran"""
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        assert self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def call_in_threads(flights, key, fetch, count):
+    """Start count callers of flights.do, returns (threads, outcomes)"""
+    outcomes = []
+
+    def call():
+        try:
+            outcomes.append(flights.do(key, fetch))
+        except Exception as e:
+            outcomes.append(e)
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+
+def wait_for_collapsed(flights, count):
+    deadline = time.monotonic() + 5
+    while flights.stats()["collapsed"] < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def finish(gate, threads):
+    gate.release.set()
+    for thread in threads:
+        thread.join(5)
+
+
+def test_concurrent_calls_share_one_fetch():
+    flights = SingleFlight()
+    gate = Gate(result={"status": "completed"})
+    threads, outcomes = call_in_threads(flights, "ws_CO_1", gate, 8)
+    wait_for_collapsed(flights, 7)
+
+    finish(gate, threads)
+
+    assert gate.calls == 1
+    assert outcomes == [{"status": "completed"}] * 8
+    assert flights.stats() == {"calls": 1, "collapsed": 7, "collapse_rate": 7 / 8, "in_flight": 0}
+
+
+def test_waiters_share_the_fetch_exception():
+    flights = SingleFlight()
+    error = ConnectionError("MongoDB is down")
+    gate = Gate(error=error)
+    threads, outcomes = call_in_threads(flights, "ws_CO_1", gate, 4)
+    wait_for_collapsed(flights, 3)
+
+    finish(gate, threads)
+
+    assert gate.calls == 1
+    assert outcomes == [error] * 4
+
+
+def test_next_call_after_a_flight_fetches_again():
+    flights = SingleFlight()
+
+    assert flights.do("ws_CO_1", lambda: "pending") == "pending"
+    assert flights.do("ws_CO_1", lambda: "completed") == "completed"
+    assert flights.stats()["calls"] == 2
+
+
+def test_forget_detaches_the_in_flight_call():
+    flights = SingleFlight()
+    old = Gate(result="pending")
+    threads, outcomes = call_in_threads(flights, "ws_CO_1", old, 2)
+    wait_for_collapsed(flights, 1)
+
+    # A writer settles the checkout while the old read is in flight
+    flights.forget("ws_CO_1")
+    assert flights.do("ws_CO_1", lambda: "completed") == "completed"
+
+    finish(old, threads)
+    # Callers that joined the old read still get its result
+    assert outcomes == ["pending", "pending"]
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_forget_does_not_drop_a_newer_flight():
+    flights = SingleFlight()
+    old = Gate(result="pending")
+    threads, _ = call_in_threads(flights, "ws_CO_1", old, 1)
+    assert old.started.wait(5)
+    flights.forget("ws_CO_1")
+    new = Gate(result="completed")
+    new_threads, outcomes = call_in_threads(flights, "ws_CO_1", new, 1)
+    assert new.started.wait(5)
+
+    # The old call finishing must not remove the new one
+    finish(old, threads)
+    assert flights.stats()["in_flight"] == 1
+    joined, joined_outcomes = call_in_threads(flights, "ws_CO_1", new, 1)
+    wait_for_collapsed(flights, 1)
+
+    finish(new, new_threads + joined)
+    assert new.calls == 1
+    assert outcomes + joined_outcomes == ["completed", "completed"]
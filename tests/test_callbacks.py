@@ -0,0 +1,107 @@
+import json
+import threading
+import http.client
+
+import pytest
+from pymongo.errors import AutoReconnect, ConnectionFailure
+
+import models
+import payment
+from callbacks import CallbackQueue, CallbackConsumer, CallbackServer
+
+CALLBACK = {'checkout_id': 'STK-test-1', 'reference': 'REF1'}
+
+
+@pytest.fixture
+def mongo_down(monkeypatch):
+    monkeypatch.setattr(models, 'mongo_connected', False)
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = CallbackQueue(str(tmp_path / 'callbacks.db'))
+    queue.put(CALLBACK['checkout_id'], json.dumps(CALLBACK))
+    return queue
+
+
+def test_callback_is_not_settled_in_fallback_store_while_mongo_is_down(app, mongo_down):
+    with pytest.raises(ConnectionFailure):
+        payment.process_payment_callback(dict(CALLBACK))
+
+
+def test_callback_raises_when_mongo_fails_during_settlement(app, monkeypatch):
+    monkeypatch.setattr(models, 'mongo_connected', True)
+    monkeypatch.setattr(models, 'mongo_client', object())
+    monkeypatch.setattr(models.mongo_breaker, 'record_failure', lambda error: None)
+
+    def unreachable():
+        raise AutoReconnect("connection reset")
+    monkeypatch.setattr(models, 'get_db', unreachable)
+
+    with pytest.raises(AutoReconnect):
+        payment.process_payment_callback(dict(CALLBACK))
+
+
+def test_consumer_keeps_callback_queued_while_mongo_is_down(app, mongo_down, queue):
+    consumer = CallbackConsumer(queue, payment.process_payment_callback, context=app.app_context, concurrency=1)
+
+    assert consumer.run_batch() == 0
+    stats = queue.stats()
+    assert stats['depth'] == 1
+    assert stats['retried'] == 1
+    assert stats['acknowledged'] == 0
+    assert consumer.stats()['failures'] == 1
+
+
+def test_consumer_acknowledges_applied_callbacks_and_repeats(app, queue):
+    queue.put(CALLBACK['checkout_id'], json.dumps(CALLBACK))
+    applied = []
+    consumer = CallbackConsumer(queue, lambda data: applied.append(data['checkout_id']) or True, concurrency=1)
+
+    assert consumer.run_batch() == 2
+    assert applied == [CALLBACK['checkout_id']]
+    assert queue.stats()['depth'] == 0
+    assert consumer.stats()['duplicates'] == 1
+
+
+@pytest.mark.parametrize('enabled, status', [(False, 404), (True, 200)])
+def test_stats_are_served_only_when_enabled(queue, enabled, status):
+    server = CallbackServer(('127.0.0.1', 0), queue, stats_enabled=enabled)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+        conn.request('GET', '/stats')
+        response = conn.getresponse()
+        body = json.loads(response.read())
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert response.status == status
+    assert ('queue' in body) == enabled
+
+
+def test_mongo_outage_never_kills_a_callback(app, mongo_down, queue):
+    consumer = CallbackConsumer(queue, payment.process_payment_callback, context=app.app_context,
+                                concurrency=1, max_attempts=1, retry_delay=0)
+
+    for _ in range(3):
+        consumer.run_batch()
+
+    stats = queue.stats()
+    assert (stats['depth'], stats['dead_queued'], stats['dead']) == (1, 0, 0)
+    assert queue.ready(10)[0][4] == 0
+
+
+def test_dead_callbacks_can_be_requeued(queue):
+    def broken(data):
+        raise ValueError("bad callback")
+    consumer = CallbackConsumer(queue, broken, concurrency=1, max_attempts=1)
+
+    consumer.run_batch()
+    assert queue.stats()['dead_queued'] == 1
+    assert queue.ready(10) == []
+
+    assert queue.requeue_dead() == 1
+    assert queue.ready(10)[0][4] == 0
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+from pymongo.errors import ConfigurationError
+
+import models
+
+
+@pytest.fixture
+def no_mongo_uri(monkeypatch):
+    monkeypatch.delenv('MONGO_URI', raising=False)
+    for name in ('mongo_client', '_client_pid', '_handles', 'mongo_connected', '_mongo_app'):
+        monkeypatch.setattr(models, name, getattr(models, name))
+
+
+def test_explicit_uri_wins_over_the_environment(monkeypatch):
+    monkeypatch.setenv('MONGO_URI', 'mongodb://env-host:27017')
+    monkeypatch.setenv('MONGO_DBNAME', 'lipia')
+
+    assert models.resolve_mongo_uri('mongodb://given-host:27017') == 'mongodb://given-host:27017/lipia'
+    assert models.resolve_mongo_uri() == 'mongodb://env-host:27017/lipia'
+
+
+def test_no_uri_resolves_to_none(no_mongo_uri):
+    assert models.resolve_mongo_uri() is None
+
+
+def test_reconnect_after_fork_without_a_uri_is_a_configuration_error(no_mongo_uri, monkeypatch):
+    monkeypatch.setattr(models, '_mongo_app', None)
+    # A client inherited from a parent process
+    monkeypatch.setattr(models, '_client_pid', os.getpid() + 1)
+
+    with pytest.raises(ConfigurationError):
+        models.get_db()
+
+
+def test_app_without_a_uri_starts_on_the_fallback_store(no_mongo_uri, app, monkeypatch):
+    monkeypatch.setenv('MONGO_FALLBACK_TO_MEMORY', 'true')
+    trips = []
+    monkeypatch.setattr(models.mongo_breaker, 'trip', trips.append)
+
+    models.init_mongo(app)
+
+    assert not models.mongo_connected
+    # No URI to probe, so no breaker probing it forever
+    assert trips == []
+
+
+def test_app_without_a_uri_fails_when_fallback_is_off(no_mongo_uri, app, monkeypatch):
+    monkeypatch.setenv('MONGO_FALLBACK_TO_MEMORY', 'false')
+
+    with pytest.raises(ConfigurationError):
+        models.init_mongo(app)
@@ -0,0 +1,50 @@
+"""
+Explain-plan check for paginated payment history: the first-page and
+next-page queries models.get_user_payments_page issues must be served by
+an index scan with no in-memory SORT stage. Needs TEST_MONGO_URI.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import models
+import indexes
+
+
+@pytest.fixture(scope='module')
+def payments(mongo_db):
+    indexes.apply(mongo_db, collections=("payments",))
+    base = datetime(2024, 1, 1)
+    mongo_db.payments.insert_many([
+        {
+            "username": f"planbench{i % 10}",
+            "amount": 20,
+            "reference": f"REF{i}",
+            "checkout_id": f"planbench-{i}",
+            "subscription_type": "basic",
+            "timestamp": base + timedelta(minutes=i // 3),
+            "status": "completed"
+        }
+        for i in range(5000)
+    ])
+    yield mongo_db.payments
+    mongo_db.payments.delete_many({"username": {"$regex": "^planbench"}})
+
+
+def next_page_cursor(payments):
+    page = list(payments.find({"username": "planbench3"}).sort(models.PAYMENT_HISTORY_SORT)
+                .limit(models.PAYMENT_HISTORY_PAGE_SIZE))
+    return models.encode_history_cursor(page[-1]["timestamp"], page[-1]["_id"])
+
+
+@pytest.mark.parametrize('page', ['first', 'next'])
+def test_history_page_is_an_index_scan(payments, page):
+    cursor = next_page_cursor(payments) if page == 'next' else None
+    query = models.payment_history_query("planbench3", cursor)
+
+    explain = payments.find(query).sort(models.PAYMENT_HISTORY_SORT).limit(models.PAYMENT_HISTORY_PAGE_SIZE + 1).explain()
+    stages = indexes.plan_stages(explain['queryPlanner']['winningPlan'])
+
+    assert 'IXSCAN' in stages, stages
+    assert 'SORT' not in stages, stages
+    assert 'COLLSCAN' not in stages, stages
@@ -0,0 +1,35 @@
+import socket
+
+import pytest
+import requests
+
+from http_client import _not_sent
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def error_from(call):
+    with pytest.raises(requests.exceptions.RequestException) as raised:
+        call()
+    return raised.value
+
+
+def test_refused_connection_was_not_sent():
+    error = error_from(lambda: requests.post(f'http://127.0.0.1:{unused_port()}/', timeout=2))
+    assert isinstance(error, requests.exceptions.ConnectionError)
+    assert _not_sent(error)
+
+
+def test_read_timeout_may_have_been_sent():
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        # Accepted by the kernel, never answered
+        error = error_from(lambda: requests.post(f'http://127.0.0.1:{port}/', timeout=0.2))
+    assert isinstance(error, requests.exceptions.ReadTimeout)
+    assert not _not_sent(error)
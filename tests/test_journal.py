@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+import journal
+from journal import Journal
+
+
+@pytest.fixture
+def fallback_journal(tmp_path):
+    fallback_journal = Journal(str(tmp_path), commit_interval=0)
+    yield fallback_journal
+    fallback_journal.close()
+
+
+def test_written_entries_are_replayed(fallback_journal):
+    fallback_journal.write('user', 'alice', {'words_remaining': 10})
+    fallback_journal.write('transaction', 'STK-1', {'status': 'pending'})
+
+    segments = fallback_journal.seal()
+    assert list(fallback_journal.replay(segments)) == [
+        ('user', 'alice', {'words_remaining': 10}),
+        ('transaction', 'STK-1', {'status': 'pending'})
+    ]
+
+
+def test_failed_write_is_raised_to_waiters_and_retried(fallback_journal, monkeypatch):
+    fallback_journal.write('user', 'alice', {'words_remaining': 10})
+
+    def disk_full(fd):
+        raise OSError(28, "No space left on device")
+
+    fsync = os.fsync
+    monkeypatch.setattr(journal.os, 'fsync', disk_full)
+    with pytest.raises(OSError):
+        fallback_journal.write('user', 'alice', {'words_remaining': 9})
+    assert fallback_journal.metrics['write_errors'] >= 1
+
+    # Once the disk recovers the kept batch is written, exactly once
+    monkeypatch.setattr(journal.os, 'fsync', fsync)
+    fallback_journal.write('user', 'alice', {'words_remaining': 8})
+
+    segments = fallback_journal.seal()
+    assert [record['words_remaining'] for _, _, record in fallback_journal.replay(segments)] == [10, 9, 8]
@@ -0,0 +1,138 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import ledger
+from leases import LeaseManager
+
+
+@pytest.fixture
+def user(mock_db):
+    mock_db.users.insert_one({"username": "alice", "words_remaining": 1000, "ledger_ops": []})
+    return "alice"
+
+
+def expire(db, seconds=60):
+    db.word_leases.update_many({"state": "active"}, {"$set": {"expires_at": datetime.now() - timedelta(seconds=seconds)}})
+
+
+def test_debits_are_served_from_the_lease(mock_db, user):
+    leases = LeaseManager(block=100)
+
+    assert leases.debit(mock_db, user, 30) == (True, 970)
+    assert leases.debit(mock_db, user, 30) == (True, 940)
+    assert ledger.balance(mock_db, user) == 900
+    assert mock_db.word_leases.find_one({"username": user})["remaining"] == 40
+
+
+def test_reclaim_returns_exactly_what_a_dead_worker_left(mock_db, user):
+    dead = LeaseManager(block=100)
+    for _ in range(7):
+        assert dead.debit(mock_db, user, 3)[0]
+    expire(mock_db)
+
+    assert LeaseManager(block=100, grace=0).reclaim_expired(mock_db) == 1
+    assert ledger.balance(mock_db, user) == 1000 - 21
+    assert mock_db.word_leases.find_one({"username": user})["state"] == "returned"
+
+
+def test_lease_lost_to_a_reclaimer_spends_nothing(mock_db, user):
+    worker = LeaseManager(block=100)
+    assert worker.debit(mock_db, user, 10) == (True, 990)
+    expire(mock_db)
+    LeaseManager(block=100, grace=0).reclaim_expired(mock_db)
+    # The worker has not noticed its lease expired yet
+    next(iter(worker._leases.values())).expires_at = datetime.now() + timedelta(seconds=60)
+
+    assert worker.debit(mock_db, user, 10) is None
+    assert worker.stats()["lost"] == 1
+    assert ledger.balance(mock_db, user) == 990
+
+
+def test_release_returns_the_unused_words(mock_db, user):
+    leases = LeaseManager(block=100)
+    leases.debit(mock_db, user, 25)
+
+    leases.release(mock_db, user)
+
+    assert ledger.balance(mock_db, user) == 975
+    assert leases.local_remaining(user) == 0
+
+
+def test_counters_add_up_across_threads(mock_db, user):
+    leases = LeaseManager(block=500)
+
+    def spend():
+        for _ in range(50):
+            leases.debit(mock_db, user, 1)
+
+    threads = [threading.Thread(target=spend) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = leases.stats()
+    assert stats["local_debits"] + stats["direct_debits"] == 400
+    leases.release_all(mock_db)
+    assert ledger.balance(mock_db, user) == 1000 - stats["local_debits"]
+
+
+def test_debit_too_large_for_a_lease_returns_the_lease_first(mock_db):
+    mock_db.users.insert_one({"username": "bob", "words_remaining": 600, "ledger_ops": []})
+    leases = LeaseManager(block=500)
+    assert leases.debit(mock_db, "bob", 10) == (True, 590)
+
+    assert leases.debit(mock_db, "bob", 550) is None
+    assert ledger.balance(mock_db, "bob") == 590
+    assert ledger.debit(mock_db, "bob", 550, ledger.new_op_id(), "debit") == (True, 40)
+
+
+def test_expired_lease_is_returned_before_the_next_grant(mock_db, user):
+    leases = LeaseManager(block=100)
+    leases.debit(mock_db, user, 10)
+    next(iter(leases._leases.values())).expires_at = datetime.now()
+
+    assert leases.debit(mock_db, user, 10) == (True, 980)
+    states = sorted(doc["state"] for doc in mock_db.word_leases.find({"username": user}))
+    assert states == ["active", "returned"]
+    leases.release_all(mock_db)
+    assert ledger.balance(mock_db, user) == 980
+
+
+def test_refused_debit_takes_back_other_workers_leases(mock_mongo, monkeypatch):
+    import models
+    monkeypatch.setattr(models, 'WORD_LEDGER_ENABLED', True)
+    monkeypatch.setattr(models, 'WORD_LEASES_ENABLED', True)
+    monkeypatch.setattr(models, 'word_leases', LeaseManager(block=500))
+    mock_mongo.users.insert_one({"username": "carol", "words_remaining": 600, "ledger_ops": []})
+    other = LeaseManager(block=500)
+    assert other.debit(mock_mongo, "carol", 10) == (True, 590)
+
+    assert models.consume_words("carol", 550) == (True, 40)
+    assert models.word_leases.stats()["reclaims"] == 1
+    # The other worker's lease went back with the reclaim
+    assert other.debit(mock_mongo, "carol", 10) is None
+    assert ledger.balance(mock_mongo, "carol") == 40
+
+
+def test_debit_is_refused_once_leases_are_counted(mock_mongo, monkeypatch):
+    import models
+    monkeypatch.setattr(models, 'WORD_LEDGER_ENABLED', True)
+    monkeypatch.setattr(models, 'WORD_LEASES_ENABLED', True)
+    monkeypatch.setattr(models, 'word_leases', LeaseManager(block=500))
+    mock_mongo.users.insert_one({"username": "dave", "words_remaining": 600, "ledger_ops": []})
+    LeaseManager(block=500).debit(mock_mongo, "dave", 10)
+
+    assert models.consume_words("dave", 700) == (False, 590)
+
+
+def test_leases_without_the_ledger_are_reported(app, monkeypatch, caplog):
+    import models
+    monkeypatch.setattr(models, 'WORD_LEDGER_ENABLED', False)
+    monkeypatch.setattr(models, 'WORD_LEASES_ENABLED', True)
+
+    assert not models._check_lease_settings(app)
+    assert "WORD_LEDGER_ENABLED" in caplog.text
+    assert models.get_lease_metrics()["enabled"] is False
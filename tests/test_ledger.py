@@ -0,0 +1,134 @@
+"""
+Ledger replays: every operation reaches the balance exactly once, however
+often it is retried or wherever it was interrupted. Runs on mongomock, and
+again against TEST_MONGO_URI when it is set.
+"""
+import uuid
+
+import pytest
+
+import ledger
+
+
+@pytest.fixture(params=['mock_db', 'mongo_db'])
+def db(request):
+    return request.getfixturevalue(request.param)
+
+
+@pytest.fixture
+def user(db):
+    username = f"ledger-{uuid.uuid4().hex[:8]}"
+    db.users.insert_one({"username": username, "words_remaining": 100, "ledger_ops": []})
+    return username
+
+
+def words(db, username):
+    return db.users.find_one({"username": username})["words_remaining"]
+
+
+def test_debit_is_applied_once(db, user):
+    op_id = ledger.new_op_id()
+
+    assert ledger.debit(db, user, 30, op_id, "debit") == (True, 70)
+    assert ledger.debit(db, user, 30, op_id, "debit") == (True, 70)
+    assert ledger.balance(db, user) == 70
+
+
+def test_replayed_debit_without_its_entry_is_applied(db, user):
+    op_id = ledger.new_op_id()
+    assert ledger.debit(db, user, 30, op_id, "debit") == (True, 70)
+    # As if the process died between the balance update and the entry write
+    db.word_ledger.delete_one({"_id": op_id})
+
+    assert ledger.debit(db, user, 30, op_id, "debit") == (True, 70)
+    assert ledger.balance(db, user) == 70
+
+
+def test_debit_refused_when_balance_is_short(db, user):
+    assert ledger.debit(db, user, 130, ledger.new_op_id(), "debit") == (False, 100)
+
+
+def test_debit_folds_pending_credits_before_refusing(db, user):
+    ledger.append(db, user, 50, ledger.new_op_id(), "credit")
+
+    assert ledger.debit(db, user, 130, ledger.new_op_id(), "debit") == (True, 20)
+    assert ledger.balance(db, user) == 20
+
+
+def test_credit_is_applied_once(db, user):
+    op_id = ledger.new_op_id()
+
+    assert ledger.credit(db, user, 50, op_id, "credit") == 150
+    assert ledger.credit(db, user, 50, op_id, "credit") == 150
+    assert words(db, user) == 150
+
+
+def test_credit_for_a_missing_user_leaves_no_entry(db):
+    op_id = ledger.new_op_id()
+
+    assert ledger.credit(db, f"missing-{op_id}", 50, op_id, "credit") is None
+    assert db.word_ledger.find_one({"_id": op_id}) is None
+
+
+def test_interrupted_credit_is_finished_once(db, user):
+    op_id = ledger.new_op_id()
+    assert ledger.credit(db, user, 50, op_id, "credit") == 150
+    # As if the process died between the fold and marking the entry folded
+    db.word_ledger.update_one({"_id": op_id}, {"$set": {"folded": False}})
+
+    assert ledger.credit(db, user, 50, op_id, "credit") == 150
+    assert db.word_ledger.find_one({"_id": op_id})["folded"] is True
+
+
+def test_unfolded_credit_counts_once_in_the_balance(db, user):
+    op_id = ledger.new_op_id()
+    ledger.append(db, user, 50, op_id, "credit")
+    # Folded into the snapshot, not marked yet
+    db.users.update_one({"username": user}, {"$inc": {"words_remaining": 50}, "$push": {"ledger_ops": op_id}})
+
+    assert ledger.balance(db, user) == 150
+    assert ledger.applied(db, user, op_id)
+
+
+def test_fold_leaves_a_missing_users_entries_unfolded(db):
+    username = f"missing-{uuid.uuid4().hex[:8]}"
+    ledger.append(db, username, 50, ledger.new_op_id(), "credit")
+
+    assert ledger.fold_user(db, username) == 0
+    assert db.word_ledger.count_documents({"username": username, "folded": False}) == 1
+
+
+def test_fold_finishes_an_interrupted_fold_without_applying_twice(db, user):
+    first, second = ledger.new_op_id(), ledger.new_op_id()
+    ledger.append(db, user, 10, first, "credit")
+    ledger.append(db, user, 20, second, "credit")
+    # The first entry reached the snapshot but was never marked folded
+    db.users.update_one({"username": user}, {"$inc": {"words_remaining": 10}, "$push": {"ledger_ops": first}})
+
+    assert ledger.fold_user(db, user) == 2
+    assert words(db, user) == 130
+    assert ledger.balance(db, user) == 130
+    assert ledger.fold_user(db, user) == 0
+
+
+def test_compaction_folds_each_entry_once(db, user):
+    for _ in range(3):
+        ledger.append(db, user, 10, ledger.new_op_id(), "credit")
+
+    ledger.compact(db, grace_seconds=-1)
+    ledger.compact(db, grace_seconds=-1)
+
+    assert words(db, user) == 130
+    assert db.word_ledger.count_documents({"username": user, "folded": False}) == 0
+
+
+def test_replayed_credit_through_models_is_applied_once(mock_mongo, monkeypatch):
+    import models
+    monkeypatch.setattr(models, 'WORD_LEDGER_ENABLED', True)
+    mock_mongo.users.insert_one({"username": "grace", "words_remaining": 100, "ledger_ops": []})
+
+    assert models.update_word_count("grace", 100, op_id="checkout-1") == 200
+    assert models.update_word_count("grace", 100, op_id="checkout-1") == 200
+    assert models.consume_words("grace", 50, op_id="debit-1") == (True, 150)
+    assert models.consume_words("grace", 50, op_id="debit-1") == (True, 150)
+    assert models.get_user("grace")["words_remaining"] == 150
@@ -0,0 +1,22 @@
+import pytest
+
+import manage
+
+
+def test_commands_exit_with_usage_without_mongo_uri(monkeypatch, capsys):
+    monkeypatch.delenv('MONGO_URI', raising=False)
+
+    with pytest.raises(SystemExit) as exited:
+        manage.main(['ensure-indexes'])
+
+    assert 'MONGO_URI is not set' in str(exited.value.code)
+
+
+def test_commands_exit_when_mongo_is_unreachable(monkeypatch):
+    monkeypatch.setenv('MONGO_URI', 'mongodb://127.0.0.1:1/lipia_test')
+    monkeypatch.setenv('MONGO_TIMEOUT', '1')
+
+    with pytest.raises(SystemExit) as exited:
+        manage.main(['archive'])
+
+    assert 'Could not reach MongoDB' in str(exited.value.code)
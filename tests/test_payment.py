@@ -0,0 +1,122 @@
+import uuid
+
+import pytest
+from flask import Flask
+
+import models
+import payment
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(models, 'mongo_connected', False)
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.register_blueprint(payment.payment_bp)
+    with app.app_context():
+        yield app.test_client()
+
+
+@pytest.fixture
+def checkout_id():
+    checkout_id = f"STK-test-{uuid.uuid4().hex[:8]}"
+    models.save_transaction(checkout_id, {
+        'checkout_id': checkout_id,
+        'username': 'alice',
+        'amount': 20,
+        'phone': '0712345678',
+        'subscription_type': 'basic',
+        'status': 'pending'
+    })
+    models.record_payment('alice', 20, 'basic', 'pending', 'N/A', checkout_id)
+    return checkout_id
+
+
+def test_cancel_pending_payment(client, checkout_id):
+    response = client.post(f'/payment/cancel/{checkout_id}')
+
+    assert response.status_code == 200
+    assert models.get_transaction(checkout_id)['status'] == 'cancelled'
+    assert payment.ACTIVE_TRANSACTIONS[checkout_id] == 'cancelled'
+
+
+def test_cancel_completed_payment_is_refused(client, checkout_id):
+    assert models.update_payment_status(checkout_id, 'completed')
+
+    response = client.post(f'/payment/cancel/{checkout_id}')
+
+    assert response.status_code == 409
+    assert models.get_transaction(checkout_id)['status'] == 'completed'
+    assert payment.ACTIVE_TRANSACTIONS.get(checkout_id) != 'cancelled'
+
+
+def test_transaction_status_follows_payment_transitions(client, checkout_id):
+    assert models.update_transaction_status(checkout_id, 'failed')
+    assert not models.update_transaction_status(checkout_id, 'cancelled')
+    assert models.get_transaction(checkout_id)['status'] == 'failed'
+
+
+@pytest.mark.parametrize('final', sorted(payment.FINAL_STATUSES))
+def test_final_status_is_never_replaced(client, final):
+    checkout_id = f"STK-test-{uuid.uuid4().hex[:8]}"
+    payment._set_status(checkout_id, 'pending')
+    payment._set_status(checkout_id, final)
+
+    for status in ('pending',) + payment.FINAL_STATUSES:
+        payment._set_status(checkout_id, status)
+
+    assert payment.ACTIVE_TRANSACTIONS[checkout_id] == final
+    assert payment.status_cache.peek(checkout_id)['status'] == final
+
+
+def test_stats_are_off_by_default(client):
+    assert client.get('/payment/stats').status_code == 404
+
+
+def test_stats_report_every_counter(client, monkeypatch):
+    monkeypatch.setattr(payment, 'PAYMENT_STATS_ENABLED', True)
+
+    response = client.get('/payment/stats')
+
+    assert response.status_code == 200
+    stats = response.get_json()
+    assert set(stats['mongo']) == {'breaker', 'sync', 'user_cache', 'single_flight', 'word_leases'}
+    assert set(stats['payment']) == {'stk_dispatch', 'lipia_http', 'status_cache', 'events'}
+    assert stats['mongo']['breaker']['state'] == models.mongo_breaker.state
+
+
+def test_events_are_off_with_sync_workers(client, checkout_id):
+    assert not payment.PAYMENT_EVENTS_ENABLED
+    assert client.get(f'/payment/events/{checkout_id}').status_code == 404
+
+
+def test_events_of_a_settled_checkout_are_one_event(client, checkout_id, monkeypatch):
+    monkeypatch.setattr(payment, 'PAYMENT_EVENTS_ENABLED', True)
+    models.update_transaction_status(checkout_id, 'completed')
+
+    response = client.get(f'/payment/events/{checkout_id}')
+
+    assert response.mimetype == 'text/event-stream'
+    assert response.get_data(as_text=True).count('event: status') == 1
+
+
+def test_pending_stream_ends_and_asks_for_a_reconnect(client, checkout_id, monkeypatch):
+    monkeypatch.setattr(payment, 'PAYMENT_EVENTS_ENABLED', True)
+    monkeypatch.setattr(payment, 'PAYMENT_EVENTS_TIMEOUT', 0.1)
+
+    body = client.get(f'/payment/events/{checkout_id}').get_data(as_text=True)
+
+    assert body.startswith(f"retry: {payment.PAYMENT_EVENTS_RETRY_MS}\n")
+    assert body.count('event: status') == 1
+    assert payment.status_events.stats()['open'] == 0
+
+
+@pytest.mark.parametrize('threads, wanted, cap', [
+    (64, None, 48),
+    (64, 60, 48),
+    (64, 10, 10),
+    (8, None, 4),
+    (4, None, 0),
+])
+def test_stream_cap_leaves_threads_for_requests(threads, wanted, cap):
+    assert payment.events_stream_cap(threads, wanted) == cap
@@ -0,0 +1,113 @@
+"""
+Round-trip budgets: no payment route may send more MongoDB commands than
+its budget, read from the X-Mongo-Ops header. The user cache is cleared
+before every call, so each count is the cold worst case. Needs
+TEST_MONGO_URI.
+
+Budgets assume word leases off. The word ledger (WORD_LEDGER_ENABLED)
+adds its entry writes to crediting routes and its tail read to account
+reads. Settling a payment on a replica set adds commitTransaction to the
+callback budget.
+"""
+import os
+import uuid
+
+import pytest
+from flask import Flask
+
+import models
+import indexes
+from auth import auth_bp
+
+
+@pytest.fixture(scope='module')
+def client(mongo_db):
+    with pytest.MonkeyPatch.context() as patch:
+        # init_mongo connects this process; put it back for the other tests
+        for name in ('mongo_connected', 'mongo_client', '_mongo_app', 'MONGO_OPS_HEADER'):
+            patch.setattr(models, name, getattr(models, name))
+        patch.setattr(models, 'MONGO_OPS_HEADER', True)
+        patch.setenv('MONGO_FALLBACK_TO_MEMORY', 'false')
+
+        app = Flask(__name__)
+        app.secret_key = 'roundtrips'
+        app.config['MONGO_URI'] = os.environ['TEST_MONGO_URI']
+        models.init_mongo(app)
+        import payment
+        patch.setattr(payment, 'PAYMENT_EVENTS_ENABLED', True)
+        app.register_blueprint(payment.payment_bp)
+        app.register_blueprint(auth_bp)
+        # initiate redirects here after activating a free plan
+        app.add_url_rule('/dashboard', 'dashboard', lambda: 'dashboard')
+        indexes.apply(models.get_db(), log=lambda message: None)
+        yield app.test_client()
+
+
+def seed(username, checkouts):
+    models.create_user(username, '1234', '0712345678')
+    for checkout_id in checkouts:
+        models.save_transaction(checkout_id, {
+            'checkout_id': checkout_id,
+            'username': username,
+            'amount': 20,
+            'phone': '0712345678',
+            'subscription_type': 'basic',
+            'status': 'pending'
+        })
+        models.record_payment(username, 20, 'basic', 'pending', 'N/A', checkout_id)
+
+
+def test_payment_routes_stay_within_round_trip_budgets(client):
+    from payment import ACTIVE_TRANSACTIONS, status_cache
+    db = models.get_db()
+    commit = 1 if models.SETTLE_WITH_TRANSACTION and db.supports_transactions else 0
+    # Ledger entry write and fold mark per credit, tail read per balance
+    credit, tail = (2, 1) if models.WORD_LEDGER_ENABLED else (0, 0)
+
+    run = uuid.uuid4().hex[:8]
+    username = f"roundtrips-{run}"
+    pending, settled, cancelled = (f"ws_CO_{run}_{i}" for i in range(3))
+    seed(username, (pending, settled, cancelled))
+    with client.session_transaction() as session:
+        session['user_id'] = username
+
+    def check_completed_in_memory():
+        ACTIVE_TRANSACTIONS[settled] = 'completed'
+
+    def forget(checkout_id):
+        # As a worker that has not seen the checkout
+        ACTIVE_TRANSACTIONS.pop(checkout_id, None)
+        status_cache.invalidate(checkout_id)
+
+    # (label, method, path, request kwargs, budget, setup)
+    cases = [
+        ("check pending", "get", f"/payment/check/{pending}", {}, 1, lambda: forget(pending)),
+        ("check unknown", "get", f"/payment/check/missing-{run}", {}, 2, None),
+        # Claim, transaction, summary entry and credit
+        ("callback settles", "post", "/payment/callback",
+         {"json": {"CheckoutRequestID": settled, "reference": "REF1"}}, 4 + credit + commit, None),
+        ("check completed", "get", f"/payment/check/{settled}", {}, 1, check_completed_in_memory),
+        # A settled checkout's stream is one event; the worker has not seen it yet
+        ("events settled", "get", f"/payment/events/{settled}", {}, 1, lambda: forget(settled)),
+        ("callback repeated", "post", "/payment/callback",
+         {"json": {"CheckoutRequestID": settled, "reference": "REF1"}}, 2 + commit, None),
+        ("callback unknown", "post", "/payment/callback",
+         {"json": {"CheckoutRequestID": f"missing-{run}"}}, 4 + commit, None),
+        ("cancel", "post", f"/payment/cancel/{cancelled}", {}, 3, None),
+        ("history", "get", "/payment/history", {}, 2, None),
+        # The user document with its summary
+        ("account", "get", "/api/account", {}, 1 + tail, None),
+        ("initiate free plan", "post", "/payment/initiate",
+         {"json": {"username": username, "subscription_type": "Free"}}, 6 + credit, None),
+    ]
+
+    over_budget = []
+    for label, method, path, kwargs, budget, setup in cases:
+        if setup:
+            setup()
+        models.user_cache.clear()
+        response = getattr(client, method)(path, **kwargs)
+        ops = int(response.headers.get('X-Mongo-Ops', -1))
+        if not 0 <= ops <= budget:
+            over_budget.append(f"{label}: {ops} commands (budget {budget}, HTTP {response.status_code})")
+    assert not over_budget, over_budget
@@ -0,0 +1,157 @@
+"""
+The users snapshot the fallback tier reads while MongoDB is down, and the
+reconciliation of balances debited against it once MongoDB is back.
+"""
+import os
+import uuid
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+import models
+import snapshot
+
+
+def user(username, words=100, **fields):
+    return dict({"username": username, "pin": "1234", "phone_number": "0712345678",
+                 "plan": "Basic", "payment_status": "Paid", "words_remaining": words}, **fields)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "users_snapshot.bin")
+
+
+def test_build_writes_every_user_in_username_order(mock_db, path):
+    mock_db.users.insert_many([user("carol", 30), user("alice", 10), user("bob", 20)])
+
+    assert snapshot.build(mock_db, path) == (3, 0)
+
+    users = snapshot.UserSnapshot(path)
+    assert len(users) == 3
+    assert [users.get(name)["words_remaining"] for name in ("alice", "bob", "carol")] == [10, 20, 30]
+
+
+def test_build_skips_users_that_do_not_fit(mock_db, path):
+    mock_db.users.insert_many([user("alice"), user("bob", pin="x" * 17)])
+
+    assert snapshot.build(mock_db, path) == (1, 1)
+    assert snapshot.UserSnapshot(path).get("bob") is None
+
+
+def test_lookup(path):
+    snapshot.write(path, [user("alice", 10), user("bob", 20, plan="Premium"), user("dave", 40)])
+    users = snapshot.UserSnapshot(path)
+
+    assert users.get("bob") == user("bob", 20, plan="Premium")
+    assert users.get("carol") is None
+    assert users.get("") is None
+    assert users.get("x" * 65) is None
+
+
+def test_unsorted_users_are_refused(path):
+    with pytest.raises(ValueError):
+        snapshot.write(path, [user("bob"), user("alice")])
+    assert not os.path.exists(path)
+
+
+def test_missing_or_foreign_file_reads_as_empty(path):
+    assert snapshot.UserSnapshot(path).get("alice") is None
+    with open(path, "wb") as f:
+        f.write(b"not a snapshot" * 10)
+    assert len(snapshot.UserSnapshot(path)) == 0
+
+
+def test_readers_remap_after_a_rename(path):
+    snapshot.write(path, [user("alice", 10)])
+    users = snapshot.UserSnapshot(path, check_interval=0)
+    assert users.get("alice")["words_remaining"] == 10
+
+    snapshot.write(path, [user("alice", 99), user("bob", 20)])
+
+    assert users.get("alice")["words_remaining"] == 99
+    assert users.get("bob")["words_remaining"] == 20
+
+
+def test_readers_keep_the_old_map_until_they_check(path):
+    snapshot.write(path, [user("alice", 10)])
+    users = snapshot.UserSnapshot(path, check_interval=3600)
+    assert users.get("alice")["words_remaining"] == 10
+
+    snapshot.write(path, [user("alice", 99)])
+
+    assert users.get("alice")["words_remaining"] == 10
+
+
+@pytest.fixture
+def stale(monkeypatch, path):
+    """A user whose snapshot balance (150) is older than MongoDB's (100)"""
+    username = f"snap-{uuid.uuid4().hex[:8]}"
+    snapshot.write(path, [user(username, 150)])
+    monkeypatch.setattr(models, 'user_snapshot', snapshot.UserSnapshot(path, check_interval=0))
+    yield username
+    models.users_db.pop(username, None)
+    models.users_db.changes.mark_clean([pair for pair in models.users_db.changes.take_dirty() if pair[0] == username])
+
+
+def debit_during_outage(monkeypatch, username, words):
+    with monkeypatch.context() as outage:
+        outage.setattr(models, 'mongo_connected', False)
+        return models.consume_words(username, words)
+
+
+def push(db, username):
+    """Apply the fallback user's sync ops the way _bulk_sync does, one at a time"""
+    models._pin_user_balance_changes()
+    record = models.users_db.get(username)
+    for collection, op in models._user_sync_ops(username, record):
+        try:
+            db[collection].update_one(op._filter, op._doc, upsert=op._upsert)
+        except DuplicateKeyError:
+            # Already applied, counts as synced
+            pass
+    models._user_synced(username, record)
+
+
+def test_fallback_debit_reaches_mongodb_as_a_delta(mock_mongo, monkeypatch, stale):
+    mock_mongo.users.create_index("username", unique=True)
+    mock_mongo.users.insert_one(user(stale, 100, ledger_ops=[]))
+
+    # Served from the stale snapshot balance
+    assert debit_during_outage(monkeypatch, stale, 30) == (True, 120)
+    push(mock_mongo, stale)
+
+    # MongoDB's balance less the debit, not the snapshot's
+    assert mock_mongo.users.find_one({"username": stale})["words_remaining"] == 70
+
+
+def test_fallback_debit_is_not_applied_twice(mock_mongo, monkeypatch, stale):
+    mock_mongo.users.create_index("username", unique=True)
+    mock_mongo.users.insert_one(user(stale, 100, ledger_ops=[]))
+    debit_during_outage(monkeypatch, stale, 30)
+    models._pin_user_balance_changes()
+    pinned = models._user_sync_ops(stale, models.users_db.get(stale))
+
+    # The sync is interrupted after MongoDB applied the change and retried
+    for collection, op in pinned:
+        mock_mongo[collection].update_one(op._filter, op._doc, upsert=op._upsert)
+    push(mock_mongo, stale)
+    push(mock_mongo, stale)
+
+    assert mock_mongo.users.find_one({"username": stale})["words_remaining"] == 70
+    assert models.users_db.get(stale)["words_synced"] == models.users_db.get(stale)["words_remaining"]
+
+
+def test_sync_after_outage_reconciles_against_live_balance(mongo_db, monkeypatch, app, stale):
+    for name in ('mongo_client', '_client_pid', '_handles'):
+        monkeypatch.setattr(models, name, getattr(models, name))
+    monkeypatch.setattr(models, 'mongo_connected', True)
+    models._set_client(mongo_db.client)
+    mongo_db.users.create_index("username", unique=True)
+    mongo_db.users.insert_one(user(stale, 100, ledger_ops=[]))
+
+    debit_during_outage(monkeypatch, stale, 30)
+    models.sync_memory_to_mongo(app)
+    models.sync_memory_to_mongo(app)
+
+    assert mongo_db.users.find_one({"username": stale})["words_remaining"] == 70
@@ -0,0 +1,46 @@
+import pytest
+
+from store import (
+    UserStore, TransactionStore, SQLiteFallbackDB, SQLiteUserStore, SQLiteTransactionStore
+)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def stores(request, tmp_path):
+    if request.param == 'memory':
+        return UserStore(), TransactionStore()
+    db = SQLiteFallbackDB(str(tmp_path / 'fallback.db'))
+    return SQLiteUserStore(db), SQLiteTransactionStore(db)
+
+
+def test_mirrored_writes_skip_records_not_stored(stores):
+    users, transactions = stores
+
+    assert not users.update_fields('alice', {'words_remaining': 5}, dirty=False)
+    assert not transactions.update('STK-1', {'status': 'completed'}, dirty=False)
+    assert len(users) == 0
+    assert len(transactions) == 0
+
+
+def test_prune_clean_keeps_unsynced_records(stores):
+    users, transactions = stores
+    users.put('alice', {'words_remaining': 10})
+    users.put('bob', {'words_remaining': 10}, dirty=False)
+    transactions.upsert('STK-1', {'user_id': 'alice', 'status': 'pending'})
+    transactions.upsert('STK-2', {'user_id': 'bob', 'status': 'completed'}, dirty=False)
+
+    assert users.prune_clean() == 1
+    assert transactions.prune_clean() == 1
+    assert users.get('alice')['words_remaining'] == 10
+    assert users.get('bob') is None
+    assert [t['transaction_id'] for t in transactions.for_user('alice')] == ['STK-1']
+    assert transactions.for_user('bob') == []
+    assert transactions.with_status('completed') == []
+
+    # Once synced they go too
+    users.changes.mark_clean(users.changes.take_dirty())
+    transactions.changes.mark_clean(transactions.changes.take_dirty())
+    assert users.prune_clean() == 1
+    assert transactions.prune_clean() == 1
+    assert len(users) == 0
+    assert len(transactions) == 0
@@ -0,0 +1,28 @@
+import uuid
+
+import pytest
+
+import models
+
+
+@pytest.fixture
+def username():
+    name = f"user-{uuid.uuid4().hex[:8]}"
+    yield name
+    models.users_db.pop(name, None)
+    models.users_db.changes.mark_clean([pair for pair in models.users_db.changes.take_dirty() if pair[0] == name])
+
+
+def test_signup_on_a_healthy_cluster_skips_the_fallback_store(mock_mongo, username):
+    assert models.create_user(username, '1234', '0712345678')
+
+    assert mock_mongo.users.find_one({"username": username})["pin"] == '1234'
+    assert username not in models.users_db
+
+
+def test_signup_without_mongodb_is_kept_for_the_sync(monkeypatch, username):
+    monkeypatch.setattr(models, 'mongo_connected', False)
+    assert models.create_user(username, '1234', '0712345678')
+
+    assert models.users_db[username]["password"] == '1234'
+    assert username in dict(models.users_db.changes.take_dirty())